@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Stress benchmark of the repositories scheduler
+
+Schedules a number of repositories, then runs a stream of rounds where due
+repositories are taken from the scheduler and rescheduled (as after a
+fetch), while other repositories are rescheduled (as after a
+notification). Run from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/scheduler.py [--repositories 100000] [--rounds 1000]
+"""
+import random
+import time
+
+import click
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from index.repositories import Scheduler
+
+
+@coroutine
+def run(repositories, rounds, reschedules, concurrency):
+    clock = {'now': 0.0}
+    scheduler = Scheduler()
+    scheduler._time = lambda: clock['now']
+    repo_ids = ['repo%d' % i for i in range(repositories)]
+
+    start = time.time()
+    for repo_id in repo_ids:
+        yield scheduler.schedule(repo_id, random.uniform(0, 3600))
+    click.echo('scheduled {:,} repositories in {:.2f}s'.format(repositories, time.time() - start))
+
+    operations = 0
+    start = time.time()
+    for _ in range(rounds):
+        clock['now'] += 3600.0 / rounds
+        due = yield scheduler.get(concurrency)
+        for repo_id in due:
+            yield scheduler.schedule(repo_id, random.uniform(1800, 3600))
+        for repo_id in random.sample(repo_ids, reschedules):
+            yield scheduler.schedule(repo_id, random.uniform(0, 3600))
+        operations += 1 + len(due) + reschedules
+
+    elapsed = time.time() - start
+    click.echo('{:,} operations in {:.2f}s ({:,.0f} operations/s)'.format(
+        operations, elapsed, operations / elapsed))
+    click.echo('{:,} entries in the queue'.format(len(scheduler._priority_q)))
+
+
+@click.command()
+@click.option('--repositories', default=100000, help='Number of repositories')
+@click.option('--rounds', default=1000, help='Number of rounds')
+@click.option('--reschedules', default=100, help='Reschedules in each round')
+@click.option('--concurrency', default=10, help='Repositories taken in each round')
+def cli(repositories, rounds, reschedules, concurrency):
+    IOLoop.current().run_sync(lambda: run(repositories, rounds, reschedules, concurrency))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Micro-benchmark of the validation of ingested identifiers
+
+Compares the rows per second validated by the previous row by row
+validation (formatting and matching the hub key patterns for each row) and
+by index.models.validators.validate_identifiers. Run from the root of the
+repository:
+
+    PYTHONPATH=. python benchmarks/validate_identifiers.py [--rows 10000] [--repeat 5]
+"""
+import logging
+import re
+import timeit
+import urllib
+import uuid
+
+import click
+from bass import hubkey
+
+from index.models.validators import validate_identifiers
+
+
+def validate_per_row(data):
+    """The validation previously done by DbInterface.add_entities"""
+    errors = []
+    accepted = []
+    for row in data:
+        row = dict(row)
+        skip = False
+        for f in ["entity_id", "source_id", "source_id_type"]:
+            if f not in row:
+                e = 'missing field entity_id skipping record %r' % (row,)
+                errors.append(e)
+                logging.warning("Error processing new record: %s" % (e,))
+                skip = True
+                break
+        if skip:
+            continue
+
+        if not re.match("[0-9a-f]{1,64}", row["entity_id"]):
+            e = 'skipping record %s - invalid id ' % (row["entity_id"],)
+            errors.append(e)
+            logging.info("Error processing new record: %s" % (e,))
+            continue
+
+        row["source_id_type"] = urllib.quote_plus(row["source_id_type"])
+        row["source_id"] = urllib.quote_plus(row["source_id"])
+
+        if not re.match(r"^({})$".format(hubkey.PARTS_S0["id_type"]), row["source_id_type"]):
+            e = 'skipping record %s - invalid id type "%s"' % (row["entity_id"], row["source_id_type"])
+            errors.append(e)
+            logging.warning("Error processing new record: %s" % (e,))
+            continue
+
+        if not re.match(r"^({})$".format(hubkey.PARTS_S0["entity_id"]), row["source_id"]):
+            e = 'skipping record %s - invalid id type "%s"' % (row["entity_id"], row["source_id"])
+            errors.append(e)
+            logging.warning("Error processing new record: %s" % (e,))
+            continue
+
+        accepted.append(row)
+
+    return accepted, errors
+
+
+def make_rows(count):
+    """Rows similar to a page of identifiers, 1% of them invalid"""
+    rows = []
+    for i in range(count):
+        rows.append({
+            'entity_id': uuid.uuid4().hex,
+            'source_id_type': 'testco' if i % 100 else 'test co/?',
+            'source_id': 'asset-%d' % i
+        })
+
+    return rows
+
+
+@click.command()
+@click.option('--rows', default=10000, help='Number of rows validated')
+@click.option('--repeat', default=5, help='Number of runs, the best is reported')
+def cli(rows, repeat):
+    logging.disable(logging.WARNING)
+    data = make_rows(rows)
+
+    for name, func in [('per row', validate_per_row),
+                       ('validate_identifiers', validate_identifiers)]:
+        best = min(timeit.repeat(lambda: func(data), number=1, repeat=repeat))
+        click.echo('{:<22}{:>12,.0f} rows/s'.format(name, rows / best))
+
+
+if __name__ == '__main__':
+    cli()
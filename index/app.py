@@ -17,7 +17,7 @@
 #
 
 """Configures and starts up the Index Service."""
-from multiprocessing import Process, Queue, Manager
+from multiprocessing import Process
 import os.path
 import tornado.ioloop
 import tornado.httpserver
@@ -25,8 +25,10 @@ from tornado.options import options
 import koi
 from . import __version__, repositories
 from .controllers import (root_handler, repositories_handler,
-                          notification_handler)
+                          notification_handler, stats_handler)
 from .models.db import DbInterface
+from .models.repository_states import RepositoryStates
+from .models.repository_status import RepositoryStatus
 
 # directory containing the config files
 CONF_DIR = os.path.join(os.path.dirname(__file__), '../config')
@@ -39,25 +41,35 @@ APPLICATION_URLS = [
      repositories_handler.RepositoriesHandler),
     (r"/entity-types/{entity_type}/repositories",
      repositories_handler.BulkRepositoriesHandler),
+    (r"/entity-types/{entity_type}/repositories/{repository_id}/deletions",
+     repositories_handler.BulkRepositoryHandler),
 ]
 
 
 def start_background_process(db):
-    """Start background process to get data from repositories"""
-    repos = Manager().dict()
+    """
+    Start background process to get data from repositories
+
+    :returns: the Notification used to send notifications to the process
+    """
+    repos = RepositoryStates(options.local_db)
+    status = RepositoryStatus(options.repository_status_size)
 
-    queue = Queue(maxsize=options.notifications_queue_max_size)
-    notification = repositories.Notification(queue)
+    notification = repositories.Notification()
 
-    Process(target=repositories.main, args=(db, repos, notification)).start()
+    Process(target=repositories.main, args=(db, notification, status)).start()
 
     APPLICATION_URLS.extend([
         (r"/notifications",
-         notification_handler.NotificationHandler, {'notification_q': queue}),
+         notification_handler.NotificationHandler, {'notification': notification}),
         (r"/repositories/{repository_id}/indexed",
-         repositories_handler.RepositoryIndexedHandler, {'repositories': repos}),
+         repositories_handler.RepositoryIndexedHandler, {'status': status, 'repositories': repos}),
+        (r"/circuit-breakers",
+         repositories_handler.CircuitBreakersHandler, {'repositories': repos}),
     ])
 
+    return notification
+
 
 def main():
     """
@@ -85,8 +97,12 @@ def main():
         options.index_db_path,
         options.index_schema)
 
+    notification = None
     if options.poll_repositories:
-        start_background_process(db)
+        notification = start_background_process(db)
+
+    APPLICATION_URLS.append(
+        (r"/stats", stats_handler.StatsHandler, {'notification': notification}))
 
     app = koi.make_application(
         __version__,
@@ -16,18 +16,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import logging
-import Queue
-
 from tornado.gen import coroutine
+from koi import exceptions
 from koi.base import BaseHandler
 
 
 class NotificationHandler(BaseHandler):
     """Handle notifications of new data from repositories"""
 
-    def initialize(self, notification_q, **kwargs):
-        self.notification_q = notification_q
+    def initialize(self, notification, **kwargs):
+        self.notification = notification
 
     @coroutine
     def post(self):
@@ -36,10 +34,8 @@ class NotificationHandler(BaseHandler):
         # request. The request has been authenticated so this seems
         # reasonable for now.
         try:
-            self.notification_q.put_nowait(repo_id)
-        except Queue.Full:
-            logging.warning('Notification from repository service {} dropped '
-                            'because the queue is full'.format(repo_id))
-            pass
+            self.notification.put_nowait(repo_id)
+        except ValueError as exc:
+            raise exceptions.HTTPError(400, str(exc))
 
         self.finish({'status': 200})
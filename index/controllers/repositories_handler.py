@@ -19,12 +19,17 @@
 """API Repositories handler.
 Return information about the repositories that an entity can be found in
 """
+from datetime import datetime
+
 from tornado.gen import coroutine
 from tornado.options import options, define
 
 from koi.base import BaseHandler
 from koi import exceptions
 
+from ..models.db import QUERY_PLANS
+from ..models.repository_status import RecordBusyError
+
 from urllib import quote_plus
 
 import logging
@@ -61,11 +66,15 @@ class RepositoriesHandler(BaseHandler):  # pragma: no cover
             related_depth = 0
         related_depth = max(0, min(options.max_related_depth, related_depth))
 
+        query_plan = self.get_argument("query_plan", default=options.bulk_query_plan)
+        if query_plan not in QUERY_PLANS:
+            raise exceptions.HTTPError(400, 'Unknown query_plan %r' % (query_plan,))
+
         try:
             results = yield self.database.query(
                 [{'source_id_type': quote_plus(source_id_type), 
                     'source_id': quote_plus(source_id)}],
-                related_depth)
+                related_depth, query_plan)
         except exceptions.HTTPError:
             # Raise a 404 because the URL contains an invaild ID that does
             # not exist
@@ -167,9 +176,13 @@ class BulkRepositoriesHandler(BaseHandler):  # pragma: no cover
             related_depth = 0
         related_depth = max(0, min(options.max_related_depth, related_depth))
 
+        query_plan = self.get_argument("query_plan", default=options.bulk_query_plan)
+        if query_plan not in QUERY_PLANS:
+            raise exceptions.HTTPError(400, 'Unknown query_plan %r' % (query_plan,))
+
         # NOTE: currently the query ignores entity type. There is only one
         # so it should be OK...
-        repositories = yield self.database.query(ids, related_depth)
+        repositories = yield self.database.query(ids, related_depth, query_plan)
         result = {
             'status': 200,
             'data': repositories
@@ -177,18 +190,74 @@ class BulkRepositoriesHandler(BaseHandler):  # pragma: no cover
 
         self.finish(result)
 
+
+class BulkRepositoryHandler(BaseHandler):  # pragma: no cover
+    """Delete support for UPSERTs of multiple assets
+
+    This endpoint supports deleting many entities from the index in one request
+    """
+
+    # the same access as deleting a single entity
+    METHOD_ACCESS = {
+        "POST": BaseHandler.WRITE_ACCESS
+    }
+
+    def initialize(self, database):
+        self.database = database
+
+    @coroutine
+    def post(self, entity_type, repository_id):
+        """
+        Delete the entities matching each of the requested lists of ids from
+        a repository
+
+        The request body should be an array of arrays of objects with
+        source_id & source_id_type, e.g.:
+            [[{"source_id": 1, "source_id_type": "a_registered_id_type"}],
+             [{"source_id": 2, "source_id_type": "a_registered_id_type"},
+              {"source_id": 3, "source_id_type": "another_id_type"}]]
+
+        :param entity_type: the type of the entities to delete
+        :param repository_id: the id of the repository to delete the entities from
+        :return: JSON array containing the status of each deletion, in the
+        order of the request
+        """
+        items = self.get_json_body()
+        if not isinstance(items, list):
+            raise exceptions.HTTPError(400, 'Expected an array of arrays of ids')
+
+        results = yield self.database.delete_many(entity_type, items, repository_id)
+        result = {
+            'status': 200,
+            'data': results
+        }
+
+        self.finish(result)
+
+
 class RepositoryIndexedHandler(BaseHandler):
-    """Return timestamp of last indexed time for repository"""
-    def initialize(self, repositories, **kwargs):
+    """
+    Return timestamp of last indexed time for repository
+
+    The time is read from the status table shared with the crawler, the
+    local database of the repositories is only read if the table is
+    incomplete.
+    """
+    def initialize(self, status, repositories, **kwargs):
+        self.status = status
         self.repositories = repositories
 
     @coroutine
     def get(self, repository_id):
-        repository = self.repositories.get(repository_id)
-        if not repository:
-            raise exceptions.HTTPError(404, 'Not found')
+        try:
+            last_indexed = self.status.get(repository_id)
+        except RecordBusyError:
+            last_indexed = self._get_stored(repository_id)
+        except KeyError:
+            if self.status.complete:
+                raise exceptions.HTTPError(404, 'Not found')
+            last_indexed = self._get_stored(repository_id)
 
-        last_indexed = repository.get('last')
         if last_indexed:
             last_indexed = last_indexed.isoformat()
 
@@ -196,3 +265,29 @@ class RepositoryIndexedHandler(BaseHandler):
             'status': 200,
             'last_indexed': last_indexed
         })
+
+    def _get_stored(self, repository_id):
+        """Get the last indexed time from the local database"""
+        repository = self.repositories.get(repository_id)
+        if not repository:
+            raise exceptions.HTTPError(404, 'Not found')
+
+        return repository.get('last')
+
+
+class CircuitBreakersHandler(BaseHandler):
+    """Return the state of the circuit breakers of the repository services"""
+    def initialize(self, repositories, **kwargs):
+        self.repositories = repositories
+
+    @coroutine
+    def get(self):
+        breakers = self.repositories.circuit_breakers()
+        for breaker in breakers:
+            if breaker['opened'] is not None:
+                breaker['opened'] = datetime.utcfromtimestamp(breaker['opened']).isoformat()
+
+        self.finish({
+            'status': 200,
+            'data': breakers
+        })
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Statistics of the service, for monitoring"""
+
+from koi.base import BaseHandler
+
+
+class StatsHandler(BaseHandler):
+    """
+    Return the statistics of the process handling the request: the requests
+    to the index database, the lookup cache, and the notifications sent to
+    the crawler (if the repositories are polled)
+    """
+
+    def initialize(self, database, notification=None, **kwargs):
+        self.database = database
+        self.notification = notification
+
+    def get(self):
+        self.finish({
+            'status': 200,
+            'data': {
+                'index_db': self.database.client_stats(),
+                'lookup_cache': self.database.cache.stats(),
+                'notifications': (self.notification.stats()
+                                  if self.notification is not None else None)
+            }
+        })
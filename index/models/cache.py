@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Cache of the results of looking up ids in the index
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .sqlite import Transaction
+
+
+class LookupCache(object):
+    """
+    Bounded LRU cache with a TTL, keyed by
+    (source_id_type, source_id, related_depth)
+
+    Values are the results of looking up an id in the index (None if the id
+    is not in the index) and are shared, so they must not be modified.
+    Entries can be invalidated by id or by repository.
+    """
+
+    def __init__(self, size, ttl, timer=time.time):
+        """
+        :param size: maximum number of entries, 0 disables the cache
+        :param ttl: seconds before an entry expires
+        :param timer: function returning the current time
+        """
+        self.size = size
+        self.ttl = ttl
+        self._time = timer
+        self._entries = OrderedDict()
+        self._by_id = {}
+        self._by_repository = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        :param key: (source_id_type, source_id, related_depth)
+        :returns: the cached value
+        :raises KeyError: if the key is not in the cache or has expired
+        """
+        try:
+            expires, value, repositories = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+
+        if expires <= self._time():
+            self._unindex(key, repositories)
+            self.misses += 1
+            raise KeyError(key)
+
+        # re-insert as the most recently used entry
+        self._entries[key] = (expires, value, repositories)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Cache a value
+
+        :param key: (source_id_type, source_id, related_depth)
+        :param value: the result of the lookup, or None if not found
+        """
+        if self.size <= 0:
+            return
+
+        self.remove(key)
+        repositories = self._repositories(value)
+        self._entries[key] = (self._time() + self.ttl, value, repositories)
+        self._by_id.setdefault(key[:2], set()).add(key)
+        for repository_id in repositories:
+            self._by_repository.setdefault(repository_id, set()).add(key)
+
+        while len(self._entries) > self.size:
+            oldest, (_, _, old_repositories) = self._entries.popitem(last=False)
+            self._unindex(oldest, old_repositories)
+            self.evictions += 1
+
+    def set_many(self, items):
+        """
+        Cache several values
+
+        :param items: an iterable of (key, value), see set
+        """
+        for key, value in items:
+            self.set(key, value)
+
+    def remove(self, key):
+        """Remove an entry (if cached)"""
+        try:
+            _, _, repositories = self._entries.pop(key)
+        except KeyError:
+            return False
+
+        self._unindex(key, repositories)
+        return True
+
+    def invalidate_ids(self, ids):
+        """
+        Remove the entries for ids, whatever the related_depth
+
+        :param ids: an iterable of (source_id_type, source_id)
+        """
+        for id_key in ids:
+            for key in list(self._by_id.get(id_key, ())):
+                self.invalidations += self.remove(key)
+
+    def invalidate_repository(self, repository_id):
+        """
+        Remove the entries referring to a repository
+
+        :param repository_id: the repository ID
+        """
+        for key in list(self._by_repository.get(repository_id, ())):
+            self.invalidations += self.remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_id.clear()
+        self._by_repository.clear()
+
+    def stats(self):
+        """
+        :returns: a dictionary with the number of entries, hits, misses,
+            evictions and invalidations
+        """
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def _unindex(self, key, repositories):
+        keys = self._by_id.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_id[key[:2]]
+
+        for repository_id in repositories:
+            keys = self._by_repository.get(repository_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_repository[repository_id]
+
+    @staticmethod
+    def _repositories(value):
+        """Returns the repositories referred to by a lookup result"""
+        if not value:
+            return frozenset()
+
+        repositories = set(x.get('repository_id') for x in value.get('repositories', []))
+        repositories.update(x.get('to', {}).get('repository_id') for x in value.get('relations', []))
+        repositories.discard(None)
+
+        return frozenset(repositories)
+
+
+class SharedLookupCache(object):
+    """
+    Cache of id lookups shared by several processes, stored in a local SQLite
+    database
+
+    It has the same interface as LookupCache, so that the forked web workers
+    can share the lookups (and the crawler process can invalidate them after
+    ingesting data). When the cache is full the entries expiring first are
+    evicted, so that reading the cache never writes to the database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS lookups (
+            key TEXT PRIMARY KEY,
+            id_key TEXT NOT NULL,
+            value TEXT,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS lookups_id_key ON lookups (id_key);
+        CREATE INDEX IF NOT EXISTS lookups_expires ON lookups (expires);
+        CREATE TABLE IF NOT EXISTS lookup_repositories (
+            key TEXT NOT NULL,
+            repository_id TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS lookup_repositories_key
+            ON lookup_repositories (key);
+        CREATE INDEX IF NOT EXISTS lookup_repositories_repository_id
+            ON lookup_repositories (repository_id);
+    """
+
+    # number of entries added between checks of the size of the cache
+    EVICTION_INTERVAL = 100
+    # seconds waited for a lock held by another process, lookups are cached
+    # by the web workers while handling requests so they are skipped instead
+    # of stalling the IOLoop
+    TIMEOUT = 0.05
+    # seconds waited for a lock by invalidations, which must not be skipped
+    INVALIDATION_TIMEOUT = 5
+
+    def __init__(self, path, size, ttl, timer=time.time):
+        """
+        :param path: path to the SQLite database
+        :param size: maximum number of entries, 0 disables the cache
+        :param ttl: seconds before an entry expires
+        :param timer: function returning the current time
+        """
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self._time = timer
+        self._connection = None
+        self._pid = None
+        self._added = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def connection(self):
+        """
+        The connection to the database, opened lazily by each process because
+        connections must not be shared across a fork
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=self.TIMEOUT,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(self.SCHEMA)
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+
+    def __contains__(self, key):
+        row = self.connection.execute('SELECT 1 FROM lookups WHERE key = ?',
+                                      (self._key(key),)).fetchone()
+        return row is not None
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        :param key: (source_id_type, source_id, related_depth)
+        :returns: the cached value
+        :raises KeyError: if the key is not in the cache or has expired
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT value FROM lookups WHERE key = ? AND expires > ?',
+                (self._key(key), self._time())).fetchone()
+        except sqlite3.Error:
+            logging.exception('Error reading the lookup cache')
+            row = None
+
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Cache a value
+
+        :param key: (source_id_type, source_id, related_depth)
+        :param value: the result of the lookup, or None if not found
+        """
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        """
+        Cache several values in a single transaction
+
+        :param items: an iterable of (key, value), see set
+        """
+        if self.size <= 0:
+            return
+
+        items = list(items)
+        if not items:
+            return
+
+        expires = self._time() + self.ttl
+        try:
+            with self._transaction() as connection:
+                for key, value in items:
+                    db_key = self._key(key)
+                    self._remove(connection, [db_key])
+                    connection.execute(
+                        'INSERT INTO lookups (key, id_key, value, expires) VALUES (?, ?, ?, ?)',
+                        (db_key, self._key(key[:2]), json.dumps(value), expires))
+                    connection.executemany(
+                        'INSERT INTO lookup_repositories (key, repository_id) VALUES (?, ?)',
+                        [(db_key, repository_id)
+                         for repository_id in LookupCache._repositories(value)])
+
+            previous = self._added
+            self._added += len(items)
+            if previous // self.EVICTION_INTERVAL != self._added // self.EVICTION_INTERVAL:
+                self._evict()
+        except sqlite3.OperationalError as exc:
+            logging.warning('Lookups not cached: {}'.format(exc))
+        except sqlite3.Error:
+            logging.exception('Error writing to the lookup cache')
+
+    def remove(self, key):
+        """Remove an entry (if cached)"""
+        try:
+            with self._transaction() as connection:
+                return self._remove(connection, [self._key(key)]) > 0
+        except sqlite3.Error:
+            logging.exception('Error removing from the lookup cache')
+            return False
+
+    def invalidate_ids(self, ids):
+        """
+        Remove the entries for ids, whatever the related_depth
+
+        :param ids: an iterable of (source_id_type, source_id)
+        """
+        id_keys = [self._key(x) for x in set(ids)]
+        if not id_keys:
+            return
+
+        try:
+            with self._transaction(self.INVALIDATION_TIMEOUT) as connection:
+                for id_key in id_keys:
+                    keys = [row[0] for row in connection.execute(
+                        'SELECT key FROM lookups WHERE id_key = ?', (id_key,))]
+                    self.invalidations += self._remove(connection, keys)
+        except sqlite3.Error:
+            logging.exception('Error invalidating the lookup cache')
+
+    def invalidate_repository(self, repository_id):
+        """
+        Remove the entries referring to a repository
+
+        :param repository_id: the repository ID
+        """
+        try:
+            with self._transaction(self.INVALIDATION_TIMEOUT) as connection:
+                keys = [row[0] for row in connection.execute(
+                    'SELECT key FROM lookup_repositories WHERE repository_id = ?',
+                    (repository_id,))]
+                self.invalidations += self._remove(connection, keys)
+        except sqlite3.Error:
+            logging.exception('Error invalidating the lookup cache')
+
+    def clear(self):
+        try:
+            with self._transaction(self.INVALIDATION_TIMEOUT) as connection:
+                connection.execute('DELETE FROM lookups')
+                connection.execute('DELETE FROM lookup_repositories')
+        except sqlite3.Error:
+            logging.exception('Error clearing the lookup cache')
+
+    def stats(self):
+        """
+        :returns: a dictionary with the number of entries, and the hits,
+            misses, evictions and invalidations of this process
+        """
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def _evict(self):
+        """Remove expired entries, then the entries expiring first if full"""
+        with self._transaction() as connection:
+            keys = [row[0] for row in connection.execute(
+                'SELECT key FROM lookups WHERE expires <= ?', (self._time(),))]
+            count = connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+            excess = count - len(keys) - self.size
+            if excess > 0:
+                keys.extend(row[0] for row in connection.execute(
+                    'SELECT key FROM lookups WHERE expires > ? ORDER BY expires LIMIT ?',
+                    (self._time(), excess)))
+            self.evictions += self._remove(connection, keys)
+
+    @contextmanager
+    def _transaction(self, timeout=None):
+        """
+        Run statements in a single transaction
+
+        :param timeout: (optional) seconds waited for a lock instead of TIMEOUT
+        """
+        connection = self.connection
+        if timeout is None:
+            with Transaction(connection):
+                yield connection
+            return
+
+        connection.execute('PRAGMA busy_timeout = {:d}'.format(int(timeout * 1000)))
+        try:
+            with Transaction(connection):
+                yield connection
+        finally:
+            connection.execute('PRAGMA busy_timeout = {:d}'.format(int(self.TIMEOUT * 1000)))
+
+    @staticmethod
+    def _remove(connection, keys):
+        """Remove entries, returns the number of entries removed"""
+        removed = 0
+        for key in keys:
+            removed += connection.execute('DELETE FROM lookups WHERE key = ?', (key,)).rowcount
+            connection.execute('DELETE FROM lookup_repositories WHERE key = ?', (key,))
+
+        return removed
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(list(key))
+
+
+def make_lookup_cache(size, ttl, path=None):
+    """
+    Create the cache of id lookups
+
+    :param size: maximum number of entries, 0 disables the cache
+    :param ttl: seconds before an entry expires
+    :param path: (optional) path to a database shared by all processes, if
+        not provided each process has its own cache
+    :returns: a LookupCache or a SharedLookupCache
+    """
+    if path:
+        return SharedLookupCache(path, size, ttl)
+
+    return LookupCache(size, ttl)
@@ -17,20 +17,94 @@
 #
 
 from __future__ import unicode_literals
-import re
 import csv
 import urllib
 import logging
 import json
 import string
+from datetime import timedelta
+from functools import partial
+from io import BytesIO
 
 from bass import hubkey
 from koi import exceptions
-from tornado.httpclient import AsyncHTTPClient, HTTPError
-from tornado import gen, options
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPResponse
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.options import define, options
+from tornado import gen, locks
+
+from .cache import make_lookup_cache
+from .fingerprints import IngestFingerprints
+from .validators import validate_identifiers
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    # pycurl is not installed, fall back on the simple http client
+    CurlAsyncHTTPClient = None
+
+define('index_db_max_clients', default=20,
+       help='Maximum number of concurrent requests to the index database, '
+            'other requests are queued')
+define('index_db_use_curl', default=True,
+       help='Use the curl http client (with keep-alive) to connect to the '
+            'index database, the simple http client is used if false or if '
+            'pycurl cannot be imported')
+define('index_db_connect_timeout', default=5,
+       help='Timeout in seconds to connect to the index database')
+define('index_db_query_timeout', default=30,
+       help='Timeout in seconds for a query to the index database, '
+            'including time spent waiting in the queue')
+define('index_db_update_timeout', default=120,
+       help='Timeout in seconds for an update or a store to the index '
+            'database, including time spent waiting in the queue')
+define('bulk_query_chunk_size', default=50,
+       help='Maximum number of ids looked up by a single query to the index '
+            'database, larger requests are split into chunks')
+define('bulk_query_concurrency', default=4,
+       help='Maximum number of chunks of a bulk request queried concurrently')
+define('bulk_query_plan', default=b'union',
+       type=str,
+       help='Default plan used to query the index for ids, "union" (a '
+            'subquery for each id) or "values" (a single join of all the ids)')
+
+define('store_chunk_size', default=65536,
+       help='Size in bytes of the chunks of data streamed to the index '
+            'database when storing entities')
+define('bulk_delete_chunk_size', default=100,
+       help='Maximum number of entities deleted by a single update to the '
+            'index database, larger bulk deletes are split into chunks')
+
+define('ingest_fingerprints_path', default=b'',
+       type=str,
+       help='Path to a local database of fingerprints of the identifiers '
+            'ingested from each repository, used to skip identifiers already '
+            'in the index. If empty every identifier is stored')
+define('ingest_fingerprints_max', default=1000000,
+       help='Maximum number of fingerprints kept for each repository')
+define('ingest_fingerprints_ttl', default=604800,
+       help='Seconds before a fingerprint expires and the identifier is '
+            'stored again, 0 if never')
+
+define('lookup_cache_size', default=10000,
+       help='Maximum number of id lookups cached, 0 disables the cache')
+define('lookup_cache_ttl', default=60,
+       help='Seconds before a cached id lookup expires')
+define('lookup_cache_path', default=b'lookup_cache.db',
+       type=str,
+       help='Path to a local database used to share the cache of id lookups '
+            'between processes, if empty each process has its own cache, '
+            'which is not invalidated by the data ingested by the crawler '
+            'process so entries are only refreshed when they expire')
 
 HUB_KEY = "hub_key"
 
+# Plans available to query the index for a set of ids
+UNION_PLAN = "union"
+VALUES_PLAN = "values"
+QUERY_PLANS = (UNION_PLAN, VALUES_PLAN)
+
 DEFAULT_PAGER_LIMIT = getattr(options, "default_pager_limit", 1024)
 
 NS = {
@@ -51,19 +125,19 @@ NAMESPACE_ASSET = """
 </properties>
 """
 
-# %s is the initial query that build entity_uri
+# $initial_query is the initial query that build entity_uri
 # the starting point of the query
-LEVEL_1_REL_SUBQUERY = """
+LEVEL_1_REL_SUBQUERY = string.Template("""
 {
-    SELECT ?via_hk ?via_id ?to_hk WHERE {
-        %s .
+    SELECT $projection WHERE {
+        $initial_query .
         BIND (?entity_uri AS ?via_hk) .
         ?via_hk op:alsoIdentifiedBy ?via_id.
         ?via_id ^op:alsoIdentifiedBy? ?to_hk .
         FILTER (?to_hk != ?via_hk) .
     }
 }
-"""
+""")
 
 LEVEL_N_REL_SUBQUERY = string.Template("""
 $from_hk op:alsoIdentifiedBy $via_id .
@@ -83,14 +157,38 @@ OUTER_REL_SUBQUERY = string.Template("""
        OPTIONAL { ?to_hk chubindex:repo ?to_repo . }
     }
 }
-BIND (CONCAT("{\\"to\\": {\\"entity_id\\": \\"", STRAFTER(STR(?to_hk),STR(id:)) , "\\", \\"repository_id\\": \\"", ?to_repo,
-             "\\" }, \\"via\\": {\\"source_id\\" : \\"", ?via_id_id_value, "\\", \\"source_id_type\\": \\"", ?via_id_id_type,
-             "\\", \\"entity_id\\" : \\"", STRAFTER(STR(?via_hk),STR(id:)), "\\" } }" ) AS ?json)
+$relation_json
 }
 GROUP BY ?group
 }
 """)
 
+# Alternative plan for bulk queries: the ids are joined using VALUES blocks
+# (see VALUES_INITIAL_QUERY) and the results are grouped by id, so that the
+# size of the query doesn't depend on the number of ids
+VALUES_OUTER_REL_SUBQUERY = string.Template("""
+{
+    SELECT ?source_id ?source_id_type (CONCAT("[", GROUP_CONCAT(?json;separator=","),"]") AS ?relations ) WHERE {
+        { SELECT DISTINCT ?source_id ?source_id_type ?to_hk ?to_repo ?via_id ?via_id_id_value ?via_id_id_type ?via_hk WHERE {
+           $relquery
+
+           OPTIONAL { ?via_id chubindex:id ?via_id_id_value . }
+           OPTIONAL { ?via_id chubindex:id_type ?via_id_id_type . }
+           OPTIONAL { ?to_hk chubindex:repo ?to_repo . }
+        }
+    }
+    $relation_json
+    }
+    GROUP BY ?source_id ?source_id_type
+}
+""")
+
+RELATION_JSON = """
+BIND (CONCAT("{\\"to\\": {\\"entity_id\\": \\"", STRAFTER(STR(?to_hk),STR(id:)) , "\\", \\"repository_id\\": \\"", ?to_repo,
+             "\\" }, \\"via\\": {\\"source_id\\" : \\"", ?via_id_id_value, "\\", \\"source_id_type\\": \\"", ?via_id_id_type,
+             "\\", \\"entity_id\\" : \\"", STRAFTER(STR(?via_hk),STR(id:)), "\\" } }" ) AS ?json)
+"""
+
 # This is the main query for querying an entry (a single part source_id, source_id_type) in the index
 #
 # Fist part of the query retrieve repositories directly associated with the id.
@@ -103,7 +201,7 @@ QUERY_TEMPLATE = string.Template("""
            BIND ( "constant" as ?group ) .
            $initial_query .
            ?entity_uri chubindex:repo ?repo_id .
-           BIND (CONCAT("{\\"repository_id\\":\\"",?repo_id,"\\",\\"entity_id\\":\\"",STRAFTER(STR(?entity_uri),STR(id:)),"\\"}") AS ?json).
+           $repository_json
         } GROUP BY ?group
     }
 
@@ -114,6 +212,47 @@ QUERY_TEMPLATE = string.Template("""
 }
 """)
 
+REPOSITORY_JSON = """
+BIND (CONCAT("{\\"repository_id\\":\\"",?repo_id,"\\",\\"entity_id\\":\\"",STRAFTER(STR(?entity_uri),STR(id:)),"\\"}") AS ?json).
+"""
+
+# The main query for the "values" plan, $initial_query binds ?source_id,
+# ?source_id_type and ?entity_uri for all the ids of the request
+VALUES_QUERY_TEMPLATE = string.Template("""
+SELECT ?source_id ?source_id_type ?repositories ?relations
+WHERE {
+    {
+        SELECT ?source_id ?source_id_type (CONCAT("[", GROUP_CONCAT(?json; separator=","),"]") AS ?repositories ) {
+           $initial_query .
+           ?entity_uri chubindex:repo ?repo_id .
+           $repository_json
+        } GROUP BY ?source_id ?source_id_type
+    }
+
+    $relquery
+}
+ORDER BY ?source_id ?source_id_type
+""")
+
+VALUES_INITIAL_QUERY = string.Template("""
+{
+    VALUES (?source_id_type ?source_id ?xid) {
+        $values
+    }
+    ?xid ^op:alsoIdentifiedBy ?entity_uri
+}
+""")
+
+VALUES_HUB_KEY_INITIAL_QUERY = string.Template("""
+{
+    VALUES ?entity_uri {
+        $values
+    }
+    BIND ( ?entity_uri AS ?source_id ) .
+    BIND ( "$hub_key" AS ?source_id_type ) .
+}
+""")
+
 FIND_ENTITY_TEMPLATE = string.Template("""
 SELECT DISTINCT ?s
 WHERE {?s ?p ?o;
@@ -131,20 +270,32 @@ SOURCE_ID_FILTER_TEMPLATE = string.Template("""
 ("$id"^^xsd:string "$id_type"^^xsd:string)
 """)
 
-FIND_ENTITY_SOURCE_IDS_TEMPLATE = string.Template("""
-SELECT DISTINCT ?id ?idtype
-WHERE {<$entity_id> ?p ?o.
-?o  	<http://digicat.io/ns/chubindex/1.0/id>  ?id;
-<http://digicat.io/ns/chubindex/1.0/id_type> ?idtype.}
+# Find the entities matching the ids (see FIND_ENTITY_TEMPLATE) and all the
+# source ids of each of them
+FIND_ENTITIES_SOURCE_IDS_TEMPLATE = string.Template("""
+SELECT DISTINCT ?s ?id ?idtype
+WHERE {
+    {
+        $find_entities
+    }
+    ?s ?p ?o.
+    ?o  <http://digicat.io/ns/chubindex/1.0/id> ?id;
+        <http://digicat.io/ns/chubindex/1.0/id_type> ?idtype.
+}
 """)
 
-FIND_ENTITY_COUNT_BY_SOURCE_IDS_TEMPLATE = string.Template("""
-SELECT (COUNT(?s) AS ?count)
-WHERE {?s ?p ?o.
-		?o 
-           <http://digicat.io/ns/chubindex/1.0/id> "$source_id"^^xsd:string;
-			<http://digicat.io/ns/chubindex/1.0/id_type> "$source_id_type"^^xsd:string
-                 }
+# Count the number of references to each source id
+COUNT_ENTITIES_BY_SOURCE_IDS_TEMPLATE = string.Template("""
+SELECT ?id ?idtype (COUNT(?s) AS ?count)
+WHERE {
+    VALUES (?id ?idtype) {
+        $id_filter
+    }
+    ?s ?p ?o.
+    ?o  <http://digicat.io/ns/chubindex/1.0/id> ?id;
+        <http://digicat.io/ns/chubindex/1.0/id_type> ?idtype.
+}
+GROUP BY ?id ?idtype
 """)
 
 DELETE_ID_TRIPLES_TEMPLATE = string.Template("""
@@ -161,6 +312,68 @@ WHERE {
 <$entity_id> ?p ?o}
 """)
 
+
+class CSVResultParser(object):
+    """
+    Incrementally parse a text/csv SPARQL result set
+
+    The body of the response can be fed in arbitrary chunks (e.g. from a
+    tornado streaming_callback). Each complete row is passed to row_callback
+    as a dictionary keyed by the header row, so that the whole result set is
+    never held in memory.
+    """
+
+    def __init__(self, row_callback):
+        self.row_callback = row_callback
+        self.fieldnames = None
+        self.rows = 0
+        self._tail = b''
+        self._lines = []
+        self._quotes = 0
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of the response body
+
+        :param chunk: a byte string
+        """
+        lines = (self._tail + chunk).split(b'\n')
+        self._tail = lines.pop()
+        complete = []
+
+        for line in lines:
+            self._lines.append(line)
+            self._quotes += line.count(b'"')
+            # an odd number of quotes means the new line is part of a
+            # quoted value
+            if not self._quotes % 2:
+                complete.extend(self._lines)
+                self._lines, self._quotes = [], 0
+
+        if complete:
+            self._parse(complete)
+
+    def close(self):
+        """Parse any remaining data (the last row may not end with a new line)"""
+        if self._tail:
+            self._lines.append(self._tail)
+            self._tail = b''
+        if self._lines:
+            self._parse(self._lines)
+            self._lines, self._quotes = [], 0
+
+    def _parse(self, lines):
+        for row in csv.reader(line + b'\n' for line in lines):
+            if not row:
+                continue
+            if self.fieldnames is None:
+                self.fieldnames = row
+                continue
+
+            self.rows += 1
+            self.row_callback(dict(zip(self.fieldnames, row)))
+
+
 class DbInterface(object):
     def __init__(self, base_path, port, path, schema):
         """
@@ -172,19 +385,140 @@ class DbInterface(object):
         self.db_url = "{0}:{1}{2}{3}".format(base_path, port, path, schema)
         self.db_namespace = self.db_url.split('/')[-1]
         self.db_namespace_url = '/'.join(self.db_url.split('/')[:-1])
+        self._client = None
+        self._stream_client = None
+        # bounds the number of concurrent requests, see _fetch
+        self._slots = locks.Semaphore(options.index_db_max_clients)
+        self._active = 0
+        self._queued = 0
+        self.cache = make_lookup_cache(options.lookup_cache_size,
+                                       options.lookup_cache_ttl,
+                                       options.lookup_cache_path)
+        self.fingerprints = None
+        if options.ingest_fingerprints_path:
+            self.fingerprints = IngestFingerprints(options.ingest_fingerprints_path,
+                                                   options.ingest_fingerprints_max,
+                                                   options.ingest_fingerprints_ttl)
+
+    @property
+    def client(self):
+        """
+        The http client used for all requests to the database.
+
+        The client is shared by all requests made from the current IOLoop, so
+        that connections are reused. It is created lazily because the
+        interface is instantiated before the service forks.
+        """
+        io_loop = IOLoop.current()
+        if self._client is None or self._client.io_loop is not io_loop:
+            if options.index_db_use_curl and CurlAsyncHTTPClient:
+                client_class = CurlAsyncHTTPClient
+            else:
+                if options.index_db_use_curl:
+                    logging.warning('pycurl is not available, connections to '
+                                    'the index database are not kept alive')
+                client_class = AsyncHTTPClient
+
+            self._client = client_class(
+                io_loop=io_loop,
+                force_instance=True,
+                max_clients=options.index_db_max_clients,
+                defaults={'connect_timeout': options.index_db_connect_timeout})
+
+        return self._client
+
+    @property
+    def stream_client(self):
+        """
+        The http client used for requests with a streamed body (see store).
+        The curl client does not support streaming request bodies, so a
+        simple http client is used when the shared client is a curl client.
+        """
+        client = self.client
+        if not (CurlAsyncHTTPClient and isinstance(client, CurlAsyncHTTPClient)):
+            return client
+
+        io_loop = IOLoop.current()
+        if self._stream_client is None or self._stream_client.io_loop is not io_loop:
+            self._stream_client = SimpleAsyncHTTPClient(
+                io_loop=io_loop,
+                force_instance=True,
+                max_clients=options.index_db_max_clients,
+                defaults={'connect_timeout': options.index_db_connect_timeout})
+
+        return self._stream_client
+
+    def client_stats(self):
+        """
+        Return the number of active and queued requests to the database
+
+        :returns: a dictionary containing "active", "queued" & "max_clients"
+        """
+        return {'active': self._active, 'queued': self._queued,
+                'max_clients': options.index_db_max_clients}
+
+    @gen.coroutine
+    def _fetch(self, url, request_timeout=None, client=None, **kwargs):
+        """
+        Send a request to the database using the shared client
+
+        At most options.index_db_max_clients requests are sent at once, the
+        others are queued here rather than in the client, because the simple
+        http client times out queued requests after the connect_timeout.
+
+        :param url: the url
+        :param request_timeout: (optional) timeout in seconds for the request,
+            including the time spent waiting in the queue
+        :param client: (optional) the http client, defaults to the shared
+            client
+        :returns: the response
+        :raises: HTTPError 599 if the request timed out
+        """
+        client = client or self.client
+        slots = self._slots
+        start = IOLoop.current().time()
+
+        if self._queued >= options.index_db_max_clients:
+            logging.warning('%d requests to the index database are queued '
+                            '(%d active)' % (self._queued, self._active))
+
+        self._queued += 1
+        try:
+            if request_timeout:
+                yield slots.acquire(timeout=timedelta(seconds=request_timeout))
+            else:
+                yield slots.acquire()
+        except gen.TimeoutError:
+            raise HTTPError(599, 'Timeout while queued')
+        finally:
+            self._queued -= 1
+
+        self._active += 1
+        try:
+            if request_timeout:
+                elapsed = IOLoop.current().time() - start
+                kwargs['request_timeout'] = max(request_timeout - elapsed, 0.001)
+            rsp = yield client.fetch(url, **kwargs)
+        finally:
+            self._active -= 1
+            slots.release()
+
+        raise gen.Return(rsp)
 
     @gen.coroutine
     def create_namespace(self):
         """
         Create the namespace in the database
+
+        The ingest fingerprints are cleared when the namespace is created,
+        because none of the identifiers are in a new namespace.
         """
         data = NAMESPACE_ASSET.format(self.db_namespace).strip()
-        client = AsyncHTTPClient()
         headers = {'Content-Type': 'application/xml'}
 
         try:
-            yield client.fetch(self.db_namespace_url, method='POST',
-                               body=data, headers=headers)
+            yield self._fetch(self.db_namespace_url, method='POST',
+                              body=data, headers=headers)
         except HTTPError as e:
             # Namespace already exists with a 409 error
             if e.code != 409:
@@ -195,6 +529,9 @@ class DbInterface(object):
             msg = ("Database server error({0}) (Is Database server"
                    " running on {1})".format(e.args, self.db_url))
             logging.error(msg)
+        else:
+            if self.fingerprints is not None:
+                self.fingerprints.clear()
 
     def map_to_entity_type(self, entity_type):
         """
@@ -204,7 +541,18 @@ class DbInterface(object):
         return urllib.quote_plus(entity_type)
 
     @gen.coroutine
-    def _run_query(self, query):
+    def _run_query(self, query, row_callback=None):
+        """
+        Run a SPARQL query
+
+        :param query: the query (without prefixes)
+        :param row_callback: (optional) if provided the response is streamed
+            and each row is passed to the callback as soon as it is parsed,
+            instead of returning a list of rows
+        :returns: a list of dictionaries, or the number of rows if streaming
+        :raises: HTTPError if the query failed, with the body of the error
+            response even if streaming
+        """
         if type(query) == unicode:
             query = query.encode('ascii')
 
@@ -212,10 +560,48 @@ class DbInterface(object):
 
 	logging.debug('_run_query : ' + SPARQL_PREFIXES + query)
 
-        rsp = yield AsyncHTTPClient().fetch(
-            self.db_url, method="POST",
-            body=urllib.urlencode({'query': SPARQL_PREFIXES + query}),
-            headers=headers)
+        parser = None
+        kwargs = {}
+        error_body = []
+        if row_callback is not None:
+            parser = CSVResultParser(row_callback)
+            status = {'code': None}
+
+            def header_callback(line):
+                if line.startswith(b'HTTP/'):
+                    status['code'] = int(line.split()[1])
+
+            def streaming_callback(chunk):
+                # only the body of a successful response is a result set
+                if status['code'] is None or 200 <= status['code'] < 300:
+                    parser.feed(chunk)
+                else:
+                    error_body.append(chunk)
+
+            kwargs['header_callback'] = header_callback
+            kwargs['streaming_callback'] = streaming_callback
+
+        try:
+            rsp = yield self._fetch(
+                self.db_url, method="POST",
+                body=urllib.urlencode({'query': SPARQL_PREFIXES + query}),
+                headers=headers,
+                request_timeout=options.index_db_query_timeout,
+                **kwargs)
+        except HTTPError as e:
+            if error_body and e.response is not None:
+                # the streamed body of the error response was not buffered
+                body = b''.join(error_body)
+                logging.error('Query failed with HTTP error {}: {}'.format(
+                    e.code, body[:1000].decode('utf-8', 'replace')))
+                e.response = HTTPResponse(e.response.request, e.code,
+                                          headers=e.response.headers,
+                                          buffer=BytesIO(body))
+            raise
+
+        if parser:
+            parser.close()
+            raise gen.Return(parser.rows)
 
         raise gen.Return(list(csv.DictReader(rsp.buffer)))
 
@@ -226,20 +612,25 @@ class DbInterface(object):
 
         headers = {'Accept': 'text/csv'}
 
-        rsp = yield AsyncHTTPClient().fetch(
+        rsp = yield self._fetch(
             self.db_url, method="POST",
             body=urllib.urlencode({'update': SPARQL_PREFIXES + query}),
-            headers=headers)
+            headers=headers,
+            request_timeout=options.index_db_update_timeout)
 
         raise gen.Return(list(csv.DictReader(rsp.buffer)))
 
-    def _format_relation_subquery(self, source_id_type, source_id, initial_query, maxdepth=2):
-        if not maxdepth:
-            # we didn't asked for relations... so let just return nothing
-            return "BIND (\"[]\" AS ?relations) ."
+    def _format_relation_levels(self, initial_query, maxdepth, projection="?via_hk ?via_id ?to_hk"):
+        """
+        Build the union of the subqueries finding relations from 1 to
+        maxdepth steps away from the entities bound by initial_query
 
+        :param initial_query: the query binding ?entity_uri
+        :param maxdepth: maximum depth when searching for related ids.
+        :param projection: the variables selected by each subquery
+        """
         # LEVEL 1 query
-        mrexpr = [LEVEL_1_REL_SUBQUERY % (initial_query,)]
+        mrexpr = [LEVEL_1_REL_SUBQUERY.substitute(projection=projection, initial_query=initial_query)]
 
         # DEEPER QUERIES (BUILD RECURSIVELY)
         for i in range(1, maxdepth):
@@ -265,11 +656,19 @@ class DbInterface(object):
                 forbidden=forbidden_nodes
             )
             )
-            cexpr = "{ SELECT ?via_hk ?via_id ?to_hk WHERE { \n %s \n } }\n" % ("\n".join(cexpr),)
+            cexpr = "{ SELECT %s WHERE { \n %s \n } }\n" % (projection, "\n".join(cexpr))
             mrexpr.append(cexpr)
 
         # UNION FOR LEVEL FROM 1 TO N
-        return OUTER_REL_SUBQUERY.substitute(relquery="{ %s }" % (" UNION ".join(mrexpr),))
+        return "{ %s }" % (" UNION ".join(mrexpr),)
+
+    def _format_relation_subquery(self, source_id_type, source_id, initial_query, maxdepth=2):
+        if not maxdepth:
+            # we didn't asked for relations... so let just return nothing
+            return "BIND (\"[]\" AS ?relations) ."
+
+        return OUTER_REL_SUBQUERY.substitute(relquery=self._format_relation_levels(initial_query, maxdepth),
+                                             relation_json=RELATION_JSON)
 
     def _format_subquery(self, source_id_type, source_id, maxdepth=2):
         """
@@ -307,171 +706,292 @@ class DbInterface(object):
         query = QUERY_TEMPLATE.substitute(source_id_bind=("id:%s" if (source_id_type == HUB_KEY) else '"%s"') % (source_id,),
                                           source_id_type=source_id_type,
                                           relquery=relquery,
-                                          initial_query=initial_query)
+                                          initial_query=initial_query,
+                                          repository_json=REPOSITORY_JSON)
         return query
 
+    def _format_values_query(self, ids, maxdepth=2):
+        """
+        Get list of repositories and relations for a set of ids with a single
+        query, whose size does not depend on the number of ids
+
+        The ids are joined with the index using a VALUES block (and a second
+        VALUES block for hub keys) instead of a subquery for each id.
+
+        :param ids: a list of dictionaries containing "source_id" &
+                    "source_id_type"
+        :param maxdepth: maximum depth when searching for related ids.
+
+        :returns: the query
+        """
+        values, hub_key_values = [], []
+        for x in ids:
+            source_id_type, source_id = x['source_id_type'], x['source_id']
+            if source_id_type == HUB_KEY:
+                if source_id.startswith("http://openpermissions.org/ns/id/"):
+                    source_id = source_id.split('/')[-1]
+                hub_key_values.append("id:{}".format(str(source_id)))
+            else:
+                values.append('("{source_id_type}" "{source_id}" <https://digicat.io/ns/xid/{source_id_type}/{source_id}>)'
+                              .format(source_id_type=source_id_type, source_id=source_id))
+
+        initial_queries = []
+        if values:
+            initial_queries.append(VALUES_INITIAL_QUERY.substitute(values="\n        ".join(values)))
+        if hub_key_values:
+            initial_queries.append(VALUES_HUB_KEY_INITIAL_QUERY.substitute(values="\n        ".join(hub_key_values),
+                                                                           hub_key=HUB_KEY))
+        initial_query = "{ %s }" % (" UNION ".join(initial_queries),)
+
+        if maxdepth:
+            relquery = VALUES_OUTER_REL_SUBQUERY.substitute(
+                relquery=self._format_relation_levels(initial_query, maxdepth,
+                                                      "?source_id ?source_id_type ?via_hk ?via_id ?to_hk"),
+                relation_json=RELATION_JSON)
+        else:
+            relquery = "BIND (\"[]\" AS ?relations) ."
+
+        return VALUES_QUERY_TEMPLATE.substitute(initial_query=initial_query,
+                                                relquery=relquery,
+                                                repository_json=REPOSITORY_JSON)
+
     @gen.coroutine
-    def _getMatchingEntities(self, ids, repository_id):
+    def _getMatchingEntitiesIdsAndTypes(self, ids, repository_id):
         """
-        Get list of entities matching the given incoming ids 
+        Get the entities matching the given incoming ids and all the source ids
+        of each of them, with a single query
 
         :param ids: a list of dictionaries containing "source_id" & "source_id_type".
         :param repository_id: the repo to search.
 
-        :returns: a list of entity ids
+        :returns: a dictionary of entity ids to lists of source_id and
+                  source_id_types
         """
         subqueries = [SOURCE_ID_FILTER_TEMPLATE.substitute(id = x['source_id'], id_type = x['source_id_type'])
                       for x in ids]
 
-        query = FIND_ENTITY_TEMPLATE.substitute(repository_id = repository_id, id_filter = ''.join(subqueries))
+        find_entities = FIND_ENTITY_TEMPLATE.substitute(repository_id = repository_id, id_filter = ''.join(subqueries))
+        query = FIND_ENTITIES_SOURCE_IDS_TEMPLATE.substitute(find_entities = find_entities)
 
         logging.debug(query)
         queryresults = yield self._run_query(query)
         logging.debug(queryresults)
 
-        results = [x['s'] for x in queryresults]
+        results = {}
+        for x in queryresults:
+            results.setdefault(x['s'], []).append({'source_id_type': x['idtype'], 'source_id': x['id']})
+
         raise gen.Return(results)
 
     @gen.coroutine
-    def _getEntityIdsAndTypes(self, entity_id):
+    def _countEntitiesUsingIds(self, idsAndTypes):
         """
-        Get list of source_ids and source_id_types for a given entity id
+        Count the number of entities using each of these ids/types, with a
+        single query
 
-        :param entity_id: the entity id
+        :param: idsAndTypes: a list of source_id and source_id_types
 
-        :returns: a list of source_id and source_id_types
+        :returns: a dictionary of (source_id_type, source_id) to a count of
+                  entities
         """
-        query = FIND_ENTITY_SOURCE_IDS_TEMPLATE.substitute(entity_id = entity_id)
+        if not idsAndTypes:
+            raise gen.Return({})
+
+        subqueries = [SOURCE_ID_FILTER_TEMPLATE.substitute(id = x['source_id'], id_type = x['source_id_type'])
+                      for x in idsAndTypes]
+        query = COUNT_ENTITIES_BY_SOURCE_IDS_TEMPLATE.substitute(id_filter = ''.join(subqueries))
 
         logging.debug(query)
         queryresults = yield self._run_query(query)
         logging.debug(queryresults)
 
-        results = [{'source_id_type': x['idtype'], 'source_id': x['id']} for x in queryresults]
-
+        results = {(x['idtype'], x['id']): int(x.get('count') or '0') for x in queryresults}
         raise gen.Return(results)
 
     @gen.coroutine
-    def _countMatchesNotIncluding(self, idAndType, entity_id):
+    def _deleteEntitiesAndIds(self, entities, idsAndTypes):
         """
-        Count the number of entities using these ids/types (other than this entity)
+        Delete entity triples and id/type triples with a single update
 
-        :param: idAndType: the source_id and source_id_type to search for
-        :param entity_id: the entity id of the entity to exclude
+        :param: entities: the ids of the entities to delete
+        :param: idsAndTypes: the source_id and source_id_types to delete
 
-        :returns: a count of entities
+        :returns: nothing
         """
-        logging.debug('idandtype ' + str(idAndType))
-        query = FIND_ENTITY_COUNT_BY_SOURCE_IDS_TEMPLATE.substitute(source_id_type = idAndType['source_id_type'],
-                                                                    source_id = idAndType['source_id'],
-                                                                    entity_id = entity_id)
+        operations = [DELETE_ID_TRIPLES_TEMPLATE.substitute(source_id_type = x['source_id_type'],
+                                                            source_id = x['source_id'])
+                      for x in idsAndTypes]
+        operations.extend(DELETE_ENTITY_TRIPLE_TEMPLATE.substitute(entity_id = entity_id)
+                          for entity_id in entities)
+
+        if not operations:
+            raise gen.Return()
+
+        query = ' ;\n'.join(operations)
 
         logging.debug(query)
-        queryresults = yield self._run_query(query)
+        queryresults = yield self._run_update(query)
         logging.debug(queryresults)
 
-        raise gen.Return(queryresults)
+        raise gen.Return()
 
     @gen.coroutine
-    def _deleteIds(self, idAndType):
+    def _planDelete(self, matches):
         """
-        Delete id/type triples
+        Find which ids are no longer used once the matched entities are deleted
 
-        :param: idAndType: the source_id and source_id_type to delete
+        :param matches: a dictionary of entity ids to be deleted to lists of
+                        their source_id and source_id_types
 
-        :returns: nothing
+        :returns: the list of source_id and source_id_types to delete
         """
-        logging.debug('delete idandtype ' + str(idAndType))
-        query = DELETE_ID_TRIPLES_TEMPLATE.substitute(source_id_type = idAndType['source_id_type'],
-                                                                    source_id = idAndType['source_id'])
+        references = {}
+        for idsAndTypes in matches.values():
+            for idAndType in idsAndTypes:
+                key = (idAndType['source_id_type'], idAndType['source_id'])
+                references[key] = references.get(key, 0) + 1
 
-        logging.debug(query)
-        queryresults = yield self._run_update(query)
-        logging.debug(queryresults)
+        counts = yield self._countEntitiesUsingIds(
+            [{'source_id_type': k[0], 'source_id': k[1]} for k in references])
+
+        # if these ids are NOT used for anything else then delete them
+        unused = [{'source_id_type': k[0], 'source_id': k[1]}
+                  for k, n in references.items() if counts.get(k, 0) <= n]
 
-        raise gen.Return()    
+        raise gen.Return(unused)
 
     @gen.coroutine
-    def _deleteEntity(self, entity_id):
+    def _query_ids(self, ids, related_depth=0, query_plan=UNION_PLAN):
         """
-        Delete entity triples
+        Get list of repositories
 
-        :param: entity_id: the id of the entity to delete
+        Results are cached by (source_id_type, source_id, related_depth). The
+        ids that are not cached are split into chunks of
+        options.bulk_query_chunk_size, which are queried concurrently (up to
+        options.bulk_query_concurrency at a time) so that large requests
+        don't generate a single huge query.
 
-        :returns: nothing
+        :param ids: a list of dictionaries containing "id" & "id_type".
+        :param related_depth: maximum depth when searching for related ids.
+        :param query_plan: UNION_PLAN or VALUES_PLAN, see _query_chunk
+
+        :returns: a list of dictionaries containing "id", "id_type" &
+                  "repository", in the same order as the ids
         """
-        logging.debug('delete entity_id ' + str(entity_id))
-        query = DELETE_ENTITY_TRIPLE_TEMPLATE.substitute(entity_id = entity_id)
+        in_results, to_query = {}, []
+        for x in ids:
+            key = (x['source_id_type'], x['source_id'])
+            try:
+                result = self.cache.get(key + (related_depth,))
+            except KeyError:
+                to_query.append(x)
+                continue
+            if result is not None:
+                in_results[key] = result
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # stats may query the shared cache database
+            logging.debug('lookup cache: {}'.format(self.cache.stats()))
+
+        chunk_size = max(1, options.bulk_query_chunk_size)
+        chunks = [to_query[i:i + chunk_size] for i in range(0, len(to_query), chunk_size)]
+        semaphore = locks.Semaphore(max(1, options.bulk_query_concurrency))
+
+        @gen.coroutine
+        def query_chunk(chunk):
+            with (yield semaphore.acquire()):
+                chunk_results = yield self._query_chunk(chunk, related_depth, query_plan)
+
+            # the results of a chunk are cached in a single transaction
+            keys = [(x['source_id_type'], x['source_id']) for x in chunk]
+            self.cache.set_many((key + (related_depth,), chunk_results.get(key))
+                                for key in keys)
+            raise gen.Return(chunk_results)
+
+        all_results = yield [query_chunk(chunk) for chunk in chunks]
+        for chunk_results in all_results:
+            in_results.update(chunk_results)
 
-        logging.debug(query)
-        queryresults = yield self._run_update(query)
-        logging.debug(queryresults)
+        results = []
+        for x in ids:
+            key = (x['source_id_type'], x['source_id'])
+            if key in in_results:
+                if in_results[key] is not None:
+                    results.append(in_results[key])
+                    # only include each result once
+                    in_results[key] = None
+                continue
+
+            # add entries for the elements that have not been found in the index
+            nx = x.copy()
+            nx['source_id_type'] = urllib.unquote_plus(x['source_id_type'])
+            nx['source_id'] = urllib.unquote_plus(x['source_id'])
+            if nx['source_id_type'] == HUB_KEY:
+                nx['source_id'] = str(nx['source_id']).split('/')[-1]
+            nx['repositories'] = []
+            nx['relations'] = []
+            results.append(nx)
 
-        raise gen.Return()    
+        raise gen.Return(results)
 
     @gen.coroutine
-    def _query_ids(self, ids, related_depth=0):
+    def _query_chunk(self, ids, related_depth=0, query_plan=UNION_PLAN):
         """
-        Get list of repositories
+        Get repositories for a chunk of ids with a single query
 
         :param ids: a list of dictionaries containing "id" & "id_type".
         :param related_depth: maximum depth when searching for related ids.
+        :param query_plan: UNION_PLAN (a subquery for each id) or VALUES_PLAN
+            (a single join of all the ids)
 
-        :returns: a list of dictionaries containing "id", "id_type" &
-                  "repository"
+        :returns: a dictionary of the results found in the index, keyed by
+                  (source_id_type, source_id)
         """
-        subqueries = [self._format_subquery(x['source_id_type'], x['source_id'], related_depth)
-                      for x in ids]
+        if query_plan == VALUES_PLAN:
+            query = self._format_values_query(ids, related_depth)
+        else:
+            subqueries = [self._format_subquery(x['source_id_type'], x['source_id'], related_depth)
+                          for x in ids]
 
-        query = """
-            SELECT DISTINCT ?source_id ?source_id_type ?repositories ?relations
-            WHERE {{ {subquery} }}
-            ORDER BY ?source_id ?source_id_type
-        """.format(subquery=' UNION '.join(subqueries))
+            query = """
+                SELECT DISTINCT ?source_id ?source_id_type ?repositories ?relations
+                WHERE {{ {subquery} }}
+                ORDER BY ?source_id ?source_id_type
+            """.format(subquery=' UNION '.join(subqueries))
 
         logging.debug(query)
-        queryresults = yield self._run_query(query)
 
-        results = []
-        in_results = {}
+        results = {}
 
-        # reformat the results that are in the index
-        for x in queryresults:
-            nx = x.copy()
-            if nx['source_id_type'] == HUB_KEY:
-                nx['source_id'] = str(nx['source_id']).split('/')[-1]
-            nx['repositories'] = json.loads(x['repositories'])
-            nx['relations'] = []
-            for r in json.loads(x['relations']):
-                nr = r.copy()
-                nr['via']['source_id_type'] = urllib.unquote_plus(r['via']['source_id_type'])
-                nr['via']['source_id'] = urllib.unquote_plus(r['via']['source_id'])
-                nx['relations'].append(nr)
-            results.append(nx)
-            in_results[(nx['source_id_type'], nx['source_id'])] = 1
+        def add_result(x):
+            # reformat the results that are in the index as they are streamed
+            if x['source_id_type'] == HUB_KEY:
+                x['source_id'] = str(x['source_id']).split('/')[-1]
+            x['repositories'] = json.loads(x['repositories'])
+            x['relations'] = json.loads(x['relations'])
+            for r in x['relations']:
+                r['via']['source_id_type'] = urllib.unquote_plus(r['via']['source_id_type'])
+                r['via']['source_id'] = urllib.unquote_plus(r['via']['source_id'])
+            results[(x['source_id_type'], x['source_id'])] = x
 
-        # add entries for the elements that have not been found in the index
-        for x in ids:
-            if (x['source_id_type'], x['source_id']) not in in_results:
-                nx = x.copy()
-                nx['source_id_type'] = urllib.unquote_plus(x['source_id_type'])
-                nx['source_id'] = urllib.unquote_plus(x['source_id'])
-                if nx['source_id_type'] == HUB_KEY:
-                    nx['source_id'] = str(nx['source_id']).split('/')[-1]
-                nx['repositories'] = []
-                nx['relations'] = []
-                results.append(nx)
+        yield self._run_query(query, row_callback=add_result)
 
         raise gen.Return(results)
 
     @gen.coroutine
-    def query(self, ids, related_depth=0):
+    def query(self, ids, related_depth=0, query_plan=None):
         """
         Get repositories for a set of entities
 
         :param ids: a list of dictionaries containing "id" & "id_type"
         :param related_depth: maximum depth when searching for related ids.
+        :param query_plan: (optional) UNION_PLAN or VALUES_PLAN, defaults to
+            options.bulk_query_plan
         """
+        query_plan = query_plan or options.bulk_query_plan
+        if query_plan not in QUERY_PLANS:
+            raise exceptions.HTTPError(400, 'Unknown query plan {}'.format(query_plan))
+
         validated_ids, errors = [], []
 
         for x in ids:                        # source_id / source_id_type
@@ -498,30 +1018,28 @@ class DbInterface(object):
         if errors:
             raise exceptions.HTTPError(400, errors)
 
-        result = yield self._query_ids(validated_ids, related_depth)
+        result = yield self._query_ids(validated_ids, related_depth, query_plan)
 
         raise gen.Return(result)
 
-    @gen.coroutine
-    def delete(self, entity_type, ids, repository_id):
+    def _validateIds(self, ids):
         """
-        Delete the triples relating to an entity (if they're not used
-        by another entity)
+        Validate ids to delete, converting hub keys to entity ids and quoting
+        other ids
 
-        :param entity_type: the type of the entity
         :param ids: a list of dictionaries containing "id" & "id_type"
-        :param repository_id: the repository from which to delete
+        :returns: a tuple of the list of validated ids and the list of errors
         """
-        
-        entity_type = self.map_to_entity_type(entity_type)
-
         validated_ids, errors = [], []
 
         for x in ids:                        # source_id / source_id_type
+            if not isinstance(x, dict):
+                errors.append(x)
+                continue
             if 'id' in x:
                 x['source_id'] = x['id']
-                x['source_id_type'] = x['id_type']
-            if 'source_id_type' not in x or 'source_id' not in x:
+                x['source_id_type'] = x.get('id_type')
+            if x.get('source_id_type') is None or x.get('source_id') is None:
                 errors.append(x)
             elif x['source_id_type'] == HUB_KEY:
                 try:
@@ -538,45 +1056,140 @@ class DbInterface(object):
                 x['source_id_type'] = urllib.quote_plus(x['source_id_type'])
                 validated_ids.append(x)
 
+        return validated_ids, errors
+
+    @gen.coroutine
+    def delete(self, entity_type, ids, repository_id):
+        """
+        Delete the triples relating to an entity (if they're not used
+        by another entity)
+
+        :param entity_type: the type of the entity
+        :param ids: a list of dictionaries containing "id" & "id_type"
+        :param repository_id: the repository from which to delete
+        """
+        
+        entity_type = self.map_to_entity_type(entity_type)
+
+        validated_ids, errors = self._validateIds(ids)
+
         if errors:
             raise exceptions.HTTPError(400, errors)
 
-        # get all the entities that match the the ids in this repo
-        entities = yield self._getMatchingEntities(validated_ids, repository_id)
-
-        logging.debug('searching for ids ' + str(validated_ids))
-        logging.debug('found entities ' + str(entities))
-
-        # for each entity find all the ids associated with it
-        for entity in entities:
-            idsAndTypes = yield self._getEntityIdsAndTypes(entity)
-            logging.debug('for entity ' + str(entity) + ' got these ids ' + str(idsAndTypes))
-            assetMatch = yield self._checkIdsAndTypesIdentical(validated_ids, idsAndTypes)
-            logging.debug('identical? : ' + str(assetMatch))
-
-            if assetMatch:
-                # loop through each set of ids for this entity
-                for idAndType in idsAndTypes:
-                    # if these ids are NOT used for anything else then delete them
-                    result = yield self._countMatchesNotIncluding(idAndType, entity)
-                    count = int(result[0].get('count', '0'))
-
-                    if count == 1:
-                        yield self._deleteIds(idAndType)
-                
-                # delete the entity itself
-                yield self._deleteEntity(entity)
-            
+        yield self._deleteMatchingEntities([validated_ids], repository_id)
+
         raise gen.Return()
 
     @gen.coroutine
-    def _checkIdsAndTypesIdentical(self, searchIds, assetIds):
-        logging.debug('compariong ' + str(searchIds) + ' : ' + str(assetIds))
-        if not [s for s in searchIds if (s['source_id_type'], s['source_id']) not in {(a['source_id_type'].replace('http://openpermissions.org/ns/hub/', ''), a['source_id']) for a in assetIds}] \
-            and not [a for a in assetIds if (a['source_id_type'].replace('http://openpermissions.org/ns/hub/', ''), a['source_id']) not in {(s['source_id_type'], s['source_id']) for s in searchIds}]:
-            raise gen.Return(True)
-        else:
-            raise gen.Return(False)
+    def delete_many(self, entity_type, items, repository_id):
+        """
+        Delete several entities from a repository, with a few grouped
+        queries and updates for each chunk of bulk_delete_chunk_size items
+
+        :param entity_type: the type of the entity
+        :param items: a list of lists of dictionaries containing "id" &
+            "id_type", each list identifying the entities to delete
+        :param repository_id: the repository from which to delete
+        :returns: a list with the result of each item, a dictionary with the
+            status (200, 400 if the ids are invalid or 500 if the update
+            failed) and the number of entities deleted or the errors
+        """
+        entity_type = self.map_to_entity_type(entity_type)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if not isinstance(item, list) or not item:
+                results[index] = {'status': 400, 'errors': [item]}
+                continue
+
+            validated_ids, errors = self._validateIds(item)
+            if errors:
+                results[index] = {'status': 400, 'errors': errors}
+            else:
+                valid.append((index, validated_ids))
+
+        chunk_size = max(1, options.bulk_delete_chunk_size)
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            try:
+                deleted = yield self._deleteMatchingEntities([x[1] for x in chunk], repository_id)
+            except Exception as e:
+                logging.exception('Error deleting entities from repository {}'.format(repository_id))
+                for index, _ in chunk:
+                    results[index] = {'status': 500, 'errors': [str(e)]}
+            else:
+                for (index, _), count in zip(chunk, deleted):
+                    results[index] = {'status': 200, 'deleted': count}
+
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def _deleteMatchingEntities(self, items, repository_id):
+        """
+        Delete the entities identified by exactly the ids of one of the items,
+        and the ids no longer used by another entity
+
+        :param items: a list of lists of validated ids
+        :param repository_id: the repository from which to delete
+        :returns: the number of entities deleted for each item
+        """
+        all_ids = {self._idAndTypeKey(x): x for item in items for x in item}
+
+        # get all the entities that match the the ids in this repo, and all
+        # the ids associated with each of them
+        candidates = yield self._getMatchingEntitiesIdsAndTypes(all_ids.values(), repository_id)
+
+        logging.debug('searching for ids ' + str(all_ids.values()))
+        logging.debug('found entities ' + str(candidates))
+
+        by_ids = {}
+        for entity, idsAndTypes in candidates.items():
+            key = frozenset(self._idAndTypeKey(x) for x in idsAndTypes)
+            by_ids.setdefault(key, []).append(entity)
+
+        matches, counts = {}, []
+        for item in items:
+            found = by_ids.get(frozenset(self._idAndTypeKey(x) for x in item), [])
+            logging.debug('for ids ' + str(item) + ' matched entities ' + str(found))
+            counts.append(len(found))
+            for entity in found:
+                matches[entity] = candidates[entity]
+
+        entities = list(matches)
+        if matches:
+            unused = yield self._planDelete(matches)
+            yield self._deleteEntitiesAndIds(entities, unused)
+
+            if self.fingerprints:
+                # the deleted identifiers must be stored if ingested again
+                self.fingerprints.remove(repository_id, [
+                    (entity.split('/')[-1],) + self._idAndTypeKey(x)
+                    for entity, idsAndTypes in matches.items() for x in idsAndTypes])
+
+        self.invalidate(repository_id,
+                        list(all_ids) +
+                        [(HUB_KEY, entity.split('/')[-1]) for entity in entities])
+
+        raise gen.Return(counts)
+
+    def invalidate(self, repository_id, ids=()):
+        """
+        Invalidate the cached lookups affected by a change to the index
+
+        :param repository_id: the repository that was changed
+        :param ids: an iterable of (source_id_type, source_id) that were changed
+        """
+        self.cache.invalidate_repository(repository_id)
+        self.cache.invalidate_ids(ids)
+
+    @staticmethod
+    def _idAndTypeKey(idAndType):
+        """
+        :returns: (source_id_type, source_id) without the hub namespace
+        """
+        return (idAndType['source_id_type'].replace('http://openpermissions.org/ns/hub/', ''),
+                idAndType['source_id'])
 
     @gen.coroutine
     def add_entities(self, entity_type, data, repo):
@@ -585,7 +1198,39 @@ class DbInterface(object):
         """
         entity_type = self.map_to_entity_type(entity_type)
 
-        turtle = TURTLE_PREFIXES
+        result = {"errors": [], "records": len(data)}
+        ingested = []
+        logging.info('storing %r records' % (len(data),))
+        # the turtle is generated while it is sent to the database
+        stored = yield self.store(self._format_entities(entity_type, data, repo, result, ingested),
+                                  'text/turtle')
+
+        if stored and self.fingerprints:
+            self.fingerprints.add(repo, ingested)
+
+        changed_ids = []
+        for entity_id, source_id_type, source_id in ingested:
+            changed_ids.append((source_id_type, source_id))
+            changed_ids.append((HUB_KEY, entity_id))
+        self.invalidate(repo, changed_ids)
+
+        raise gen.Return(result)
+
+    def _format_entities(self, entity_type, data, repo, result, ingested):
+        """
+        Generate the turtle for JSON identifiers, in chunks of about
+        options.store_chunk_size bytes
+
+        :param entity_type: the type of the entities
+        :param data: a list of dictionaries containing "entity_id", "source_id"
+            & "source_id_type"
+        :param repo: the repository ID
+        :param result: a dictionary of the "errors" and number of "records",
+            updated as the turtle is generated
+        :param ingested: a list the (entity_id, source_id_type, source_id)
+            stored are appended to
+        """
+        errors = result['errors']
         template = """
         <https://digicat.io/ns/xid/{source_id_type}/{source_id}>
         chubindex:id "{source_id}"^^xsd:string ;
@@ -595,74 +1240,80 @@ class DbInterface(object):
         chubindex:repo "{repository_id}"^^xsd:string ;
         chubindex:type "{entity_type}"^^xsd:string .
         """
-        errors = []
+        chunk = [TURTLE_PREFIXES]
+        size = len(TURTLE_PREFIXES)
         try:
-            for row in data:
-                logging.debug(row)
-                # validate data to avoid "turtle injection
-                # "
-                skip = False
-                for f in ["entity_id", "source_id", "source_id_type"]:
-                    if f not in row:
-                        e = 'missing field entity_id skipping record %r'%(row,)
-                        errors.append(e)
-                        logging.warning("Error processing new record: %s" % (e,))
-                        skip = True
-                        break
-                if skip:
-                    continue
-
-                if not re.match("[0-9a-f]{1,64}", row["entity_id"]):
-                    e = 'skipping record %s - invalid id ' % (row["entity_id"],)
-                    errors.append(e)
-                    logging.info("Error processing new record: %s" % (e,))
-                    continue
-
-                row["entity_uri"] = NS['id']+row["entity_id"]
-                row["source_id_type"] = urllib.quote_plus(row["source_id_type"])
-                row["source_id"] = urllib.quote_plus(row["source_id"])
-
-                if not re.match(r"^({})$".format(hubkey.PARTS_S0["id_type"]), row["source_id_type"]):
-                    e = 'skipping record %s - invalid id type "%s"' % (row["entity_id"], row["source_id_type"])
-                    errors.append(e)
-                    logging.warning("Error processing new record: %s" % (e,))
-                    continue
-
-                if not re.match(r"^({})$".format(hubkey.PARTS_S0["entity_id"]), row["source_id"]):
-                    e = 'skipping record %s - invalid id type "%s"' % (row["entity_uri"], row["source_id"])
-                    errors.append(e)
-                    logging.warning("Error processing new record: %s" % (e,))
-                    continue
-
-                row['repository_id'] = repo
-                row['entity_type'] = entity_type
-                turtle += template.format(**row)
+            accepted, rejected = validate_identifiers(data)
+            errors.extend(error for _, error in rejected)
+
+            if self.fingerprints:
+                # skip the identifiers already in the index
+                count = len(accepted)
+                accepted = self.fingerprints.filter(repo, accepted)
+                logging.debug('skipping %r records already ingested' % (count - len(accepted),))
+
+            for entity_id, source_id_type, source_id in accepted:
+                record = template.format(entity_uri=NS['id'] + entity_id,
+                                         source_id_type=source_id_type,
+                                         source_id=source_id,
+                                         repository_id=repo,
+                                         entity_type=entity_type)
+                chunk.append(record)
+                size += len(record)
+                ingested.append((entity_id, source_id_type, source_id))
+
+                if size >= options.store_chunk_size:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
         except Exception, e:
-            data = []
+            result['records'] = 0
             logging.exception("Error parsing data from repo")
 
-        logging.debug(turtle.strip())
-        logging.info('storing %r records' % (len(data),))
-        yield self.store(turtle.strip(), 'text/turtle')
-
-        raise gen.Return({"errors": errors, "records": len(data)})
+        if chunk:
+            yield ''.join(chunk)
 
     @gen.coroutine
     def store(self, data, content_type):
         """
         Async function to store data in the database
 
-        :param data: String
+        :param data: String, or an iterable of strings streamed to the
+            database
         :param content_type: String
+        :returns: True if the data was stored
         """
-        client = AsyncHTTPClient()
         headers = {'Content-Type': content_type}
+        kwargs = {}
+        if isinstance(data, basestring):
+            kwargs['body'] = data
+        else:
+            kwargs['body_producer'] = partial(self._produce_body, data)
+            kwargs['client'] = self.stream_client
+
         try:
-            yield client.fetch(self.db_url, method='POST',
-                               body=data, headers=headers)
+            yield self._fetch(self.db_url, method='POST',
+                              headers=headers,
+                              request_timeout=options.index_db_update_timeout,
+                              **kwargs)
         except HTTPError as e:
             logging.error("Database server error({0}) (Is Database server"
                           " running on {1} HTTP Error {2})".format(e.message, self.db_url, e.code))
         except Exception as e:
             logging.error("Database server error({0}) (Is database server"
                           " running on {1}) {2}".format(e.args, self.db_url, e))
+        else:
+            raise gen.Return(True)
+
+        raise gen.Return(False)
+
+    @staticmethod
+    @gen.coroutine
+    def _produce_body(chunks, write):
+        """
+        Write chunks of the request body, waiting for each chunk to be sent
+        before generating the next one
+        """
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            yield write(chunk)
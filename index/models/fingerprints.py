@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Fingerprints of the identifiers already stored in the index
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import time
+
+from .sqlite import Transaction
+
+
+def fingerprint(entity_id, source_id_type, source_id):
+    """
+    :returns: a 64 bit integer identifying the identifier
+    """
+    key = '\0'.join([entity_id, source_id_type, source_id])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    digest = hashlib.md5(key).digest()
+    return struct.unpack(b'<q', digest[:8])[0]
+
+
+class IngestFingerprints(object):
+    """
+    Fingerprints of the (entity_id, source_id_type, source_id) ingested from
+    each repository, stored in a local SQLite database
+
+    Used to skip identifiers that are already in the index when polling
+    repositories, the database is shared with the web workers so that
+    deleted identifiers can be ingested again. A fingerprint only means the
+    identifier was stored, so the oldest fingerprints are evicted when there
+    are more than max_size for a repository, and fingerprints expire after
+    ttl seconds so that identifiers missing from the index (e.g. after the
+    index database was rebuilt) are eventually ingested again.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            repository_id TEXT NOT NULL,
+            fingerprint INTEGER NOT NULL,
+            added REAL NOT NULL,
+            PRIMARY KEY (repository_id, fingerprint)
+        );
+        CREATE INDEX IF NOT EXISTS fingerprints_added
+            ON fingerprints (repository_id, added);
+    """
+
+    # maximum number of fingerprints in a single statement
+    BATCH_SIZE = 500
+
+    def __init__(self, path, max_size, ttl=0, timer=time.time):
+        """
+        :param path: path to the SQLite database
+        :param max_size: maximum number of fingerprints for each repository
+        :param ttl: seconds before a fingerprint expires, 0 if never
+        :param timer: function returning the current time
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._time = timer
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        """
+        The connection to the database, opened lazily by each process because
+        connections must not be shared across a fork
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=5,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(self.SCHEMA)
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def count(self, repository_id):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM fingerprints WHERE repository_id = ?',
+            (repository_id,)).fetchone()[0]
+
+    def filter(self, repository_id, rows):
+        """
+        Remove the identifiers already ingested from a repository
+
+        :param repository_id: the repository ID
+        :param rows: a list of (entity_id, source_id_type, source_id)
+        :returns: the rows that have not been ingested, in the same order
+        """
+        fingerprints = [fingerprint(*row) for row in rows]
+        try:
+            seen = set()
+            for start in range(0, len(fingerprints), self.BATCH_SIZE):
+                batch = fingerprints[start:start + self.BATCH_SIZE]
+                seen.update(row[0] for row in self.connection.execute(
+                    'SELECT fingerprint FROM fingerprints WHERE repository_id = ? '
+                    'AND added > ? AND fingerprint IN ({})'.format(','.join('?' * len(batch))),
+                    [repository_id, self._expired()] + batch))
+        except sqlite3.Error:
+            logging.exception('Error reading the ingest fingerprints')
+            return list(rows)
+
+        return [row for row, x in zip(rows, fingerprints) if x not in seen]
+
+    def add(self, repository_id, rows):
+        """
+        Record identifiers stored in the index
+
+        :param repository_id: the repository ID
+        :param rows: a list of (entity_id, source_id_type, source_id)
+        """
+        if self.max_size <= 0 or not rows:
+            return
+
+        now = self._time()
+        try:
+            with Transaction(self.connection) as connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO fingerprints (repository_id, fingerprint, added) '
+                    'VALUES (?, ?, ?)',
+                    [(repository_id, fingerprint(*row), now) for row in rows])
+                connection.execute(
+                    'DELETE FROM fingerprints WHERE repository_id = ? AND added <= ?',
+                    (repository_id, self._expired()))
+
+                excess = connection.execute(
+                    'SELECT COUNT(*) FROM fingerprints WHERE repository_id = ?',
+                    (repository_id,)).fetchone()[0] - self.max_size
+                if excess > 0:
+                    connection.execute(
+                        'DELETE FROM fingerprints WHERE rowid IN ('
+                        'SELECT rowid FROM fingerprints WHERE repository_id = ? '
+                        'ORDER BY added LIMIT ?)', (repository_id, excess))
+        except sqlite3.Error:
+            logging.exception('Error writing the ingest fingerprints')
+
+    def _expired(self):
+        """The time fingerprints added before (or at) have expired"""
+        if self.ttl <= 0:
+            return float('-inf')
+
+        return self._time() - self.ttl
+
+    def remove(self, repository_id, rows):
+        """
+        Forget identifiers deleted from the index
+
+        :param repository_id: the repository ID
+        :param rows: a list of (entity_id, source_id_type, source_id)
+        """
+        if not rows:
+            return
+
+        try:
+            with Transaction(self.connection) as connection:
+                connection.executemany(
+                    'DELETE FROM fingerprints WHERE repository_id = ? AND fingerprint = ?',
+                    [(repository_id, fingerprint(*row)) for row in rows])
+        except sqlite3.Error:
+            logging.exception('Error writing the ingest fingerprints')
+
+    def clear(self, repository_id=None):
+        """
+        Forget the identifiers ingested from a repository, or all repositories
+
+        :param repository_id: (optional) the repository ID
+        """
+        with Transaction(self.connection) as connection:
+            if repository_id is None:
+                connection.execute('DELETE FROM fingerprints')
+            else:
+                connection.execute('DELETE FROM fingerprints WHERE repository_id = ?',
+                                   (repository_id,))
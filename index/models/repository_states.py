@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+State of the repositories polled by the index
+"""
+import cPickle as pickle
+import logging
+import os
+import shelve
+import sqlite3
+import whichdb
+
+from .sqlite import Transaction
+
+
+class RepositoryStates(object):
+    """
+    The records of the repositories polled by the index, with the state of
+    the polling (errors, last and next query), stored in a local SQLite
+    database
+
+    Updates (and removals) are kept in memory and written in a single
+    transaction once batch_size repositories have changed or when flushed,
+    so that recording the result of each query is cheap. The database is shared with the web
+    workers, which only read it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS repositories (
+            id TEXT PRIMARY KEY,
+            state BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS circuit_breakers (
+            host TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            failures INTEGER NOT NULL,
+            opened REAL
+        );
+    """
+
+    def __init__(self, path, batch_size=100):
+        """
+        :param path: path to the SQLite database
+        :param batch_size: number of changed repositories written at once
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._changed = {}
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        """
+        The connection to the database, opened lazily by each process because
+        connections must not be shared across a fork
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=5,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(self.SCHEMA)
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __contains__(self, repo_id):
+        if repo_id in self._changed:
+            return self._changed[repo_id] is not None
+
+        row = self.connection.execute('SELECT 1 FROM repositories WHERE id = ?',
+                                      (repo_id,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, repo_id):
+        """
+        :param repo_id: the repository ID
+        :returns: the repository dictionary
+        :raises KeyError: if an unknown repository
+        """
+        if repo_id in self._changed:
+            repository = self._changed[repo_id]
+            if repository is None:
+                raise KeyError(repo_id)
+            return repository
+
+        row = self.connection.execute('SELECT state FROM repositories WHERE id = ?',
+                                      (repo_id,)).fetchone()
+        if row is None:
+            raise KeyError(repo_id)
+
+        return pickle.loads(str(row[0]))
+
+    def __setitem__(self, repo_id, repository):
+        self._changed[repo_id] = repository
+        if len(self._changed) >= self.batch_size:
+            self.flush()
+
+    def __delitem__(self, repo_id):
+        if repo_id not in self:
+            raise KeyError(repo_id)
+
+        # None marks a removed repository until flushed
+        self[repo_id] = None
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, repo_id, default=None):
+        try:
+            return self[repo_id]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        :returns: a set of the IDs of the known repositories
+        """
+        ids = set(row[0] for row in self.connection.execute('SELECT id FROM repositories'))
+        for repo_id, repository in self._changed.items():
+            if repository is None:
+                ids.discard(repo_id)
+            else:
+                ids.add(repo_id)
+        return ids
+
+    def set_circuit_breaker(self, host, breaker):
+        """
+        Store the state of the circuit breaker of a repository service host,
+        written immediately because it rarely changes
+
+        :param host: the host
+        :param breaker: a dictionary with the "state", "failures" and the
+            time the circuit was "opened"
+        """
+        try:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO circuit_breakers (host, state, failures, opened) '
+                'VALUES (?, ?, ?, ?)',
+                (host, breaker['state'], breaker['failures'], breaker.get('opened')))
+        except sqlite3.Error:
+            logging.exception('Error writing the circuit breakers')
+
+    def circuit_breakers(self):
+        """
+        :returns: a list of dictionaries with the "host", "state",
+            "failures" and the time the circuit was "opened"
+        """
+        return [{'host': host, 'state': state, 'failures': failures, 'opened': opened}
+                for host, state, failures, opened in self.connection.execute(
+                    'SELECT host, state, failures, opened FROM circuit_breakers ORDER BY host')]
+
+    def flush(self):
+        """Write the changed repositories to the database"""
+        if not self._changed:
+            return
+
+        try:
+            with Transaction(self.connection) as connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO repositories (id, state) VALUES (?, ?)',
+                    [(repo_id, sqlite3.Binary(pickle.dumps(repository, pickle.HIGHEST_PROTOCOL)))
+                     for repo_id, repository in self._changed.items()
+                     if repository is not None])
+                connection.executemany(
+                    'DELETE FROM repositories WHERE id = ?',
+                    [(repo_id,) for repo_id, repository in self._changed.items()
+                     if repository is None])
+        except sqlite3.Error:
+            logging.exception('Error writing the repository states')
+            return
+
+        self._changed.clear()
+
+    def import_shelf(self, path):
+        """
+        Import the repositories from the shelf used by earlier versions, if
+        there are no repositories in the database yet (e.g. on the first
+        start after an upgrade), so that their state is not lost
+
+        :param path: path to the shelf
+        :returns: the number of repositories imported
+        """
+        if not whichdb.whichdb(path) or self.keys():
+            return 0
+
+        shelf = shelve.open(path, flag='r')
+        try:
+            for repo_id, repository in shelf.items():
+                self._changed[repo_id] = repository
+        finally:
+            shelf.close()
+
+        count = len(self._changed)
+        self.flush()
+        logging.info('Imported {} repositories from {}'.format(count, path))
+        return count
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Status of the repositories shared by the crawler and the web workers
+"""
+from datetime import datetime
+import calendar
+import logging
+import mmap
+import struct
+import zlib
+
+
+class RecordBusyError(Exception):
+    """A record of the status table is being written and could not be read"""
+
+
+class RepositoryStatus(object):
+    """
+    Time each repository was last indexed, in a table of fixed size records
+    in shared memory
+
+    The table is created before forking, written by the crawler process
+    and read by the web workers without any lock or system call. Records
+    are found by open addressing on a hash of the repository ID, within
+    MAX_PROBES records. Removed repositories leave a tombstone, reused by
+    the repositories stored later. Each record has a sequence number, odd
+    while the record is being written, so that readers retry instead of
+    reading a partially written record (there must be a single writer).
+
+    Until the crawler has populated the table, or if a repository cannot be
+    stored (no free record or the ID is too long), the table is not
+    complete, and readers must then treat a missing repository as unknown
+    rather than as not found.
+    """
+
+    # header: flags
+    HEADER = struct.Struct(b'<Q')
+    POPULATED = 1
+    INCOMPLETE = 2
+    # record: sequence, length of the ID, last indexed time, ID
+    RECORD = struct.Struct(b'<IId64s')
+    SEQUENCE = struct.Struct(b'<I')
+    MAX_ID_LENGTH = 64
+    # maximum number of records looked at to find a repository
+    MAX_PROBES = 128
+    # maximum number of attempts to read a record being written
+    MAX_READ_RETRIES = 1000
+    # last indexed time of repositories that have not been indexed
+    NEVER = -1.0
+    # last indexed time of removed repositories, their records are kept so
+    # that the repositories stored after them can still be found
+    REMOVED = -2.0
+
+    def __init__(self, size):
+        """
+        :param size: maximum number of repositories
+        """
+        self.size = size
+        self._memory = mmap.mmap(-1, self.HEADER.size + self.RECORD.size * size)
+
+    @property
+    def complete(self):
+        """Whether the table was populated and all the repositories set could be stored"""
+        return self._flags() == self.POPULATED
+
+    def mark_populated(self):
+        """Flag the table as populated with all the known repositories"""
+        self.HEADER.pack_into(self._memory, 0, self._flags() | self.POPULATED)
+
+    def _flags(self):
+        return self.HEADER.unpack_from(self._memory, 0)[0]
+
+    def _slots(self, repo_id):
+        """The offsets of the records where a repository may be stored"""
+        start = zlib.crc32(repo_id) & 0xffffffff
+        for i in xrange(min(self.size, self.MAX_PROBES)):
+            yield self.HEADER.size + ((start + i) % self.size) * self.RECORD.size
+
+    def _read(self, offset):
+        """
+        Read a record, waiting for the writer to finish writing it
+
+        :raises RecordBusyError: if the record is still being written after
+            MAX_READ_RETRIES attempts (e.g. the writer died while writing it)
+        """
+        for _ in xrange(self.MAX_READ_RETRIES):
+            record = self.RECORD.unpack_from(self._memory, offset)
+            sequence = self.SEQUENCE.unpack_from(self._memory, offset)[0]
+            if record[0] == sequence and not sequence % 2:
+                return record
+
+        raise RecordBusyError('Record at offset {} is being written'.format(offset))
+
+    def get(self, repo_id):
+        """
+        Get the time a repository was last indexed
+
+        :param repo_id: the repository ID
+        :returns: a datetime (UTC), None if the repository has not been
+            indexed
+        :raises KeyError: if the repository is not in the table
+        :raises RecordBusyError: if a record could not be read
+        """
+        key = repo_id.encode('utf-8') if isinstance(repo_id, unicode) else repo_id
+        if len(key) <= self.MAX_ID_LENGTH:
+            for offset in self._slots(key):
+                _, length, last, stored = self._read(offset)
+                if not length:
+                    break
+                if stored[:length] == key:
+                    if last == self.REMOVED:
+                        break
+                    if last == self.NEVER:
+                        return None
+                    return datetime.utcfromtimestamp(last)
+
+        raise KeyError(repo_id)
+
+    def set(self, repo_id, last):
+        """
+        Set the time a repository was last indexed
+
+        :param repo_id: the repository ID
+        :param last: a datetime (UTC), or None if not indexed
+        :returns: True if the repository was stored
+        """
+        if last is None:
+            last = self.NEVER
+        else:
+            last = calendar.timegm(last.utctimetuple()) + last.microsecond / 1e6
+
+        return self._set(repo_id, last)
+
+    def remove(self, repo_id):
+        """
+        Remove a repository
+
+        :param repo_id: the repository ID
+        """
+        key = repo_id.encode('utf-8') if isinstance(repo_id, unicode) else repo_id
+        offset = self._find(key)
+        if offset is not None:
+            self._write(offset, key, self.REMOVED)
+
+    def _find(self, key):
+        """
+        Find the record of a repository (removed or not), only used by the
+        writer so records are read without waiting
+
+        :returns: the offset of the record, None if not found
+        """
+        if len(key) > self.MAX_ID_LENGTH:
+            return None
+
+        for offset in self._slots(key):
+            _, length, _, stored = self.RECORD.unpack_from(self._memory, offset)
+            if not length:
+                return None
+            if stored[:length] == key:
+                return offset
+
+        return None
+
+    def _set(self, repo_id, last):
+        key = repo_id.encode('utf-8') if isinstance(repo_id, unicode) else repo_id
+        if len(key) <= self.MAX_ID_LENGTH:
+            free = None
+            for offset in self._slots(key):
+                _, length, stored_last, stored = self.RECORD.unpack_from(self._memory, offset)
+                if stored[:length] == key:
+                    free = offset
+                    break
+                if not length:
+                    if free is None:
+                        free = offset
+                    break
+                if stored_last == self.REMOVED and free is None:
+                    free = offset
+
+            if free is not None:
+                self._write(free, key, last)
+                return True
+
+        if not self._flags() & self.INCOMPLETE:
+            logging.warning('Repository {} not stored in the status table, '
+                            'the table is incomplete'.format(repo_id))
+            self.HEADER.pack_into(self._memory, 0, self._flags() | self.INCOMPLETE)
+        return False
+
+    def _write(self, offset, key, last):
+        """Write a record, with an odd sequence number while writing it"""
+        sequence = self.SEQUENCE.unpack_from(self._memory, offset)[0]
+        writing = (sequence + 1) & 0xffffffff
+        self.SEQUENCE.pack_into(self._memory, offset, writing)
+        self.RECORD.pack_into(self._memory, offset, writing, len(key), last, key)
+        self.SEQUENCE.pack_into(self._memory, offset, (writing + 1) & 0xffffffff)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Validation of the identifiers ingested from repositories
+"""
+import logging
+import re
+import urllib
+
+from bass import hubkey
+
+REQUIRED_FIELDS = ("entity_id", "source_id", "source_id_type")
+
+# the patterns are compiled once, rather than looked up for each row
+ENTITY_ID_PATTERN = re.compile("[0-9a-f]{1,64}")
+ID_TYPE_PATTERN = re.compile(r"^({})$".format(hubkey.PARTS_S0["id_type"]))
+SOURCE_ID_PATTERN = re.compile(r"^({})$".format(hubkey.PARTS_S0["entity_id"]))
+
+
+def validate_identifiers(rows):
+    """
+    Validate a page of identifiers, to avoid "turtle injection"
+
+    :param rows: a list of dictionaries containing "entity_id", "source_id"
+        & "source_id_type"
+    :returns: a tuple of two lists, the accepted rows as
+        (entity_id, source_id_type, source_id) tuples with the source id and
+        type url quoted, and the rejected rows as (index, error) tuples
+    """
+    accepted = []
+    rejected = []
+    append = accepted.append
+    quote = urllib.quote_plus
+    match_entity_id = ENTITY_ID_PATTERN.match
+    match_id_type = ID_TYPE_PATTERN.match
+    match_source_id = SOURCE_ID_PATTERN.match
+
+    for index, row in enumerate(rows):
+        try:
+            entity_id = row["entity_id"]
+            source_id = row["source_id"]
+            source_id_type = row["source_id_type"]
+        except KeyError:
+            rejected.append((index, 'missing field entity_id skipping record %r' % (row,)))
+            continue
+
+        if not match_entity_id(entity_id):
+            rejected.append((index, 'skipping record %s - invalid id ' % (entity_id,)))
+            continue
+
+        source_id_type = quote(source_id_type)
+        source_id = quote(source_id)
+
+        if not match_id_type(source_id_type):
+            rejected.append((index, 'skipping record %s - invalid id type "%s"' % (entity_id, source_id_type)))
+        elif not match_source_id(source_id):
+            rejected.append((index, 'skipping record %s - invalid id type "%s"' % (entity_id, source_id)))
+        else:
+            append((entity_id, source_id_type, source_id))
+
+    for _, error in rejected:
+        logging.warning("Error processing new record: %s" % (error,))
+
+    return accepted, rejected
@@ -20,56 +20,140 @@
 Responsible for periodically polling repository services for data to populate
 the index.
 """
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import errno
+import fcntl
 import heapq
 import logging
 import os
-import Queue
-import shelve
+import select
 import random
+import time
+import urlparse
 
 import dateutil.parser
 from tornado.gen import coroutine, sleep, Return
 from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from tornado.queues import Queue as PageQueue
 from tornado.options import define, options
 from tornado.httpclient import HTTPError
+from tornado.httputil import format_timestamp
 import koi
 from koi.configure import log_config, configure_syslog, ssl_server_options
 from chub import API
-from chub.oauth2 import Read, get_token
+from chub.oauth2 import Read, RequestToken
 
 from .models import db
+from .models.repository_states import RepositoryStates
 
 define('url_accounts', help='The accounts service URL')
 define('accounts_poll_interval', default=60 * 60 * 24,
        help='Seconds between requests to get repository services registered in'
             ' the accounts service')
+define('accounts_page_size', default=0,
+       help='Number of repositories requested from the accounts service at '
+       'once, 0 requests all the repositories at once')
+define('repository_removal_grace', default=60 * 60 * 24,
+       help='Seconds a repository may be missing from the list of the '
+       'accounts service before it is removed, 0 removes it at once')
 define('default_poll_interval', default=60 * 60 * 6,
        help='Default seconds between requests to a repository service')
+define('min_poll_interval', default=60 * 10,
+       help='Minimum seconds between requests to an active repository service')
+define('max_poll_interval', default=60 * 60 * 24 * 7,
+       help='Maximum seconds between requests to a dormant repository service')
+define('poll_history_size', default=10,
+       help='Number of polls of each repository used to adapt its poll '
+       'interval')
 define('max_poll_error_delay_factor', default=5,
-       help='Maximum multiplication factor to delay requests to repositories '
-       'that responded with an error')
+       help='Maximum delay before requesting a repository that responded with '
+       'an error, as a multiple of default_poll_interval')
+define('circuit_breaker_threshold', default=5,
+       help='Number of consecutive connection errors, timeouts or server '
+       'errors from a repository service host before requests to the host '
+       'are suspended')
+define('circuit_breaker_timeout', default=60 * 5,
+       help='Seconds requests to a failing repository service host are '
+       'suspended before a single request is tried')
 define('max_repository_pages', default=5,
        help='The maximum number of pages to fetch from a repository before'
        'moving onto another repository')
-define('notification_poll_interval', default=0.1,
-       help='Time to wait before rechecking for notifications from other threads')
+define('repository_poll_time_budget', default=60,
+       help='Seconds after which no more pages are requested from a repository '
+       'before moving onto another repository')
+define('continuation_delay', default=0,
+       help='Seconds before polling again a repository that had more pages '
+       'than max_repository_pages (or repository_poll_time_budget allowed)')
+define('backfill_slices', default=1,
+       help='Number of date slices fetched concurrently from a new repository, '
+       '1 fetches the pages of a new repository one after another')
+define('backfill_concurrency', default=4,
+       help='Maximum number of date slices of a new repository fetched at once')
+define('repository_prefetch_pages', default=2,
+       help='The number of pages fetched from a repository ahead of the page '
+       'being stored in the index')
+define('scheduler_compact_ratio', default=0.5,
+       help='Ratio of rescheduled items left in the scheduler queue above '
+       'which the queue is compacted')
 define('concurrency', default=2,
        help='Number of workers making requests to repositories')
-define('notify_queue_overload_warning', default=2,
-       help='Display a warning if the notification queue starts to a grow (min value should be close to concurrency)')
-define('local_db', default='repos_shelf.db', help='Path to shelf database')
+define('local_db', default='repositories.db',
+       help='Path to the local database of the repositories')
+define('legacy_local_db', default='repos_shelf.db',
+       help='Path to the shelf of the repositories used by earlier versions, '
+       'imported into local_db when it has no repositories')
+define('local_db_commit_interval', default=1.0,
+       help='Maximum seconds before changes to the repositories are written to '
+       'the local database')
+define('repository_status_size', default=65536,
+       help='Maximum number of repositories in the table of the last indexed '
+       'times shared with the web workers')
+define('notifications_queue_max_size', default=1000,
+       help='Maximum number of notifications from repositories waiting to be '
+       'sent to the crawler by each web worker')
+define('notify_debounce', default=1.0,
+       help='Seconds during which the notifications received by a web worker '
+       'are merged before being sent to the crawler')
 define('notify_min_delay', default=(60 * 60 * 6) / 10, help='Min delay between checks with notify')
+define('token_refresh_margin', default=300,
+       help='Seconds before an OAuth token expires when a new token is '
+       'requested')
 define('open_service', default=True, help='If the service is open then repositories not associated with '
                                           'this index can send notification to this index')
 
 
 class Notification(object):
-    """Responsible for notifying the scheduler"""
+    """
+    Responsible for notifying the scheduler
+
+    The web workers write the ids of the repositories sending notifications
+    to a pipe, which is read by the crawler process as soon as they are
+    written. Each web worker keeps the ids received during notify_debounce
+    seconds (or while the pipe is full) and sends each of them once, and the
+    crawler reschedules a repository only if it is not already due sooner.
+    """
+
+    # ids are written in chunks of whole lines no larger than PIPE_BUF, so
+    # that the writes of the web workers are atomic
+    PIPE_BUF = select.PIPE_BUF
 
-    def __init__(self, notification_q=None):
-        self.notification_q = notification_q
+    def __init__(self):
         self._scheduler = None
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self._buffer = b''
+        self._pending = OrderedDict()
+        self._writing = False
+        self._flush_timeout = None
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.delivered = 0
 
     def connect_with(self, scheduler):
         """
@@ -79,20 +163,96 @@ class Notification(object):
         self._scheduler = scheduler
 
     def put_nowait(self, repo_id):
-        """Put (no wait) dropping silently"""
-        try:
-            self.notification_q.put_nowait(repo_id)
-        except Queue.Full:
+        """
+        Send a notification to the crawler process, dropped if too many
+        notifications are waiting to be sent
+
+        :param repo_id: the repository ID
+        :raises ValueError: if the repository ID is not a string, contains a
+            new line or is too long to be written at once
+        """
+        if not isinstance(repo_id, basestring):
+            raise ValueError('Invalid repository id {!r}'.format(repo_id))
+
+        repo_id = repo_id.encode('utf-8') if isinstance(repo_id, unicode) else repo_id
+        if not repo_id or b'\n' in repo_id or len(repo_id) > self.PIPE_BUF - 1:
+            raise ValueError('Invalid repository id {!r}'.format(repo_id[:100]))
+
+        self.received += 1
+        if repo_id in self._pending:
+            self.coalesced += 1
+            return
+
+        if len(self._pending) >= options.notifications_queue_max_size:
+            self.dropped += 1
             logging.warning('Notification from repository service {} dropped '
                             'because the queue is full'.format(repo_id))
-            pass
+            return
 
-    def get_nowait(self):
-        """Get (no wait) returning None if empty"""
-        try:
-            return self.notification_q.get_nowait()
-        except Queue.Empty:
-            pass
+        self._pending[repo_id] = None
+        if self._flush_timeout is None and not self._writing:
+            if options.notify_debounce > 0:
+                self._flush_timeout = IOLoop.current().call_later(
+                    options.notify_debounce, self._flush)
+            else:
+                self._write()
+
+    def stats(self):
+        """
+        :returns: a dictionary with the number of notifications received,
+            coalesced with a notification from the same repository, dropped
+            and delivered (written to the pipe by a web worker, or
+            rescheduled by the crawler) by this process
+        """
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'delivered': self.delivered
+        }
+
+    def _flush(self):
+        """Send the notifications received during the debounce window"""
+        self._flush_timeout = None
+        self._write()
+        logging.debug('notifications: {}'.format(self.stats()))
+
+    def _write(self, fd=None, events=None):
+        """Write the pending notifications, until the pipe is full"""
+        while self._pending:
+            chunk, size = [], 0
+            for repo_id in self._pending:
+                if size + len(repo_id) + 1 > self.PIPE_BUF:
+                    break
+                chunk.append(repo_id)
+                size += len(repo_id) + 1
+
+            if not chunk:
+                # put_nowait does not accept ids longer than PIPE_BUF
+                logging.error('Notification {!r} too long to be sent'.format(
+                    next(iter(self._pending))[:100]))
+                self._pending.popitem(last=False)
+                continue
+
+            try:
+                os.write(self._write_fd, b''.join(x + b'\n' for x in chunk))
+            except OSError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+
+            for repo_id in chunk:
+                del self._pending[repo_id]
+            self.delivered += len(chunk)
+
+        io_loop = IOLoop.current()
+        if self._pending and not self._writing:
+            # wait for the crawler to read from the pipe
+            io_loop.add_handler(self._write_fd, self._write, IOLoop.WRITE)
+            self._writing = True
+        elif not self._pending and self._writing:
+            io_loop.remove_handler(self._write_fd)
+            self._writing = False
 
     def start(self):
         """
@@ -101,69 +261,116 @@ class Notification(object):
         scheduler.
         """
         io_loop = IOLoop.current()
-        io_loop.add_callback(self.check_for_notifications)
+        io_loop.add_handler(self._read_fd, self._read, IOLoop.READ)
 
-    @coroutine
-    def check_for_notifications(self):
+    def _read(self, fd=None, events=None):
         """
-        Coroutine thread that
-        receives notifications and integrate them in the scheduling.
+        Read the notifications written to the pipe and integrate them in the
+        scheduling
         """
+        repo_ids = OrderedDict()
         while True:
             try:
-                yield self._check_for_notifications()
-                yield sleep(options.notification_poll_interval)
-            except Exception as e:
-                logging.exception('Error checking for notifications')
-                pass
+                data = os.read(self._read_fd, 65536)
+            except OSError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.exception('Error reading notifications')
+                break
 
-    @coroutine
-    def _check_for_notifications(self, max_notifications=20):
-        """
-        Receives notifications and integrate them in the scheduling.
-        """
-        repo_id = self.get_nowait()
-        while repo_id and max_notifications > 0:
-            yield self._scheduler.reschedule(repo_id, options.notify_min_delay)
-            logging.info("Received notification from %s " % (repo_id,))
-            repo_id = self.get_nowait()
-            max_notifications -= 1
+            if not data:
+                break
 
-        try:
-            qsize = self.notification_q.qsize()
-            if qsize >= options.notify_queue_overload_warning:
-                logging.info("%d elements in the notification queue %s " % (qsize,))
-        except NotImplementedError:
-            # qsize not implemented for OSX
-            # see: https://docs.python.org/2/library/multiprocessing.html#multiprocessing.Queue.qsize
-            pass
+            lines = (self._buffer + data).split(b'\n')
+            self._buffer = lines.pop()
+            for repo_id in lines:
+                repo_id = repo_id.decode('utf-8')
+                self.received += 1
+                if repo_id in repo_ids:
+                    self.coalesced += 1
+                repo_ids[repo_id] = None
+
+        for repo_id in repo_ids:
+            if self._scheduler._reschedule(repo_id, options.notify_min_delay):
+                self.delivered += 1
+                logging.info("Received notification from %s " % (repo_id,))
+            else:
+                self.coalesced += 1
+
+        if repo_ids:
+            logging.info('notifications: {}'.format(self.stats()))
 
 
 class Scheduler(object):
-    """Responsible for scheduling"""
+    """
+    Responsible for scheduling
+
+    Items are kept in a heap of [time, item_id]. Rescheduled items are
+    flagged as removed and left in the heap, which is compacted once the
+    removed items are more than scheduler_compact_ratio of the heap.
+
+    Items returned by get are in flight until released with done, so that
+    an item is never processed by two workers at once. An item scheduled
+    while in flight is held, and scheduled when it is released.
+    """
 
     REMOVED = '/task removed/'
+    # the heap is not compacted when it is smaller than this
+    MIN_COMPACT_SIZE = 64
 
     def __init__(self):
         self._items = {}
+        # item_id -> time the item is held for, or None
+        self._in_flight = {}
         self._priority_q = []
+        self._removed = 0
         self._time = IOLoop.current().time
+        self._changed = Condition()
+
+    def __len__(self):
+        """The number of scheduled items"""
+        return len(self._priority_q) - self._removed
 
     def _remove_item(self, item_id):
         """Flag an item in the _priority_q as removed"""
         try:
-            item = self._items[item_id]
+            item = self._items.pop(item_id)
         except KeyError:
             return
         item[-1] = self.REMOVED
+        self._removed += 1
+
+        size = len(self._priority_q)
+        if size >= self.MIN_COMPACT_SIZE and self._removed > size * options.scheduler_compact_ratio:
+            self._compact()
+
+    def _compact(self):
+        """Remove the items flagged as removed from the _priority_q"""
+        self._priority_q = [x for x in self._priority_q if x[-1] != self.REMOVED]
+        heapq.heapify(self._priority_q)
+        self._removed = 0
 
     @coroutine
     def reschedule(self, item_id, when=None):
-        """Reschedule an item (act only if not already scheduled before)"""
-        now = self._time()
-        item = self._items.get(item_id)
-        if not item or (item and item[0] > (now + when)):
-            yield self.schedule(item_id, when)
+        """
+        Reschedule an item (act only if not already scheduled before)
+
+        :returns: True if the item was rescheduled
+        """
+        raise Return(self._reschedule(item_id, when))
+
+    def _reschedule(self, item_id, when):
+        """Synchronous version of reschedule"""
+        when = self._time() + when
+        if item_id in self._in_flight:
+            scheduled = self._in_flight[item_id]
+        else:
+            scheduled = self._items.get(item_id, [None])[0]
+
+        if scheduled is None or scheduled > when:
+            self._schedule(item_id, when)
+            return True
+
+        return False
 
     @coroutine
     def schedule(self, item_id, when=None):
@@ -171,7 +378,13 @@ class Scheduler(object):
         if when is None:
             # If when is none the job is scheduled as not urgent
             when = random.uniform(0, options.default_poll_interval)
-        when = self._time() + when
+        self._schedule(item_id, self._time() + when)
+
+    def _schedule(self, item_id, when):
+        """Schedule an item at the time when, or hold it if in flight"""
+        if item_id in self._in_flight:
+            self._in_flight[item_id] = when
+            return
 
         if item_id in self._items:
             self._remove_item(item_id)
@@ -179,49 +392,270 @@ class Scheduler(object):
         item = [when, item_id]
         heapq.heappush(self._priority_q, item)
         self._items[item_id] = item
+        self._changed.notify_all()
+
+    def wake(self):
+        """Wake up the coroutines waiting for an item"""
+        self._changed.notify_all()
+
+    def unschedule(self, item_id):
+        """Remove an item from the schedule (if scheduled or held)"""
+        self._remove_item(item_id)
+        if item_id in self._in_flight:
+            self._in_flight[item_id] = None
+
+    def done(self, item_id, when=None):
+        """
+        Release an item returned by get, and schedule it again
+
+        :param item_id: the item
+        :param when: the item is scheduled again in this many seconds. If
+            the item was scheduled while in flight, it is scheduled at the
+            earliest of the two times. If None the item is only scheduled
+            if it was scheduled while in flight.
+        """
+        held = self._in_flight.pop(item_id, None)
+        if when is not None:
+            when = self._time() + when
+            if held is None or when < held:
+                held = when
+
+        if held is not None:
+            self._schedule(item_id, held)
+
+    def _next_time(self):
+        """The time of the next item, None if no item is scheduled"""
+        queue = self._priority_q
+        while queue and queue[0][-1] == self.REMOVED:
+            heapq.heappop(queue)
+            self._removed -= 1
+
+        if queue:
+            return queue[0][0]
+
+    @coroutine
+    def wait(self):
+        """
+        Wait until the next item is due, or until woken early when an item is
+        scheduled (or by wake)
+        """
+        when = self._next_time()
+        if when is None:
+            yield self._changed.wait()
+        elif when > self._time():
+            yield self._changed.wait(timeout=timedelta(seconds=when - self._time()))
 
     @coroutine
     def get(self, n=1):
         """
-        Gets the next n items
+        Gets the next n items. The items are in flight until released with
+        done.
 
         :param n: maximum number of items to get, defaults to 1. If items are
             scheduled in the future less than n items might be returned.
         """
         items = []
         now = self._time()
+        queue = self._priority_q
 
         while len(items) < n:
-            try:
-                item = heapq.nsmallest(1, self._priority_q)
-                time, repo_id = item[0]
-            except IndexError:
+            when = self._next_time()
+            if when is None or when > now:
                 break
 
-            if time > now:
-                break
+            _, repo_id = heapq.heappop(queue)
+            self._items.pop(repo_id, None)
+            self._in_flight[repo_id] = None
+            items.append(repo_id)
 
-            heapq.heappop(self._priority_q)
+        raise Return(items)
 
-            if repo_id != self.REMOVED:
-                items.append(repo_id)
 
-        raise Return(items)
+def backoff_delay(previous=None):
+    """
+    Delay before querying a repository again after an error
+
+    The delay grows exponentially with "decorrelated jitter": it is a random
+    float between half the default_poll_interval and three times the
+    previous delay, up to max_poll_error_delay_factor times the
+    default_poll_interval, so that repositories failing together are not
+    queried again together.
+
+    :param previous: (optional) the previous delay, after the first error
+    :returns: seconds
+    """
+    base = 0.5 * options.default_poll_interval
+    cap = options.max_poll_error_delay_factor * options.default_poll_interval
+    return min(cap, random.uniform(base, 3 * max(base, previous or base)))
+
+
+class CircuitOpenError(Exception):
+    """Requests to a repository service host are suspended"""
+
+    def __init__(self, host, retry_after):
+        super(CircuitOpenError, self).__init__(
+            'Requests to {} are suspended'.format(host))
+        self.host = host
+        self.retry_after = retry_after
+
+
+def is_host_failure(exc):
+    """
+    Whether an error making a request to a repository service is a failure
+    of the host (a connection error, a timeout or a server error), rather
+    than an error of the repository queried
+
+    :param exc: the exception
+    """
+    if isinstance(exc, HTTPError):
+        return exc.code == 599 or exc.code >= 500
+
+    return isinstance(exc, (IOError, OSError))
+
+
+class CircuitBreaker(object):
+    """
+    Suspends requests to the repository service hosts that keep failing
+
+    The circuit of a host is opened after circuit_breaker_threshold
+    consecutive host failures (see is_host_failure), whichever repositories
+    were queried. Once open, no
+    request is made to the host for circuit_breaker_timeout seconds, then
+    the circuit is "half-open" and a single request (the "probe") is
+    allowed: the circuit is closed if it succeeds, and opened again if it
+    fails. Until then the other requests are rejected.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, on_change=None, timer=time.time):
+        """
+        :param on_change: (optional) function called with the host and a
+            dictionary of its "state", number of consecutive "failures" and
+            the time it was "opened" when they change
+        :param timer: function returning the current time
+        """
+        self.on_change = on_change
+        self._time = timer
+        self._hosts = {}
+
+    def load(self, breakers):
+        """
+        Restore the states stored before a restart. A request that was
+        allowed while half-open did not complete, so the circuit is opened.
+
+        :param breakers: an iterable of dictionaries with the "host",
+            "state", "failures" and the time the circuit was "opened"
+        """
+        for breaker in breakers:
+            state = breaker['state']
+            if state == self.HALF_OPEN:
+                state = self.OPEN
+            self._hosts[breaker['host']] = {'state': state,
+                                            'failures': breaker['failures'],
+                                            'opened': breaker['opened']}
+
+    def allow(self, host):
+        """
+        Check that a request can be made to a host
+
+        :param host: the host of a repository service
+        :returns: True if the request is the probe allowed while half-open,
+            which must then be ended by success, failure or release
+        :raises CircuitOpenError: if requests to the host are suspended
+        """
+        breaker = self._hosts.get(host)
+        if breaker is None or breaker['state'] == self.CLOSED:
+            return False
+
+        retry_after = 0
+        if breaker['state'] == self.OPEN:
+            retry_after = breaker['opened'] + options.circuit_breaker_timeout - self._time()
+            if retry_after <= 0:
+                logging.info('Trying a request to {} again'.format(host))
+                self._set(host, self.HALF_OPEN)
+                return True
+
+        raise CircuitOpenError(host, max(retry_after, 0))
+
+    def success(self, host):
+        """Record a successful request to a host"""
+        breaker = self._hosts.get(host)
+        if breaker and (breaker['state'] != self.CLOSED or breaker['failures']):
+            if breaker['state'] != self.CLOSED:
+                logging.info('Requests to {} resumed'.format(host))
+            self._set(host, self.CLOSED, failures=0, opened=None)
+
+    def failure(self, host):
+        """Record a failed request to a host"""
+        breaker = self._hosts.get(host, {'state': self.CLOSED, 'failures': 0})
+        failures = breaker['failures'] + 1
+
+        if breaker['state'] == self.HALF_OPEN or failures >= options.circuit_breaker_threshold:
+            if breaker['state'] != self.OPEN:
+                logging.warning('Requests to {} suspended after {} errors'
+                                .format(host, failures))
+            self._set(host, self.OPEN, failures, self._time())
+        else:
+            self._set(host, breaker['state'], failures)
+
+    def release(self, host):
+        """
+        End the probe allowed while half-open if it has neither succeeded
+        nor failed (e.g. if it was interrupted by an error storing the
+        identifiers), so that another probe is allowed. Must only be called
+        by the probe, see allow.
+        """
+        breaker = self._hosts.get(host)
+        if breaker and breaker['state'] == self.HALF_OPEN:
+            self._set(host, self.OPEN)
+
+    def states(self):
+        """
+        :returns: a dictionary of the state of each host
+        """
+        return {host: dict(breaker) for host, breaker in self._hosts.items()}
+
+    def _set(self, host, state, failures=None, opened=None):
+        breaker = self._hosts.setdefault(host, {'failures': 0, 'opened': None})
+        breaker['state'] = state
+        if failures is not None:
+            breaker['failures'] = failures
+        if opened is not None or state == self.CLOSED:
+            breaker['opened'] = opened
+
+        if self.on_change:
+            self.on_change(host, dict(breaker))
 
 
 class RepositoryStore(object):
-    """Responsible for storing information about repositories"""
+    """
+    Responsible for storing information about repositories
+
+    The repositories are stored in the local database, changes are written
+    every local_db_commit_interval seconds (or once enough repositories have
+    changed) and when the store is closed. The time each repository was last
+    indexed is also published to the status table (if provided) read by the
+    web workers.
+    """
 
-    def __init__(self, repository_dict, api_client=None):
+    def __init__(self, api_client=None, states=None, status=None):
         if api_client is None:
             api_client = API(options.url_accounts,
                              ssl_options=ssl_server_options())
+        if states is None:
+            states = RepositoryStates(options.local_db)
 
-        self._repository_dict = repository_dict
         self._api = api_client
         self._endpoint = self._api.accounts.repositories
-        self._shelf = shelve.open(options.local_db, writeback=True)
+        self._states = states
+        self._status = status
+        self._flush_timeout = None
+        self._synced = None
         self.on_new_repo = None
+        self.on_removed_repo = None
 
     def __enter__(self):
         return self
@@ -230,13 +664,28 @@ class RepositoryStore(object):
         self.close()
 
     def close(self):
-        self._shelf.close()
+        if self._flush_timeout is not None:
+            IOLoop.current().remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        self._states.close()
+
+    def _flush(self):
+        self._flush_timeout = None
+        self._states.flush()
 
     def start(self):
         """
         Starts a worker that periodically requests information about
         repositories from the account service
         """
+        if options.legacy_local_db:
+            self._states.import_shelf(options.legacy_local_db)
+
+        if self._status is not None:
+            for repo_id in self.get_repositories():
+                self._status.set(repo_id, self._get_repository(repo_id).get('last'))
+            self._status.mark_populated()
+
         io_loop = IOLoop.current()
         io_loop.add_callback(self._fetch_repositories_forever)
 
@@ -257,41 +706,155 @@ class RepositoryStore(object):
     @coroutine
     def _fetch_repositories(self):
         """
-        Get repositories from the accounts service and publish new ones to the
-        queue
-
-        TODO: Decide what should happen if a repo is removed from accounts service?
+        Get repositories from the accounts service and synchronise them with
+        the store
+
+        New repositories are published to the queue, the records of changed
+        repositories are updated, and the repositories no longer listed by
+        the accounts service are removed (and unscheduled), except the
+        repositories fetched on their own (see get_repository). A missing
+        repository is only removed once it has been missing for
+        repository_removal_grace seconds, and nothing is removed if the
+        accounts service lists no repositories.
         """
         logging.info('Getting repositories from accounts service')
 
+        synced = time.time()
         try:
-            repositories = yield self._endpoint.get()
+            repositories = yield self._fetch_repository_list()
         except Exception:
             logging.exception('Error fetching repositories')
             raise Return()
 
-        for repo in repositories['data']:
+        if repositories is None:
+            logging.info('Repositories unchanged in accounts service')
+            self._synced = synced
+            raise Return()
+
+        known = self.get_repositories()
+        listed = set()
+        changed = 0
+        for repo in repositories:
             repo_id = str(repo['id'])
+            listed.add(repo_id)
 
-            if repo_id not in self.get_repositories():
+            if repo_id not in known:
+                known.add(repo_id)
                 self._set_repository(repo_id, repo)
                 if self.on_new_repo:
                     logging.info("Adding new repository " + repo_id)
                     yield self.on_new_repo(repo_id)
+                continue
+
+            stored = self._get_repository(repo_id)
+            if (stored.get('unlisted') or 'missing_since' in stored or
+                    any(stored.get(k) != v for k, v in repo.items())):
+                stored.update(repo)
+                stored.pop('unlisted', None)
+                stored.pop('missing_since', None)
+                self._set_repository(repo_id, stored)
+                changed += 1
+
+        removed = 0
+        missing = known - listed
+        if not listed and missing:
+            logging.warning('No repositories listed by accounts service, '
+                            'keeping the known repositories')
+            missing = set()
+
+        for repo_id in missing:
+            stored = self._get_repository(repo_id)
+            if stored.get('unlisted'):
+                continue
+
+            missing_since = stored.get('missing_since', synced)
+            if synced - missing_since >= options.repository_removal_grace:
+                logging.info("Removing repository " + repo_id)
+                self._remove_repository(repo_id)
+                removed += 1
+            elif 'missing_since' not in stored:
+                logging.info("Repository {} no longer listed".format(repo_id))
+                stored['missing_since'] = synced
+                self._set_repository(repo_id, stored)
+
+        self._synced = synced
+        logging.info('{} repositories from accounts service, {} changed, {} removed'
+                     .format(len(listed), changed, removed))
+
+    @coroutine
+    def _fetch_repository_list(self):
+        """
+        Fetch the list of repositories from the accounts service, in pages
+        of accounts_page_size repositories if set. Pages are requested until
+        one is empty, or ends the list (no "next" page in its metadata), as
+        the service may return fewer repositories than requested per page.
+        After the first synchronisation the list is only requested if
+        modified since.
+
+        :returns: a list of repository dictionaries, or None if not modified
+        """
+        kwargs = {}
+        if self._synced is not None:
+            kwargs['headers'] = {'If-Modified-Since': format_timestamp(self._synced)}
+
+        size = options.accounts_page_size
+        try:
+            if not size:
+                response = yield self._endpoint.get(**kwargs)
+                raise Return(response['data'])
+
+            repositories = []
+            seen = set()
+            page = 1
+            while True:
+                response = yield self._endpoint.get(page=page, page_size=size, **kwargs)
+                data = response['data']
+                new = [x for x in data if str(x['id']) not in seen]
+                repositories.extend(new)
+                seen.update(str(x['id']) for x in new)
+
+                # stop if the service does not paginate the repositories
+                if not data or not new:
+                    break
+                metadata = response.get('metadata') or {}
+                if 'next' in metadata and not metadata['next']:
+                    break
+                page += 1
+                kwargs = {}
+        except HTTPError as exc:
+            if exc.code == 304:
+                raise Return(None)
+            raise
+
+        raise Return(repositories)
+
+    def _remove_repository(self, repo_id):
+        """Remove a repository from the store and the schedule"""
+        del self._states[str(repo_id)]
+        if self._status is not None:
+            self._status.remove(str(repo_id))
+        if self.on_removed_repo:
+            self.on_removed_repo(repo_id)
 
     def _set_repository(self, repo_id, repository):
         """Stores shared metadata
         :param repo_id: The repository identifier
         :param repository: The repository record
         """
-        self._repository_dict[repo_id] = repository
-        self._shelf[str(repo_id)] = repository
+        self._states[str(repo_id)] = repository
+        if self._status is not None:
+            self._status.set(str(repo_id), repository.get('last'))
+        if self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().call_later(
+                options.local_db_commit_interval, self._flush)
 
     def fail(self, repo_id, reason=None):
         """
         Record failure to fetch identifiers from a repository
 
-        If a reason is provided then it is used when logging the failure
+        The repository's "backoff" is the delay before it is queried again,
+        see backoff_delay. If a reason is provided then it is used when
+        logging the failure
 
         :param repo_id: the repository ID
         :param reason: (optional) reason for the failure
@@ -300,6 +863,7 @@ class RepositoryStore(object):
         """
         repository = self._get_repository(repo_id)
         repository['errors'] = repository.get('errors', 0) + 1
+        repository['backoff'] = backoff_delay(repository.get('backoff'))
 
         self._set_repository(repo_id, repository)
 
@@ -310,26 +874,60 @@ class RepositoryStore(object):
 
         return repository
 
-    def success(self, repo_id, next_query_start=None):
+    def success(self, repo_id, next_query_start=None, rows=None, pages=None,
+                truncated=False):
         """
         Record success fetching identifiers from a repository
 
-        Resets the error count to 0
+        Resets the error count to 0 and the backoff. If the number of rows and pages fetched
+        are provided the poll is added to the history of the repository (the
+        last poll_history_size polls), a list of dictionaries with the
+        number of "rows" and "pages", the seconds since the previous poll
+        ("interval"), the seconds the query range "moved", None if
+        unknown, and whether there were more pages ("truncated").
 
         :param repo_id: the repository ID
         :param next_query_start: (optional) datetime, the start of the query
             range the next time the repository is queried
+        :param rows: (optional) the number of rows fetched
+        :param pages: (optional) the number of pages fetched
+        :param truncated: (optional) whether the repository had more pages
+            than fetched
         :returns: repository dict
         :raises KeyError: if an unknown repository
         """
         repository = self._get_repository(repo_id)
+        now = datetime.utcnow()
+        if rows is not None:
+            previous_last = repository.get('last')
+            previous_next = repository.get('next')
+            poll = {
+                'rows': rows,
+                'pages': pages,
+                'interval': None,
+                'moved': None,
+                'truncated': truncated
+            }
+            if previous_last:
+                poll['interval'] = (now - previous_last).total_seconds()
+            if previous_next and next_query_start:
+                try:
+                    poll['moved'] = (next_query_start - previous_next).total_seconds()
+                except TypeError:
+                    # comparing a date with a timezone to a date without
+                    pass
+
+            polls = repository.get('polls', []) + [poll]
+            repository['polls'] = polls[-options.poll_history_size:]
+
         changes = {
             'next': next_query_start,
-            'last': datetime.utcnow(),
+            'last': now,
             'errors': 0,
             'successful_queries': repository.get('successful_queries', 0) + 1
         }
         repository.update(changes)
+        repository.pop('backoff', None)
 
         self._set_repository(repo_id, repository)
 
@@ -337,18 +935,51 @@ class RepositoryStore(object):
 
         return repository
 
+    def checkpoint_backfill(self, repo_id, slices):
+        """
+        Store the progress of the backfill of a repository
+
+        :param repo_id: the repository ID
+        :param slices: the date slices (see Manager._backfill_slices), or
+            None once the backfill is done
+        :raises KeyError: if an unknown repository
+        """
+        repository = self._get_repository(repo_id)
+        if slices:
+            repository['backfill'] = slices
+        else:
+            repository.pop('backfill', None)
+
+        self._set_repository(repo_id, repository)
+
+    def set_circuit_breaker(self, host, breaker):
+        """
+        Store the state of the circuit breaker of a repository service host
+
+        :param host: the host
+        :param breaker: a dictionary, see CircuitBreaker
+        """
+        self._states.set_circuit_breaker(host, breaker)
+
+    def circuit_breakers(self):
+        """
+        :returns: the stored states of the circuit breakers, see
+            RepositoryStates.circuit_breakers
+        """
+        return self._states.circuit_breakers()
+
     def get_repositories(self):
         """
-        Returns a list of information related to the the repositories
-        that are to be indexed by this service.
+        Returns a set of the IDs of the repositories that are to be indexed
+        by this service.
         """
-        return self._shelf.keys()
+        return self._states.keys()
 
     def _get_repository(self, repo_id):
         """
         Returns information about a specific repository already known by this service.
         """
-        return self._shelf[str(repo_id)]
+        return self._states[str(repo_id)]
 
     @coroutine
     def _fetch_repository(self, repo_id):
@@ -364,7 +995,9 @@ class RepositoryStore(object):
             try:
                 repo = self._get_repository(repo_id)
             except Exception:
-                repo = {}
+                # not listed by the accounts service, so not removed when
+                # synchronising the list of repositories
+                repo = {'unlisted': True}
 
             repo.update(response['data'])
             self._set_repository(repo_id, repo)
@@ -410,7 +1043,7 @@ class Manager(object):
     service may be polled sooner than scheduled.
 
     The timestamp of the most recent data in the repsoitory service is
-    persisted to disk using the standard library's shelve module. The timestamp
+    persisted to disk in the local database of the repositories. The timestamp
     is used to limit the date range in future requests to the repository
     service.
     """
@@ -421,6 +1054,7 @@ class Manager(object):
         self.repositories = repositories
         self.scheduler = scheduler
         self.repositories.on_new_repo = scheduler.schedule
+        self.repositories.on_removed_repo = scheduler.unschedule
 
         interval = options.default_poll_interval
         self.poll_interval_range = (0.5 * interval, interval)
@@ -429,14 +1063,36 @@ class Manager(object):
             raise ValueError('max_poll_error_delay_factor must be >= 1')
 
         self.max_error_delay_factor = options.max_poll_error_delay_factor
+        self.circuit_breaker = CircuitBreaker(on_change=self.repositories.set_circuit_breaker)
+        self.concurrency = 0
+        self._workers = 0
 
     def start(self):
         """
         Start workers that will fetch identifiers from repositories
         """
+        self.circuit_breaker.load(self.repositories.circuit_breakers())
+
         io_loop = IOLoop.current()
         io_loop.add_callback(self._schedule_all_repositories)
-        io_loop.add_callback(self.fetch_forever)
+        self.set_concurrency(max(1, options.concurrency))
+
+    def set_concurrency(self, concurrency):
+        """
+        Change the number of workers fetching identifiers from repositories.
+        Extra workers stop once they have finished their current fetch.
+
+        :param concurrency: the number of workers
+        """
+        self.concurrency = max(0, concurrency)
+        io_loop = IOLoop.current()
+        while self._workers < self.concurrency:
+            self._workers += 1
+            io_loop.add_callback(self.fetch_forever)
+
+        if self._workers > self.concurrency:
+            # wake up the idle workers so that they stop
+            self.scheduler.wake()
 
     @coroutine
     def _schedule_all_repositories(self):
@@ -464,109 +1120,419 @@ class Manager(object):
             meta = self.repositories.fail(repo_id, msg)
             raise Return(meta)
 
+        host = urlparse.urlparse(location).netloc
+        probe = self.circuit_breaker.allow(host)
+
         from_time = repo.get('next')
-        result_to = yield self._fetch_identifiers(repo_id, from_time, location)
+        slices = repo.get('backfill')
+        if slices is None and from_time is None and options.backfill_slices > 1:
+            slices = self._backfill_slices()
+
+        try:
+            if slices:
+                result = yield self._backfill(repo_id, slices, location, host, probe)
+            else:
+                result = yield self._fetch_identifiers(repo_id, from_time, location, host)
+        finally:
+            if probe:
+                self.circuit_breaker.release(host)
+
+        result_to, rows, pages, truncated = result
 
         if result_to:
             result_to = dateutil.parser.parse(result_to)
 
-        meta = self.repositories.success(repo_id, result_to)
+        meta = self.repositories.success(repo_id, result_to, rows, pages, truncated)
         raise Return(meta)
 
+    def _backfill_slices(self):
+        """
+        Split the range from DEFAULT_FROM_TIME to now into backfill_slices
+        date slices
+
+        :returns: a list of dictionaries with the start ("from") and end
+            ("to") of each slice, the start of the next query ("next") and
+            whether the slice is "done"
+        """
+        start = self.DEFAULT_FROM_TIME
+        end = datetime.utcnow()
+        step = (end - start) / options.backfill_slices
+
+        slices = []
+        for i in range(options.backfill_slices):
+            slices.append({
+                'from': start + i * step,
+                'to': start + (i + 1) * step,
+                'next': None,
+                'done': False
+            })
+        slices[-1]['to'] = end
+
+        return slices
+
+    @coroutine
+    def _backfill(self, repo_id, slices, location, host=None, probe=False):
+        """
+        Fetch the identifiers of a new repository in date slices
+
+        Up to backfill_concurrency slices are fetched concurrently, each
+        for a single poll (see _fetch_pages), then the progress of the slices
+        is checkpointed in the repository. The start of the next query only
+        moves past a slice once all the earlier slices are done. If the
+        fetch is the probe of a half-open circuit breaker a single slice is
+        fetched.
+
+        :returns: a tuple like _fetch_identifiers, the end of the range being
+            where the slices are done up to, and the repository having more
+            pages until all the slices are done
+        :raises: the first error fetching a slice, once the others are done
+        """
+        pending = [x for x in slices if not x['done']]
+        concurrency = 1 if probe else max(1, options.backfill_concurrency)
+        results = yield [self._fetch_slice(repo_id, x, location, host)
+                         for x in pending[:concurrency]]
+
+        done = all(x['done'] for x in slices)
+        self.repositories.checkpoint_backfill(repo_id, None if done else slices)
+
+        errors = [error for error, _, _ in results if error is not None]
+        if errors:
+            raise errors[0]
+
+        for x in slices:
+            if not x['done']:
+                result_to = x['next'] or x['from']
+                break
+        else:
+            result_to = slices[-1]['next'] or slices[-1]['to']
+
+        rows = sum(x[1] for x in results)
+        pages = sum(x[2] for x in results)
+        raise Return((result_to.isoformat(), rows, pages, not done))
+
     @coroutine
-    def _fetch_identifiers(self, repo_id, from_time, location):
+    def _fetch_slice(self, repo_id, date_slice, location, host=None):
+        """
+        Fetch the identifiers of a date slice of a repository, updating its
+        "next" and "done"
+
+        :returns: a tuple of the error (None if successful), and the number
+            of rows and pages stored
+        """
+        try:
+            result_to, rows, pages, truncated = yield self._fetch_identifiers(
+                repo_id, date_slice['next'] or date_slice['from'], location, host,
+                date_slice['to'])
+        except Exception as exc:
+            logging.exception('Error fetching a slice of {}'.format(repo_id))
+            raise Return((exc, 0, 0))
+
+        if result_to:
+            date_slice['next'] = dateutil.parser.parse(result_to)
+        date_slice['done'] = not truncated
+
+        raise Return((None, rows, pages))
+
+    @coroutine
+    def _fetch_identifiers(self, repo_id, from_time, location, host=None, to_time=None):
+        """
+        Fetch pages of identifiers and store them in the index
+
+        The pages are fetched ahead (up to repository_prefetch_pages) while
+        the previous pages are stored, in order. The requests are recorded
+        by the circuit breaker of the host, if provided. If to_time is
+        provided only the identifiers up to to_time are requested.
+
+        :returns: a tuple of the end of the range of the last page stored,
+            the number of rows and pages stored, and whether the repository
+            had more pages than fetched
+        """
         client = yield repository_service_client(location)
         logging.info('Getting IDs for {} from {}'.format(repo_id, location))
 
-        page = 1
         endpoint = client.repository.repositories[repo_id].assets.identifiers
         from_time = from_time or self.DEFAULT_FROM_TIME
         query_dict = {'from': from_time.isoformat()}
+        if to_time:
+            query_dict['to'] = to_time.isoformat()
         result_to = None
+        rows = 0
+        stored = 0
 
-        while page <= options.max_repository_pages:
-            query_dict['page'] = page
-            result = yield endpoint.get(**query_dict)
-            data = result.get('data')
+        pages = PageQueue(maxsize=max(1, options.repository_prefetch_pages))
+        state = {'stopped': False, 'truncated': False}
+        fetching = self._fetch_pages(endpoint, query_dict, pages, state, host)
 
-            if not data:
-                break
+        try:
+            while True:
+                result = yield pages.get()
+                if result is None:
+                    break
+
+                yield self.db.add_entities('asset', result['data'], repo_id)
+                rows += len(result['data'])
+                stored += 1
+                # Store the end of the range for the last query so that it can be
+                # used as the start for the next time the endpoint is queried
+                _, result_to = result['metadata'].get('result_range', (None, None))
+        except Exception:
+            # stop fetching pages, unblocking the producer if the queue is full
+            state['stopped'] = True
+            while pages.qsize():
+                pages.get_nowait()
+            raise
+        finally:
+            if state['stopped']:
+                # wait for the producer to stop, the error storing the pages
+                # is raised rather than its own error
+                try:
+                    yield fetching
+                except Exception:
+                    logging.exception('Error fetching pages from {}'.format(repo_id))
+
+        # raise any error fetching the pages
+        yield fetching
+        raise Return((result_to, rows, stored, state['truncated']))
+
+    @coroutine
+    def _fetch_pages(self, endpoint, query_dict, pages, state, host=None):
+        """
+        Put the pages of identifiers in a queue, followed by None after the
+        last page
+
+        At most max_repository_pages pages are fetched, and no page is
+        requested after repository_poll_time_budget seconds. If pages were
+        left unfetched "truncated" is set in the state, i.e. if the last
+        page fetched links to a next page or, without a link, was full.
+
+        :param endpoint: the identifiers endpoint of the repository
+        :param query_dict: the query parameters
+        :param pages: a queue of pages
+        :param state: a dictionary, the pages are no longer fetched once
+            "stopped" is True
+        :param host: (optional) the host of the repository service, to
+            record the requests in the circuit breaker
+        """
+        io_loop = IOLoop.current()
+        deadline = io_loop.time() + options.repository_poll_time_budget
+        page = 1
+        page_size = 0
+        result = None
+        try:
+            while not state['stopped']:
+                if page > options.max_repository_pages or (page > 1 and io_loop.time() >= deadline):
+                    state['truncated'] = result is None or self._more_pages(result, page_size)
+                    break
+
+                try:
+                    result = yield endpoint.get(page=page, **query_dict)
+                except Exception as exc:
+                    if host is not None:
+                        if is_host_failure(exc):
+                            self.circuit_breaker.failure(host)
+                        elif isinstance(exc, HTTPError):
+                            # the host responded, the error is the repository's
+                            self.circuit_breaker.success(host)
+                    raise
+
+                if host is not None:
+                    self.circuit_breaker.success(host)
+                if not result.get('data') or state['stopped']:
+                    break
+
+                page_size = max(page_size, len(result['data']))
+                yield pages.put(result)
+                page += 1
+        finally:
+            if not state['stopped']:
+                yield pages.put(None)
+
+    @staticmethod
+    def _more_pages(result, page_size):
+        """
+        Whether a repository may have pages after a page
 
-            yield self.db.add_entities('asset', data, repo_id)
-            # Store the end of the range for the last query so that it can be
-            # used as the start for the next time the endpoint is queried
-            _, result_to = result['metadata'].get('result_range', (None, None))
-            page += 1
+        :param result: the last page fetched
+        :param page_size: the number of rows of the largest page fetched
+        """
+        metadata = result.get('metadata') or {}
+        if 'next' in metadata:
+            return bool(metadata['next'])
 
-        raise Return(result_to)
+        return len(result['data']) >= page_size
 
     @coroutine
     def fetch_forever(self):
-        """Fetch entities from repository services and reschedule"""
-        while True:
+        """
+        Worker fetching entities from repository services and rescheduling
+        them, one repository at a time. The worker stops when there are more
+        workers than the concurrency (see set_concurrency).
+        """
+        while self._workers <= self.concurrency:
             try:
-                ids = yield self.scheduler.get(options.concurrency)
-                yield [self.fetch(repo_id) for repo_id in ids]
-                yield sleep(min(options.notification_poll_interval, 1))
+                yield self.scheduler.wait()
+                if self._workers > self.concurrency:
+                    break
+
+                ids = yield self.scheduler.get()
+                for repo_id in ids:
+                    yield self.fetch(repo_id)
             except Exception:
                 logging.exception('Error fetching entities')
-                pass
+                yield sleep(1)
+
+        self._workers -= 1
 
     @coroutine
     def fetch(self, repo_id):
         if repo_id is None:
             raise Return()
 
+        # the repository is released even if fetching it fails unexpectedly,
+        # otherwise it would never be scheduled again
+        delay = None
         try:
             repo_meta = yield self.fetch_identifiers(repo_id)
+            delay = self._next_poll_interval(repo_meta)
         except KeyError:
             # unknown repositories are not rescheduled
-            raise Return(None)
+            pass
+        except CircuitOpenError as exc:
+            # spread the repositories of the host after the timeout
+            logging.info('Repository {} skipped: {}'.format(repo_id, exc))
+            delay = exc.retry_after + random.uniform(0, options.circuit_breaker_timeout)
         except Exception:
-            repo_meta = self.repositories.fail(repo_id)
+            delay = self._next_poll_interval(self.repositories.fail(repo_id))
+        finally:
+            self.scheduler.done(repo_id, delay)
 
-        self.scheduler.schedule(repo_id, self._next_poll_interval(repo_meta))
-        raise Return(repo_id)
+        raise Return(None if delay is None else repo_id)
 
     def _next_poll_interval(self, repo_meta):
         """
         Compute the time to the next poll for this repo.
 
-        If there were no errors this function will return a random float
-        in the poll_interval_range. If there was an error, the interval
-        will be multiplied by the number of errors up to the
-        max_error_delay_factor
+        If there was an error, this function will return the backoff of the
+        repository (see backoff_delay). If the repository had more pages than
+        fetched, it is polled again after the continuation_delay: it is then
+        scheduled after the repositories already due, so that its backlog is
+        fetched in turns with the other repositories. Otherwise the interval
+        is adapted to the history of the polls (see _adapted_poll_interval),
+        or is a random float in the poll_interval_range if there is no
+        history.
+        """
+        if repo_meta.get('errors'):
+            return repo_meta.get('backoff') or backoff_delay()
+
+        polls = repo_meta.get('polls')
+        if not polls:
+            return random.uniform(*self.poll_interval_range)
+
+        if polls[-1].get('truncated'):
+            return options.continuation_delay
+
+        interval = self._adapted_poll_interval(polls)
+        return max(options.min_poll_interval, random.uniform(0.5 * interval, interval))
+
+    @staticmethod
+    def _adapted_poll_interval(polls):
+        """
+        Compute the poll interval from the history of the polls
+
+        If no new rows were fetched (or the query range did not move) during
+        the history, the interval since the last poll is doubled. Otherwise
+        the interval is the time the repository took on average to add a
+        page of rows, ignoring the polls of a backlog (that had more pages
+        than fetched).
+
+        :param polls: the history of the polls, see RepositoryStore.success
+        :returns: seconds, between min_poll_interval and max_poll_interval
         """
-        errors = repo_meta.get('errors', 0)
-        delay_factor = min(errors or 1, self.max_error_delay_factor)
-        return delay_factor * random.uniform(*self.poll_interval_range)
+        last = polls[-1]
+        polls = [x for x in polls if x['interval']]
+        elapsed = sum(x['interval'] for x in polls)
+        pages = sum(x['pages'] for x in polls
+                    if x['rows'] and not x.get('truncated') and
+                    (x['moved'] is None or x['moved'] > 0))
+
+        if not pages:
+            interval = 2 * (last['interval'] or options.default_poll_interval)
+        else:
+            # the average time the repository takes to add a page
+            interval = elapsed / pages
+
+        return min(max(interval, options.min_poll_interval), options.max_poll_interval)
+
+
+# chub's token cache, kept apart from the shared get_token so that its
+# refresh margin can be configured (see configure_tokens)
+request_token = RequestToken()
+# the pending request for a token, shared by concurrent callers
+_token_request = None
+# API client of each repository service location, least recently used first
+_clients = OrderedDict()
+MAX_CLIENTS = 1000
+
+
+def configure_tokens():
+    """
+    A new token is requested token_refresh_margin seconds before the cached
+    token expires
+    """
+    request_token.max_until_expired = options.token_refresh_margin
+
+
+def get_token():
+    """
+    Get a token to read from the repository services. Concurrent callers
+    share a single request when the token is refreshed.
+
+    :returns: a Future resolving to the token
+    """
+    global _token_request
+    if _token_request is None or _token_request.done():
+        _token_request = request_token(
+            options.url_auth, options.service_id,
+            options.client_secret, scope=Read(),
+            ssl_options=ssl_server_options()
+        )
+
+    return _token_request
 
 
 @coroutine
 def repository_service_client(location):
     """
-    get an api client for a repository service
+    get an api client for a repository service, a single client is kept for
+    each location and its token is updated when it is refreshed
     :params location: base url of the repository
     """
-    token = yield get_token(
-        options.url_auth, options.service_id,
-        options.client_secret, scope=Read(),
-        ssl_options=ssl_server_options()
-    )
-    client = API(location, token=token, ssl_options=ssl_server_options())
+    token = yield get_token()
+
+    client = _clients.pop(location, None)
+    if client is None:
+        client = API(location, token=token, ssl_options=ssl_server_options())
+    elif client.token != token:
+        client.token = token
+
+    _clients[location] = client
+    while len(_clients) > MAX_CLIENTS:
+        _clients.popitem(last=False)
+
     raise Return(client)
 
 
-def main(database, repository_dict, notification=None):
+def main(database, notification=None, status=None):
     """
     Main entry point for the process crawling the repositories
     """
     configure_syslog()
     log_config()
+    configure_tokens()
     io_loop = IOLoop.current()
 
     scheduler = Scheduler()
-    with RepositoryStore(repository_dict) as repositorystore:
+    with RepositoryStore(status=status) as repositorystore:
         manager = Manager(database, repositorystore, scheduler)
 
         repositorystore.start()
@@ -590,7 +1556,5 @@ if __name__ == '__main__':
         options.index_db_path,
         options.index_schema)
 
-    repository_dict = dict()
-    notification_q = Queue.Queue()
-    notification = Notification(notification_q)
-    main(db, repository_dict, notification)
+    notification = Notification()
+    main(db, notification)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+from koi import exceptions
+from koi.test_helpers import gen_test
+from mock import MagicMock
+
+from index.controllers.notification_handler import NotificationHandler
+from index.repositories import Notification
+
+
+def make_handler(body):
+    handler = NotificationHandler(MagicMock(), MagicMock(), notification=Notification())
+    handler.get_json_body = MagicMock(return_value=body)
+    handler.finish = MagicMock()
+    return handler
+
+
+@gen_test
+def test_post_invalid_repository_id():
+    handler = make_handler({'id': 1})
+
+    with pytest.raises(exceptions.HTTPError) as exc:
+        yield handler.post()
+
+    assert exc.value.status_code == 400
+    assert not handler.finish.called
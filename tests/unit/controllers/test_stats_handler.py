@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from mock import MagicMock
+
+from index.controllers.stats_handler import StatsHandler
+from index.models.db import DbInterface
+from index.repositories import Notification
+
+
+def test_get_stats():
+    database = DbInterface('url', '8080', '/path/', 'schema')
+    handler = StatsHandler(MagicMock(), MagicMock(), database=database)
+    handler.finish = MagicMock()
+
+    handler.get()
+
+    data = handler.finish.call_args[0][0]['data']
+    assert data['index_db'] == database.client_stats()
+    assert data['lookup_cache'] == database.cache.stats()
+    assert data['notifications'] is None
+
+
+def test_get_notification_stats():
+    notification = Notification()
+    notification.put_nowait('repo1')
+    notification.put_nowait('repo1')
+    handler = StatsHandler(MagicMock(), MagicMock(),
+                           database=DbInterface('url', '8080', '/path/', 'schema'),
+                           notification=notification)
+    handler.finish = MagicMock()
+
+    handler.get()
+
+    data = handler.finish.call_args[0][0]['data']
+    assert data['notifications'] == {
+        'received': 2, 'coalesced': 1, 'dropped': 0, 'delivered': 0}
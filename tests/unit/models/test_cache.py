@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sqlite3
+import time
+
+import pytest
+from mock import patch
+
+from index.models.cache import LookupCache, SharedLookupCache, make_lookup_cache
+
+
+RESULT_A = {
+    'source_id_type': 'type1', 'source_id': 'a',
+    'repositories': [{'repository_id': 'repo1', 'entity_id': 'e1'}],
+    'relations': [{'to': {'repository_id': 'repo2', 'entity_id': 'e2'},
+                   'via': {}}]
+}
+
+
+@pytest.fixture(params=['local', 'shared'])
+def make_cache(request, tmpdir):
+    """Returns a function creating either a LookupCache or a SharedLookupCache"""
+    def func(size, ttl, **kwargs):
+        if request.param == 'local':
+            return LookupCache(size, ttl, **kwargs)
+        return SharedLookupCache(str(tmpdir.join('cache.db')), size, ttl, **kwargs)
+
+    return func
+
+
+def test_get_missing(make_cache):
+    cache = make_cache(10, 60)
+
+    with pytest.raises(KeyError):
+        cache.get(('type1', 'a', 0))
+
+    assert cache.stats()['misses'] == 1
+
+
+def test_set_get(make_cache):
+    cache = make_cache(10, 60)
+    cache.set(('type1', 'a', 0), RESULT_A)
+    cache.set(('type1', 'b', 0), None)
+
+    assert cache.get(('type1', 'a', 0)) == RESULT_A
+    assert cache.get(('type1', 'b', 0)) is None
+    assert cache.stats()['hits'] == 2
+
+
+def test_set_many(make_cache):
+    cache = make_cache(10, 60)
+    cache.set_many([(('type1', 'a', 0), RESULT_A), (('type1', 'b', 0), None)])
+
+    assert cache.get(('type1', 'a', 0)) == RESULT_A
+    assert cache.get(('type1', 'b', 0)) is None
+    cache.invalidate_repository('repo2')
+    assert ('type1', 'a', 0) not in cache
+
+
+def test_shared_set_many_single_transaction(tmpdir):
+    cache = SharedLookupCache(str(tmpdir.join('cache.db')), 10, 60)
+    with patch.object(cache, '_transaction', wraps=cache._transaction) as transaction:
+        cache.set_many([(('type1', x, 0), None) for x in 'abc'])
+
+    assert transaction.call_count == 1
+    assert len(cache) == 3
+
+
+def test_disabled(make_cache):
+    cache = make_cache(0, 60)
+    cache.set(('type1', 'a', 0), RESULT_A)
+
+    assert len(cache) == 0
+
+
+def test_expired(make_cache):
+    now = [0]
+    cache = make_cache(10, 60, timer=lambda: now[0])
+    cache.set(('type1', 'a', 0), RESULT_A)
+
+    now[0] = 60
+    with pytest.raises(KeyError):
+        cache.get(('type1', 'a', 0))
+
+
+def test_expired_removed():
+    now = [0]
+    cache = LookupCache(10, 60, timer=lambda: now[0])
+    cache.set(('type1', 'a', 0), RESULT_A)
+
+    now[0] = 60
+    with pytest.raises(KeyError):
+        cache.get(('type1', 'a', 0))
+
+    assert len(cache) == 0
+    assert cache._by_repository == {}
+
+
+def test_least_recently_used_evicted():
+    cache = LookupCache(2, 60)
+    cache.set(('type1', 'a', 0), None)
+    cache.set(('type1', 'b', 0), None)
+    cache.get(('type1', 'a', 0))
+    cache.set(('type1', 'c', 0), None)
+
+    assert ('type1', 'a', 0) in cache
+    assert ('type1', 'b', 0) not in cache
+    assert ('type1', 'c', 0) in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_shared_first_expiring_evicted(tmpdir):
+    now = [0]
+    cache = SharedLookupCache(str(tmpdir.join('cache.db')), 2, 60,
+                              timer=lambda: now[0])
+    cache.EVICTION_INTERVAL = 1
+    for i, source_id in enumerate(['a', 'b', 'c']):
+        now[0] = i
+        cache.set(('type1', source_id, 0), None)
+
+    assert ('type1', 'a', 0) not in cache
+    assert ('type1', 'b', 0) in cache
+    assert ('type1', 'c', 0) in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_repository(make_cache):
+    cache = make_cache(10, 60)
+    cache.set(('type1', 'a', 0), RESULT_A)
+    cache.set(('type1', 'b', 0), None)
+
+    # repo2 is only referred to by a relation
+    cache.invalidate_repository('repo2')
+
+    assert ('type1', 'a', 0) not in cache
+    assert ('type1', 'b', 0) in cache
+    assert cache.stats()['invalidations'] == 1
+
+    cache.invalidate_repository('repo1')
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_invalidate_ids_all_depths(make_cache):
+    cache = make_cache(10, 60)
+    cache.set(('type1', 'a', 0), RESULT_A)
+    cache.set(('type1', 'a', 2), RESULT_A)
+    cache.set(('type1', 'b', 0), None)
+
+    cache.invalidate_ids([('type1', 'a'), ('type1', 'unknown')])
+
+    assert len(cache) == 1
+    assert ('type1', 'b', 0) in cache
+
+
+def test_shared_between_processes(tmpdir):
+    """Entries and invalidations are visible to other processes"""
+    path = str(tmpdir.join('cache.db'))
+    worker = SharedLookupCache(path, 10, 60)
+    crawler = SharedLookupCache(path, 10, 60)
+
+    worker.set(('type1', 'a', 0), RESULT_A)
+    assert crawler.get(('type1', 'a', 0)) == RESULT_A
+
+    crawler.invalidate_repository('repo1')
+    with pytest.raises(KeyError):
+        worker.get(('type1', 'a', 0))
+
+
+@patch.object(SharedLookupCache, 'INVALIDATION_TIMEOUT', 0.05)
+def test_shared_locked_writes_skipped(tmpdir):
+    """Writes do not wait for a lock held by another process"""
+    path = str(tmpdir.join('cache.db'))
+    cache = SharedLookupCache(path, 10, 60)
+    cache.set(('type1', 'a', 0), RESULT_A)
+
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        start = time.time()
+        cache.set(('type1', 'b', 0), None)
+        assert not cache.remove(('type1', 'a', 0))
+        cache.clear()
+        assert time.time() - start < 1
+    finally:
+        other.execute('ROLLBACK')
+
+    assert cache.get(('type1', 'a', 0)) == RESULT_A
+    with pytest.raises(KeyError):
+        cache.get(('type1', 'b', 0))
+
+
+def test_shared_reconnects_after_fork(tmpdir):
+    cache = SharedLookupCache(str(tmpdir.join('cache.db')), 10, 60)
+    connection = cache.connection
+
+    cache._pid = os.getpid() + 1
+
+    assert cache.connection is not connection
+
+
+def test_make_lookup_cache(tmpdir):
+    assert isinstance(make_lookup_cache(10, 60), LookupCache)
+    assert isinstance(make_lookup_cache(10, 60, str(tmpdir.join('cache.db'))),
+                      SharedLookupCache)
@@ -21,11 +21,16 @@ import re
 import json
 from functools import partial
 import pytest
+import rdflib
 from koi import exceptions
 from koi.test_helpers import make_future
 from mock import patch, Mock
 from tornado import ioloop, gen
-from index.models.db import DbInterface, HTTPError
+from tornado.httpclient import HTTPResponse
+from tornado.options import options
+from index.models.db import (DbInterface, CSVResultParser, HTTPError,
+                             HUB_KEY, SPARQL_PREFIXES, TURTLE_PREFIXES)
+from index.models.fingerprints import IngestFingerprints
 
 
 VALID_ENTITY_ID1 = '37cd1397e0814e989fa22da6b15fec60'
@@ -37,6 +42,14 @@ VALID_HUBKEY2 = "https://opp.org/s1/hub1/37cd1397e0814e989fa22da6b15fec51/asset/
 INVALID_HUBKEY = "https://opp.org/s1/hub1/invalidrepo/asset/invalidentityid"
 
 
+@pytest.yield_fixture(autouse=True)
+def lookup_cache_path(tmpdir):
+    """Each test has its own shared lookup cache"""
+    path = str(tmpdir.join('lookup_cache.db'))
+    with patch.object(options.mockable(), 'lookup_cache_path', path):
+        yield path
+
+
 def test_set_database_url_port():
     db_interface = DbInterface('url', '8080', '/path/', 'schema')
     assert "8080" in db_interface.db_url
@@ -57,6 +70,86 @@ def test_set_database_url_schema():
     assert "schema" in db_interface.db_url
 
 
+@patch('index.models.db.CurlAsyncHTTPClient', None)
+@patch('index.models.db.AsyncHTTPClient')
+def test_client_is_shared(async):
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    async.return_value.io_loop = ioloop.IOLoop.current()
+
+    client = db_interface.client
+
+    assert db_interface.client is client
+    async.assert_called_once_with(
+        io_loop=ioloop.IOLoop.current(),
+        force_instance=True,
+        max_clients=options.index_db_max_clients,
+        defaults={'connect_timeout': options.index_db_connect_timeout})
+
+
+@patch('index.models.db.CurlAsyncHTTPClient', None)
+@patch('index.models.db.AsyncHTTPClient')
+def test_client_created_for_new_ioloop(async):
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    other_loop = ioloop.IOLoop()
+    async.return_value.io_loop = other_loop
+
+    db_interface.client
+    db_interface.client
+    other_loop.close()
+
+    assert async.call_count == 2
+
+
+@patch.object(options.mockable(), 'index_db_max_clients', 1)
+def test_client_stats():
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface._client = Mock(io_loop=ioloop.IOLoop.current())
+    response = gen.Future()
+    db_interface._client.fetch.return_value = response
+    assert db_interface.client_stats() == {
+        'active': 0, 'queued': 0, 'max_clients': 1}
+
+    @gen.coroutine
+    def func():
+        first = db_interface._fetch('url')
+        second = db_interface._fetch('url')
+        yield gen.moment
+        stats = db_interface.client_stats()
+        response.set_result('response')
+        yield [first, second]
+        raise gen.Return(stats)
+
+    stats = ioloop.IOLoop.current().run_sync(func)
+
+    assert stats == {'active': 1, 'queued': 1, 'max_clients': 1}
+    assert db_interface.client_stats() == {
+        'active': 0, 'queued': 0, 'max_clients': 1}
+
+
+@patch.object(options.mockable(), 'index_db_max_clients', 1)
+def test_fetch_timeout_includes_queue():
+    """A request times out after request_timeout, even if still queued"""
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface._client = Mock(io_loop=ioloop.IOLoop.current())
+    response = gen.Future()
+    db_interface._client.fetch.return_value = response
+
+    @gen.coroutine
+    def func():
+        first = db_interface._fetch('url')
+        with pytest.raises(HTTPError) as exc:
+            yield db_interface._fetch('url', request_timeout=0.01)
+        response.set_result('response')
+        yield first
+        raise gen.Return(exc.value)
+
+    error = ioloop.IOLoop.current().run_sync(func)
+
+    assert error.code == 599
+    assert db_interface._client.fetch.call_count == 1
+    assert db_interface.client_stats()['queued'] == 0
+
+
 @patch('index.models.db.logging.error')
 @patch('index.models.db.AsyncHTTPClient')
 def test_create_namespace(async, error):
@@ -77,6 +170,28 @@ def test_create_namespace(async, error):
     assert not error.called
 
 
+@patch('index.models.db.AsyncHTTPClient')
+def test_create_namespace_clears_fingerprints(async):
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface.fingerprints = Mock()
+    async().fetch.return_value = make_future(None)
+
+    db_interface.create_namespace()
+
+    db_interface.fingerprints.clear.assert_called_once_with()
+
+
+@patch('index.models.db.AsyncHTTPClient')
+def test_create_namespace_already_exists_keeps_fingerprints(async):
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface.fingerprints = Mock()
+    async().fetch.side_effect = HTTPError(409)
+
+    db_interface.create_namespace()
+
+    assert not db_interface.fingerprints.clear.called
+
+
 @patch('index.models.db.logging.error')
 @patch('index.models.db.AsyncHTTPClient')
 def test_create_namespace_generic_error(async, error):
@@ -129,7 +244,19 @@ DATA0BAD = [
 ]
 
 
-@patch('index.models.db.DbInterface.store')
+def mock_store():
+    """Mock store consuming the data, as the database would"""
+    store = Mock()
+
+    def consume(data, content_type):
+        store.body = ''.join(data)
+        return make_future(True)
+
+    store.side_effect = consume
+    return store
+
+
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
 def test_add_entities(store):
     store.return_value = make_future([])
 
@@ -142,13 +269,12 @@ def test_add_entities(store):
 
     errors = ioloop.IOLoop().run_sync(add_entities)
 
-    assert (len(store.call_args[0][0].strip()) > 0)
+    assert (len(store.body.strip()) > 0)
     assert errors == {'errors': [], 'records': 2}
 
 
-@patch('index.models.db.DbInterface.store')
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
 def test_add_partial_invalid_entities(store):
-    store.return_value = make_future([])
 
     db_interface = DbInterface('url', '8080', '/path/', 'schema')
 
@@ -159,14 +285,13 @@ def test_add_partial_invalid_entities(store):
 
     errors = ioloop.IOLoop().run_sync(add_entities)
 
-    assert (len(store.call_args[0][0].strip()) > 0)
+    assert (len(store.body.strip()) > 0)
     assert errors['records'] == 2
     assert len(errors['errors']) == 1
 
 
-@patch('index.models.db.DbInterface.store')
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
 def test_add_entities_empty_data(store):
-    store.return_value = make_future([])
 
     db_interface = DbInterface('url', '8080', '/path/', 'schema')
 
@@ -177,7 +302,7 @@ def test_add_entities_empty_data(store):
 
     errors = ioloop.IOLoop().run_sync(add_entities)
 
-    assert (len(store.call_args[0][0].strip()) > 0)
+    assert (len(store.body.strip()) > 0)
     assert errors['errors'] == []
 
 
@@ -198,7 +323,7 @@ def test_bulk_repositories():
     result = ioloop.IOLoop().run_sync(func)
 
     assert result == [1, 2]
-    db._query_ids.assert_called_once_with(ids, 0)
+    db._query_ids.assert_called_once_with(ids, 0, 'union')
 
 
 def test_bulk_repositories_with_errors():
@@ -226,6 +351,95 @@ def test_bulk_repositories_with_errors():
     assert not db._query_ids.called
 
 
+def mock_run_query(rows):
+    """
+    Return a mock of DbInterface._run_query streaming rows to the row_callback
+    """
+    def run_query(query, row_callback=None):
+        if row_callback is None:
+            return make_future(rows)
+        for row in rows:
+            row_callback(dict(row))
+        return make_future(len(rows))
+
+    return Mock(side_effect=run_query)
+
+
+def test_csv_result_parser():
+    rows = []
+    parser = CSVResultParser(rows.append)
+    body = (b'source_id,relations\r\n'
+            b'a,"[{""x"": ""1,2""}]"\r\n'
+            b'b,"multi\r\nline"\r\n'
+            b'c,last')
+
+    # feed the body in small chunks splitting rows and quoted values
+    for i in range(0, len(body), 7):
+        parser.feed(body[i:i + 7])
+    parser.close()
+
+    assert parser.rows == 3
+    assert rows == [
+        {'source_id': 'a', 'relations': '[{"x": "1,2"}]'},
+        {'source_id': 'b', 'relations': 'multi\r\nline'},
+        {'source_id': 'c', 'relations': 'last'},
+    ]
+
+
+def test_csv_result_parser_empty_result():
+    rows = []
+    parser = CSVResultParser(rows.append)
+    parser.feed(b'source_id,relations\r\n')
+    parser.close()
+
+    assert parser.rows == 0
+    assert rows == []
+
+
+def test_run_query_streams_rows():
+    db = DbInterface('url', '8080', '/path/', 'schema')
+
+    def fetch(url, streaming_callback=None, **kwargs):
+        streaming_callback(b'source_id,source_id_type\r\na,')
+        streaming_callback(b'b\r\nc,d\r\n')
+        return make_future(Mock())
+
+    db._fetch = Mock(side_effect=fetch)
+    rows = []
+
+    func = partial(db._run_query, 'SELECT ...', row_callback=rows.append)
+    result = ioloop.IOLoop().run_sync(func)
+
+    assert result == 2
+    assert rows == [{'source_id': 'a', 'source_id_type': 'b'},
+                    {'source_id': 'c', 'source_id_type': 'd'}]
+
+
+def test_run_query_streamed_error():
+    """The body of an error response is not parsed as a result set"""
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    request = Mock()
+
+    def fetch(url, header_callback=None, streaming_callback=None, **kwargs):
+        header_callback(b'HTTP/1.1 500 Server Error\r\n')
+        header_callback(b'Content-Type: text/plain\r\n')
+        streaming_callback(b'java.lang.RuntimeException: \n')
+        streaming_callback(b'MalformedQueryException\n')
+        response = HTTPResponse(request, 500)
+        raise HTTPError(500, response=response)
+
+    db._fetch = Mock(side_effect=fetch)
+    rows = []
+
+    func = partial(db._run_query, 'SELECT ...', row_callback=rows.append)
+    with pytest.raises(HTTPError) as exc:
+        ioloop.IOLoop().run_sync(func)
+
+    assert rows == []
+    assert exc.value.code == 500
+    assert exc.value.response.body == (b'java.lang.RuntimeException: \n'
+                                       b'MalformedQueryException\n')
+
 def test_get_repositories_for_ids():
     """
     Test the query result is formatted correctly
@@ -243,8 +457,7 @@ def test_get_repositories_for_ids():
     ]
     db = DbInterface('url', '8080', '/path/', 'schema')
     # mock methods that should be called
-    db._run_query = Mock()
-    db._run_query.return_value = make_future([
+    db._run_query = mock_run_query([
         {'source_id': 'asset1', 'source_id_type': 'type1',
          'repositories': json.dumps([{'repository_id': 'repo1'}]),
          'relations': json.dumps([])
@@ -297,8 +510,7 @@ def test_get_repositories_for_ids_with_keys_not_found():
     db = DbInterface('url', '8080', '/path/', 'schema')
 
     # mock methods that should be called
-    db._run_query = Mock()
-    db._run_query.return_value = make_future([{
+    db._run_query = mock_run_query([{
         'source_id': 'asset1',
         'source_id_type': 'type1',
         'repositories': json.dumps([{'id': 'repo1'}]),
@@ -336,8 +548,7 @@ def test_get_repositories_with_utf8_ids():
     ]
     db = DbInterface('url', '8080', '/path/', 'schema')
     # mock methods that should be called
-    db._run_query = Mock()
-    db._run_query.return_value = make_future([{
+    db._run_query = mock_run_query([{
         'source_id': 'b%E2%82%AC',
         'source_id_type': 'som%E2%82%ACthing',
         'repositories': json.dumps([]),
@@ -353,3 +564,418 @@ def test_get_repositories_with_utf8_ids():
         'repositories': [],
         'relations': []
     }]
+
+
+@patch.object(options.mockable(), 'bulk_query_chunk_size', 2)
+def test_get_repositories_for_ids_in_chunks():
+    """Test large requests are split into chunks and the order is kept"""
+    ids = [{'source_id': 'id%d' % i, 'source_id_type': 'type1'}
+           for i in range(5)]
+    db = DbInterface('url', '8080', '/path/', 'schema')
+
+    # results are returned in reverse order, only odd ids are in the index
+    db._run_query = mock_run_query([
+        {'source_id': 'id%d' % i, 'source_id_type': 'type1',
+         'repositories': json.dumps([{'repository_id': 'repo%d' % i}]),
+         'relations': json.dumps([])}
+        for i in reversed(range(5)) if i % 2
+    ])
+
+    func = partial(db._query_ids, ids)
+    res = ioloop.IOLoop().run_sync(func)
+
+    assert db._run_query.call_count == 3
+    assert [x['source_id'] for x in res] == ['id0', 'id1', 'id2', 'id3', 'id4']
+    assert [x['repositories'] for x in res] == [
+        [], [{'repository_id': 'repo1'}], [],
+        [{'repository_id': 'repo3'}], []]
+
+
+@patch.object(options.mockable(), 'bulk_query_chunk_size', 1)
+@patch.object(options.mockable(), 'bulk_query_concurrency', 2)
+def test_get_repositories_for_ids_concurrency_limit():
+    """Test no more than bulk_query_concurrency chunks are queried at once"""
+    ids = [{'source_id': 'id%d' % i, 'source_id_type': 'type1'}
+           for i in range(5)]
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    running = {'now': 0, 'max': 0}
+
+    @gen.coroutine
+    def run_query(query, row_callback=None):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        yield gen.moment
+        running['now'] -= 1
+        raise gen.Return(0)
+
+    db._run_query = run_query
+
+    func = partial(db._query_ids, ids)
+    res = ioloop.IOLoop().run_sync(func)
+
+    assert running['max'] == 2
+    assert len(res) == 5
+
+
+INDEX_TTL = """
+<https://digicat.io/ns/xid/type1/a> chubindex:id "a"^^xsd:string ;
+    chubindex:id_type "type1"^^xsd:string .
+<https://digicat.io/ns/xid/type2/b> chubindex:id "b"^^xsd:string ;
+    chubindex:id_type "type2"^^xsd:string .
+id:%s op:alsoIdentifiedBy <https://digicat.io/ns/xid/type1/a> ;
+    chubindex:repo "repo1"^^xsd:string .
+id:%s op:alsoIdentifiedBy <https://digicat.io/ns/xid/type1/a>,
+                          <https://digicat.io/ns/xid/type2/b> ;
+    chubindex:repo "repo2"^^xsd:string .
+""" % (VALID_ENTITY_ID1, VALID_ENTITY_ID2)
+
+
+@pytest.mark.parametrize('related_depth', [0, 1, 2])
+def test_values_plan_matches_union_plan(related_depth):
+    """Run both query plans against an in memory graph"""
+    graph = rdflib.Graph()
+    graph.parse(data=TURTLE_PREFIXES + INDEX_TTL, format='turtle')
+    ids = [{'source_id': 'a', 'source_id_type': 'type1'},
+           {'source_id': 'b', 'source_id_type': 'type2'},
+           {'source_id': VALID_ENTITY_ID1, 'source_id_type': 'hub_key'}]
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    results = {}
+
+    def run_query(query, row_callback=None):
+        for row in graph.query(SPARQL_PREFIXES + query):
+            row = {k: unicode(v) for k, v in row.asdict().items()}
+            # ignore unbound group values (rdflib specific)
+            if 'not bound' not in row.get('relations', ''):
+                row_callback(row)
+        return make_future(None)
+
+    db._run_query = run_query
+    for plan in ['union', 'values']:
+        func = partial(db._query_chunk, ids, related_depth, plan)
+        results[plan] = ioloop.IOLoop().run_sync(func)
+
+    assert results['values'].keys() == results['union'].keys()
+    for key, value in results['union'].items():
+        assert (sorted(results['values'][key]['repositories']) ==
+                sorted(value['repositories']))
+        assert (sorted(results['values'][key]['relations']) ==
+                sorted(value['relations']))
+
+
+def test_values_plan_query_size():
+    """The values plan uses the same joins whatever the number of ids"""
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    queries = [
+        db._format_values_query([{'source_id': 'id%d' % i, 'source_id_type': 'type1'}
+                                 for i in range(n)], 2)
+        for n in [1, 100]
+    ]
+
+    for token in ['VALUES', 'UNION', '^op:alsoIdentifiedBy ?entity_uri']:
+        assert queries[0].count(token) == queries[1].count(token)
+
+
+def test_query_unknown_plan():
+    ids = [{'source_id': 'b', 'source_id_type': 'something'}]
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    db._query_ids = Mock()
+
+    func = partial(db.query, ids, 0, 'unknown')
+    with pytest.raises(exceptions.HTTPError) as exc:
+        ioloop.IOLoop().run_sync(func)
+
+    assert exc.value.status_code == 400
+    assert not db._query_ids.called
+
+
+def test_get_repositories_for_ids_cached():
+    """Test ids are only queried once, including ids not in the index"""
+    ids = [{'source_id': 'asset1', 'source_id_type': 'type1'},
+           {'source_id': 'b', 'source_id_type': 'something'}]
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    db._run_query = mock_run_query([{
+        'source_id': 'asset1',
+        'source_id_type': 'type1',
+        'repositories': json.dumps([{'repository_id': 'repo1'}]),
+        'relations': json.dumps([])
+    }])
+
+    func = partial(db._query_ids, [x.copy() for x in ids])
+    first = ioloop.IOLoop().run_sync(func)
+    func = partial(db._query_ids, [x.copy() for x in ids])
+    second = ioloop.IOLoop().run_sync(func)
+
+    assert db._run_query.call_count == 1
+    assert first == second
+    assert db.cache.stats()['hits'] == 2
+
+
+def test_get_repositories_for_ids_cache_stats_not_logged():
+    """The cache stats (a query of the shared cache) are only computed for debug logs"""
+    db = DbInterface('url', '8080', '/path/', 'schema')
+    db._run_query = mock_run_query([])
+    db.cache = Mock(wraps=db.cache)
+
+    with patch('index.models.db.logging.getLogger') as getLogger:
+        getLogger.return_value.isEnabledFor.return_value = False
+        func = partial(db._query_ids, [{'source_id': 'b', 'source_id_type': 'something'}])
+        ioloop.IOLoop().run_sync(func)
+
+    assert not db.cache.stats.called
+    assert db.cache.set_many.call_count == 1
+
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
+def test_add_entities_invalidates_cache(store):
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface.cache.set(('my_id_type', 'my_id', 0), None)
+    db_interface.cache.set((HUB_KEY, VALID_ENTITY_ID2, 1), None)
+    db_interface.cache.set(('other', 'x', 0),
+                           {'repositories': [{'repository_id': 'repo2'}]})
+    db_interface.cache.set(('other', 'y', 0),
+                           {'repositories': [{'repository_id': 'repo3'}]})
+
+    func = partial(db_interface.add_entities, 'asset', DATA0, 'repo2')
+    ioloop.IOLoop().run_sync(func)
+
+    assert len(db_interface.cache) == 1
+    assert ('other', 'y', 0) in db_interface.cache
+
+
+@patch.object(options.mockable(), 'store_chunk_size', 100)
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
+def test_add_entities_chunks(store):
+    """The turtle is generated in chunks while it is stored"""
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    data = [{'source_id_type': 'my_id_type', 'source_id': 'my_id%d' % i,
+             'entity_id': VALID_ENTITY_ID1} for i in range(10)]
+    chunks = []
+
+    def consume(data, content_type):
+        chunks.extend(data)
+        return make_future(None)
+
+    store.side_effect = consume
+    func = partial(db_interface.add_entities, 'asset', data, 'repo2')
+    result = ioloop.IOLoop().run_sync(func)
+
+    assert result == {'errors': [], 'records': 10}
+    assert len(chunks) == 10
+    graph = rdflib.Graph()
+    graph.parse(data=''.join(chunks), format='turtle')
+    assert len(set(graph.objects(predicate=rdflib.URIRef(
+        'http://digicat.io/ns/chubindex/1.0/id')))) == 10
+
+
+def test_store_streams_chunks():
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    db_interface._client = Mock(io_loop=ioloop.IOLoop.current())
+    db_interface._client.fetch.return_value = make_future(None)
+    written = []
+
+    def write(chunk):
+        written.append(chunk)
+        return make_future(None)
+
+    func = partial(db_interface.store, iter(['a', 'b']), 'text/turtle')
+    ioloop.IOLoop.current().run_sync(func)
+
+    kwargs = db_interface._client.fetch.call_args[1]
+    assert 'body' not in kwargs
+    ioloop.IOLoop.current().run_sync(partial(kwargs['body_producer'], write))
+    assert written == [b'a', b'b']
+
+
+class MockCurlClient(Mock):
+    pass
+
+
+@patch.object(options.mockable(), 'index_db_use_curl', True)
+@patch('index.models.db.SimpleAsyncHTTPClient')
+@patch('index.models.db.CurlAsyncHTTPClient', MockCurlClient)
+def test_store_streams_chunks_with_curl(simple):
+    """The curl client does not stream request bodies, the simple client is used"""
+    db_interface = DbInterface('url', '8080', '/path/', 'schema')
+    curl = db_interface.client
+    assert isinstance(curl, MockCurlClient)
+    curl.io_loop = ioloop.IOLoop.current()
+    simple.return_value.io_loop = ioloop.IOLoop.current()
+    simple.return_value.fetch.return_value = make_future(None)
+
+    func = partial(db_interface.store, iter(['a', 'b']), 'text/turtle')
+    assert ioloop.IOLoop.current().run_sync(func)
+
+    assert not curl.fetch.called
+    kwargs = simple.return_value.fetch.call_args[1]
+    assert 'body' not in kwargs
+    assert 'body_producer' in kwargs
+    assert db_interface.stream_client is simple.return_value
+    assert simple.call_count == 1
+
+def graph_db(ttl):
+    """DbInterface running queries and updates against an in memory graph"""
+    graph = rdflib.Graph()
+    graph.parse(data=TURTLE_PREFIXES + ttl, format='turtle')
+    db = DbInterface('url', '8080', '/path/', 'schema')
+
+    def run_query(query, row_callback=None):
+        rows = [{k: unicode(v) for k, v in row.asdict().items()}
+                for row in graph.query(SPARQL_PREFIXES + query)]
+        return make_future(rows)
+
+    def run_update(query):
+        graph.update(SPARQL_PREFIXES + query)
+        return make_future([])
+
+    db._run_query = Mock(side_effect=run_query)
+    db._run_update = Mock(side_effect=run_update)
+
+    return graph, db
+
+
+def test_delete_keeps_shared_ids():
+    graph, db = graph_db(INDEX_TTL)
+    ids = [{'source_id': 'a', 'source_id_type': 'type1'}]
+
+    func = partial(db.delete, 'asset', ids, 'repo1')
+    ioloop.IOLoop().run_sync(func)
+
+    subjects = {unicode(s).split('/')[-1] for s in graph.subjects()}
+    assert VALID_ENTITY_ID1 not in subjects
+    assert VALID_ENTITY_ID2 in subjects
+    assert {'a', 'b'} <= subjects
+
+
+def test_delete_removes_unused_ids():
+    graph, db = graph_db(INDEX_TTL)
+    ids = [{'source_id': 'a', 'source_id_type': 'type1'},
+           {'source_id': 'b', 'source_id_type': 'type2'}]
+
+    func = partial(db.delete, 'asset', ids, 'repo2')
+    ioloop.IOLoop().run_sync(func)
+
+    subjects = {unicode(s).split('/')[-1] for s in graph.subjects()}
+    assert subjects == {VALID_ENTITY_ID1, 'a'}
+
+
+def test_delete_round_trips():
+    """The number of requests does not depend on the number of entities"""
+    ttl = ''.join("""
+<https://digicat.io/ns/xid/type1/id%(i)d> chubindex:id "id%(i)d"^^xsd:string ;
+    chubindex:id_type "type1"^^xsd:string .
+id:entity%(i)d op:alsoIdentifiedBy <https://digicat.io/ns/xid/type1/id%(i)d>,
+                                   <https://digicat.io/ns/xid/type1/a> ;
+    chubindex:repo "repo1"^^xsd:string .
+""" % {'i': i} for i in range(3))
+    graph, db = graph_db(INDEX_TTL + ttl)
+    ids = [{'source_id': 'a', 'source_id_type': 'type1'},
+           {'source_id': 'id1', 'source_id_type': 'type1'}]
+
+    func = partial(db.delete, 'asset', ids, 'repo1')
+    ioloop.IOLoop().run_sync(func)
+
+    subjects = {unicode(s).split('/')[-1] for s in graph.subjects()}
+    assert 'entity1' not in subjects
+    assert 'id1' not in subjects
+    assert {'entity0', 'entity2', 'a'} <= subjects
+    assert db._run_query.call_count == 2
+    assert db._run_update.call_count == 1
+
+
+def test_delete_no_matching_entities():
+    graph, db = graph_db(INDEX_TTL)
+    ids = [{'source_id': 'c', 'source_id_type': 'type1'}]
+
+    func = partial(db.delete, 'asset', ids, 'repo1')
+    ioloop.IOLoop().run_sync(func)
+
+    assert db._run_query.call_count == 1
+    assert not db._run_update.called
+
+
+def test_delete_many():
+    graph, db = graph_db(INDEX_TTL)
+    items = [
+        [{'source_id': 'a', 'source_id_type': 'type1'}],
+        [{'source_id': 'c', 'source_id_type': 'type1'}],
+        [{'source_id': 'a'}],
+        'a',
+        [{'id': 'a', 'id_type': 'type1'}, {'id': 'b', 'id_type': 'type2'}]
+    ]
+
+    func = partial(db.delete_many, 'asset', items, 'repo2')
+    results = ioloop.IOLoop().run_sync(func)
+
+    assert results == [
+        {'status': 200, 'deleted': 0},
+        {'status': 200, 'deleted': 0},
+        {'status': 400, 'errors': [{'source_id': 'a'}]},
+        {'status': 400, 'errors': ['a']},
+        {'status': 200, 'deleted': 1}
+    ]
+    subjects = {unicode(s).split('/')[-1] for s in graph.subjects()}
+    assert subjects == {VALID_ENTITY_ID1, 'a'}
+    assert db._run_query.call_count == 2
+    assert db._run_update.call_count == 1
+
+
+@patch.object(options.mockable(), 'bulk_delete_chunk_size', 1)
+def test_delete_many_chunk_error():
+    graph, db = graph_db(INDEX_TTL)
+    run_query = db._run_query.side_effect
+
+    def fail_first(query, row_callback=None):
+        if db._run_query.call_count == 1:
+            raise HTTPError(500)
+        return run_query(query, row_callback)
+
+    db._run_query.side_effect = fail_first
+    items = [[{'source_id': 'a', 'source_id_type': 'type1'},
+              {'source_id': 'b', 'source_id_type': 'type2'}],
+             [{'source_id': 'a', 'source_id_type': 'type1'}]]
+
+    func = partial(db.delete_many, 'asset', items, 'repo1')
+    results = ioloop.IOLoop().run_sync(func)
+
+    assert results[0]['status'] == 500
+    assert results[1] == {'status': 200, 'deleted': 1}
+    subjects = {unicode(s).split('/')[-1] for s in graph.subjects()}
+    assert subjects == {VALID_ENTITY_ID2, 'a', 'b'}
+
+
+@patch('index.models.db.DbInterface.store', new_callable=mock_store)
+def test_add_entities_skips_ingested(store, tmpdir):
+    path = str(tmpdir.join('fingerprints.db'))
+    with patch.object(options.mockable(), 'ingest_fingerprints_path', path):
+        db_interface = DbInterface('url', '8080', '/path/', 'schema')
+
+    func = partial(db_interface.add_entities, 'asset', DATA0, 'repo2')
+    consume = store.side_effect
+    store.side_effect = lambda data, content_type: consume(data, content_type) and make_future(False)
+    ioloop.IOLoop().run_sync(func)
+    assert db_interface.fingerprints.count('repo2') == 0
+
+    store.side_effect = consume
+    ioloop.IOLoop().run_sync(func)
+    assert db_interface.fingerprints.count('repo2') == 2
+
+    func = partial(db_interface.add_entities, 'asset', DATA0 + [
+        {'source_id_type': 'my_id_type', 'source_id': 'new_id',
+         'entity_id': VALID_ENTITY_ID1}], 'repo2')
+    result = ioloop.IOLoop().run_sync(func)
+
+    assert result == {'errors': [], 'records': 3}
+    assert 'new_id' in store.body
+    assert '/flibble>' not in store.body
+    assert db_interface.fingerprints.count('repo2') == 3
+
+
+def test_delete_forgets_fingerprints(tmpdir):
+    graph, db = graph_db(INDEX_TTL)
+    db.fingerprints = IngestFingerprints(str(tmpdir.join('fingerprints.db')), 100)
+    rows = [(VALID_ENTITY_ID1, 'type1', 'a'), (VALID_ENTITY_ID2, 'type1', 'a')]
+    db.fingerprints.add('repo1', rows)
+
+    func = partial(db.delete, 'asset', [{'source_id': 'a', 'source_id_type': 'type1'}], 'repo1')
+    ioloop.IOLoop().run_sync(func)
+
+    assert db.fingerprints.filter('repo1', rows) == rows[:1]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from index.models.fingerprints import IngestFingerprints, fingerprint
+
+ROWS = [('e%d' % i, 'type1', 'id%d' % i) for i in range(5)]
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def fingerprints(tmpdir, clock):
+    return IngestFingerprints(str(tmpdir.join('fingerprints.db')), 100, timer=clock)
+
+
+def test_fingerprint():
+    assert fingerprint('e', 'type1', 'id') == fingerprint(u'e', u'type1', u'id')
+    assert fingerprint('e', 'type1', 'id') != fingerprint('e', 'type1i', 'd')
+
+
+def test_filter(fingerprints):
+    fingerprints.add('repo1', ROWS[:3])
+
+    assert fingerprints.filter('repo1', ROWS) == ROWS[3:]
+    assert fingerprints.filter('repo2', ROWS) == ROWS
+
+
+def test_filter_batches(fingerprints):
+    fingerprints.BATCH_SIZE = 2
+    fingerprints.add('repo1', ROWS[::2])
+
+    assert fingerprints.filter('repo1', ROWS) == ROWS[1::2]
+
+
+def test_remove(fingerprints):
+    fingerprints.add('repo1', ROWS)
+    fingerprints.remove('repo1', ROWS[:2])
+
+    assert fingerprints.filter('repo1', ROWS) == ROWS[:2]
+
+
+def test_clear(fingerprints):
+    fingerprints.add('repo1', ROWS)
+    fingerprints.add('repo2', ROWS)
+    fingerprints.clear('repo1')
+
+    assert fingerprints.count('repo1') == 0
+    assert fingerprints.count('repo2') == 5
+
+
+def test_evicts_oldest(fingerprints, clock):
+    fingerprints.max_size = 3
+    for row in ROWS:
+        clock.now += 1
+        fingerprints.add('repo1', [row])
+
+    assert fingerprints.count('repo1') == 3
+    assert fingerprints.filter('repo1', ROWS) == ROWS[:2]
+
+
+def test_expired(fingerprints, clock):
+    fingerprints.ttl = 10
+    fingerprints.add('repo1', ROWS[:2])
+    clock.now = 5
+    fingerprints.add('repo1', ROWS[2:3])
+
+    clock.now = 10
+    assert fingerprints.filter('repo1', ROWS) == ROWS[:2] + ROWS[3:]
+
+    fingerprints.add('repo1', ROWS[3:4])
+    assert fingerprints.count('repo1') == 2
+
+
+def test_shared_between_connections(fingerprints, clock):
+    other = IngestFingerprints(fingerprints.path, 100, timer=clock)
+    fingerprints.add('repo1', ROWS)
+    other.remove('repo1', ROWS[:1])
+
+    assert fingerprints.filter('repo1', ROWS) == ROWS[:1]
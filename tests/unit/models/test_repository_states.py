@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import shelve
+from datetime import datetime
+
+import pytest
+
+from index.models.repository_states import RepositoryStates
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('repositories.db'))
+
+
+def test_get_unknown_repository(path):
+    states = RepositoryStates(path)
+
+    assert 'repo1' not in states
+    assert states.get('repo1') is None
+    with pytest.raises(KeyError):
+        states['repo1']
+
+
+def test_changes_written_in_batches(path):
+    states = RepositoryStates(path, batch_size=2)
+    reader = RepositoryStates(path)
+
+    states['repo1'] = {'id': 'repo1'}
+    assert states['repo1'] == {'id': 'repo1'}
+    assert 'repo1' not in reader
+
+    states['repo2'] = {'id': 'repo2'}
+    assert reader['repo1'] == {'id': 'repo1'}
+    assert reader['repo2'] == {'id': 'repo2'}
+
+
+def test_keys(path):
+    states = RepositoryStates(path)
+    states['repo1'] = {}
+    states.flush()
+    states['repo2'] = {}
+
+    assert states.keys() == {'repo1', 'repo2'}
+    assert len(states) == 2
+
+
+def test_persisted_when_closed(path):
+    now = datetime(2016, 1, 1)
+    states = RepositoryStates(path)
+    states['repo1'] = {'next': now, 'errors': 1, 'service': {'location': 'http://a.test'}}
+    states.close()
+
+    assert RepositoryStates(path)['repo1'] == {
+        'next': now, 'errors': 1, 'service': {'location': 'http://a.test'}}
+
+
+def test_update(path):
+    states = RepositoryStates(path)
+    states['repo1'] = {'errors': 1}
+    states.flush()
+    states['repo1'] = {'errors': 2}
+    states.flush()
+
+    assert RepositoryStates(path)['repo1'] == {'errors': 2}
+    assert len(states) == 1
+
+
+def test_circuit_breakers(path):
+    states = RepositoryStates(path)
+    states.set_circuit_breaker('b.test', {'state': 'open', 'failures': 5, 'opened': 10.0})
+    states.set_circuit_breaker('a.test', {'state': 'closed', 'failures': 1, 'opened': None})
+    states.set_circuit_breaker('b.test', {'state': 'half-open', 'failures': 5, 'opened': 10.0})
+
+    assert RepositoryStates(path).circuit_breakers() == [
+        {'host': 'a.test', 'state': 'closed', 'failures': 1, 'opened': None},
+        {'host': 'b.test', 'state': 'half-open', 'failures': 5, 'opened': 10.0}
+    ]
+
+
+def test_remove(path):
+    states = RepositoryStates(path)
+    states['repo1'] = {}
+    states['repo2'] = {}
+    states.flush()
+
+    del states['repo1']
+    assert 'repo1' not in states
+    assert states.keys() == {'repo2'}
+    assert 'repo1' in RepositoryStates(path)
+
+    states.flush()
+    assert 'repo1' not in RepositoryStates(path)
+    with pytest.raises(KeyError):
+        del states['repo1']
+
+
+def test_import_shelf(path, tmpdir):
+    shelf_path = str(tmpdir.join('repos_shelf.db'))
+    repository = {'id': 'repo1', 'next': datetime(2016, 7, 8), 'errors': 0}
+    shelf = shelve.open(shelf_path)
+    shelf['repo1'] = repository
+    shelf.close()
+
+    states = RepositoryStates(path)
+    assert states.import_shelf(shelf_path) == 1
+    states.close()
+
+    assert RepositoryStates(path)['repo1'] == repository
+
+
+def test_import_shelf_not_empty(path, tmpdir):
+    shelf_path = str(tmpdir.join('repos_shelf.db'))
+    shelf = shelve.open(shelf_path)
+    shelf['repo1'] = {'id': 'repo1'}
+    shelf.close()
+
+    states = RepositoryStates(path)
+    states['repo2'] = {'id': 'repo2'}
+
+    assert states.import_shelf(shelf_path) == 0
+    assert states.keys() == {'repo2'}
+
+
+def test_import_missing_shelf(path, tmpdir):
+    states = RepositoryStates(path)
+
+    assert states.import_shelf(str(tmpdir.join('missing.db'))) == 0
+    assert len(states) == 0
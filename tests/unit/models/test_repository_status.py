@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from datetime import datetime
+import os
+
+import pytest
+
+from index.models.repository_status import RecordBusyError, RepositoryStatus
+
+
+def test_get_unknown_repository():
+    status = RepositoryStatus(10)
+    status.mark_populated()
+
+    with pytest.raises(KeyError):
+        status.get('repo1')
+    assert status.complete
+
+
+def test_incomplete_until_populated():
+    status = RepositoryStatus(10)
+    status.set('repo1', None)
+    assert not status.complete
+
+    status.mark_populated()
+    assert status.complete
+
+
+def test_set():
+    status = RepositoryStatus(10)
+    last = datetime(2016, 1, 2, 3, 4, 5, 600)
+
+    assert status.set('repo1', last)
+    assert status.set(u'repo2', None)
+
+    assert status.get(u'repo1') == last
+    assert status.get('repo2') is None
+
+
+def test_update():
+    status = RepositoryStatus(10)
+    status.set('repo1', None)
+    status.set('repo1', datetime(2016, 1, 1))
+
+    assert status.get('repo1') == datetime(2016, 1, 1)
+
+
+def test_colliding_repositories():
+    status = RepositoryStatus(2)
+    ids = ['repo%d' % i for i in range(2)]
+    for i, repo_id in enumerate(ids):
+        status.set(repo_id, datetime(2016, 1, i + 1))
+
+    for i, repo_id in enumerate(ids):
+        assert status.get(repo_id) == datetime(2016, 1, i + 1)
+
+
+def test_full():
+    status = RepositoryStatus(1)
+    status.mark_populated()
+    status.set('repo1', None)
+
+    assert not status.set('repo2', None)
+    assert not status.complete
+    with pytest.raises(KeyError):
+        status.get('repo2')
+
+
+def test_id_too_long():
+    status = RepositoryStatus(10)
+
+    assert not status.set('a' * 65, None)
+    assert not status.complete
+
+
+def test_shared_with_forked_process():
+    status = RepositoryStatus(10)
+
+    pid = os.fork()
+    if pid == 0:
+        status.set('repo1', datetime(2016, 1, 1))
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert status.get('repo1') == datetime(2016, 1, 1)
+
+
+def test_remove():
+    status = RepositoryStatus(2)
+    status.set('repo0', None)
+    status.set('repo1', datetime(2016, 1, 1))
+
+    status.remove('repo0')
+    status.remove('unknown')
+
+    with pytest.raises(KeyError):
+        status.get('repo0')
+    assert status.get('repo1') == datetime(2016, 1, 1)
+
+    status.set('repo0', datetime(2016, 1, 2))
+    assert status.get('repo0') == datetime(2016, 1, 2)
+
+
+def test_removed_records_reused():
+    status = RepositoryStatus(4)
+    status.mark_populated()
+
+    for i in range(20):
+        assert status.set('repo%d' % i, None)
+        status.remove('repo%d' % i)
+
+    assert status.set('repo20', datetime(2016, 1, 1))
+    assert status.get('repo20') == datetime(2016, 1, 1)
+    assert status.complete
+
+
+def test_probes_bounded():
+    status = RepositoryStatus(10)
+    status.MAX_PROBES = 2
+    status.mark_populated()
+    offsets = []
+    status._read = lambda offset: offsets.append(offset) or (0, 3, 0.0, b'abc')
+
+    with pytest.raises(KeyError):
+        status.get('repo1')
+    assert len(offsets) == 2
+
+
+def test_read_busy_record():
+    """A record left half written by a writer is not read forever"""
+    status = RepositoryStatus(1)
+    status.set('repo1', None)
+    status.SEQUENCE.pack_into(status._memory, status.HEADER.size, 3)
+
+    with pytest.raises(RecordBusyError):
+        status.get('repo1')
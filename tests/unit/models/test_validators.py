@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from index.models.validators import validate_identifiers
+
+ENTITY_ID = '37cd1397e0814e989fa22da6b15fec60'
+
+
+def test_validate_identifiers_accepted():
+    rows = [{'entity_id': ENTITY_ID, 'source_id_type': 'my id type',
+             'source_id': 'my/id', 'other': 'ignored'}]
+
+    accepted, rejected = validate_identifiers(rows)
+
+    assert accepted == [(ENTITY_ID, 'my+id+type', 'my%2Fid')]
+    assert rejected == []
+
+
+def test_validate_identifiers_rejected():
+    rows = [
+        {'entity_id': ENTITY_ID, 'source_id': 'a'},
+        {'entity_id': 'ZK#/123Z', 'source_id_type': 'type', 'source_id': 'a'},
+        {'entity_id': ENTITY_ID, 'source_id_type': '', 'source_id': 'a'},
+        {'entity_id': ENTITY_ID, 'source_id_type': 'type', 'source_id': ''},
+        {'entity_id': ENTITY_ID, 'source_id_type': 'type', 'source_id': 'a'},
+    ]
+
+    accepted, rejected = validate_identifiers(rows)
+
+    assert accepted == [(ENTITY_ID, 'type', 'a')]
+    assert [index for index, _ in rejected] == [0, 1, 2, 3]
+    assert 'invalid id' in rejected[1][1]
+
+
+def test_validate_identifiers_does_not_modify_rows():
+    rows = [{'entity_id': ENTITY_ID, 'source_id_type': 'my type', 'source_id': 'a'}]
+
+    validate_identifiers(rows)
+
+    assert rows == [{'entity_id': ENTITY_ID, 'source_id_type': 'my type', 'source_id': 'a'}]
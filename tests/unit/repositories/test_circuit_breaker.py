@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+from koi.test_helpers import make_future, gen_test
+from mock import MagicMock, patch
+from tornado.httpclient import HTTPError
+from tornado.options import options
+
+from index import repositories
+
+CircuitBreaker = repositories.CircuitBreaker
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(on_change=MagicMock(), timer=clock)
+
+
+def open_breaker(breaker, host='a.test'):
+    for _ in range(options.circuit_breaker_threshold):
+        breaker.failure(host)
+
+
+def test_closed(breaker):
+    assert not breaker.allow('a.test')
+    breaker.failure('a.test')
+    assert not breaker.allow('a.test')
+
+    assert breaker.states() == {
+        'a.test': {'state': CircuitBreaker.CLOSED, 'failures': 1, 'opened': None}}
+
+
+def test_opened_after_consecutive_failures(breaker, clock):
+    clock.now = 10
+    open_breaker(breaker)
+
+    with pytest.raises(repositories.CircuitOpenError) as exc:
+        breaker.allow('a.test')
+
+    assert exc.value.retry_after == options.circuit_breaker_timeout
+    assert breaker.states()['a.test']['state'] == CircuitBreaker.OPEN
+    assert breaker.states()['a.test']['opened'] == 10
+    breaker.allow('b.test')
+
+
+def test_failures_reset_by_success(breaker):
+    for _ in range(options.circuit_breaker_threshold - 1):
+        breaker.failure('a.test')
+    breaker.success('a.test')
+    breaker.failure('a.test')
+
+    breaker.allow('a.test')
+
+
+def test_single_request_when_half_open(breaker, clock):
+    open_breaker(breaker)
+    clock.now = options.circuit_breaker_timeout
+
+    assert breaker.allow('a.test')
+    assert breaker.states()['a.test']['state'] == CircuitBreaker.HALF_OPEN
+
+    with pytest.raises(repositories.CircuitOpenError) as exc:
+        breaker.allow('a.test')
+    assert exc.value.retry_after == 0
+
+
+def test_closed_when_half_open_request_succeeds(breaker, clock):
+    open_breaker(breaker)
+    clock.now = options.circuit_breaker_timeout
+    breaker.allow('a.test')
+
+    breaker.success('a.test')
+
+    breaker.allow('a.test')
+    assert breaker.states()['a.test'] == {
+        'state': CircuitBreaker.CLOSED, 'failures': 0, 'opened': None}
+
+
+def test_opened_when_half_open_request_fails(breaker, clock):
+    open_breaker(breaker)
+    clock.now = options.circuit_breaker_timeout
+    breaker.allow('a.test')
+
+    breaker.failure('a.test')
+
+    with pytest.raises(repositories.CircuitOpenError) as exc:
+        breaker.allow('a.test')
+    assert exc.value.retry_after == options.circuit_breaker_timeout
+
+
+def test_released_half_open_request(breaker, clock):
+    open_breaker(breaker)
+    clock.now = options.circuit_breaker_timeout
+    breaker.allow('a.test')
+
+    breaker.release('a.test')
+
+    breaker.allow('a.test')
+    assert breaker.states()['a.test']['state'] == CircuitBreaker.HALF_OPEN
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_manager_single_probe_when_half_open(koi, repository_service_client):
+    """
+    A request that was not the probe does not end the probe when it fails
+    with an error that is not the host's, so no other probe is allowed
+    """
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = ValueError()
+
+    repostore = MagicMock()
+    repostore.get_repository.return_value = make_future(
+        {'service': {'location': 'http://a.test/v1'}})
+    manager = repositories.Manager(MagicMock(), repostore, MagicMock())
+    clock = Clock()
+    manager.circuit_breaker = CircuitBreaker(timer=clock)
+
+    open_breaker(manager.circuit_breaker)
+    clock.now = options.circuit_breaker_timeout
+    assert manager.circuit_breaker.allow('a.test')
+
+    # a request allowed before the circuit was opened
+    with pytest.raises(ValueError):
+        yield manager._fetch_identifiers('repo1', None, 'http://a.test/v1', 'a.test')
+
+    assert manager.circuit_breaker.states()['a.test']['state'] == CircuitBreaker.HALF_OPEN
+    with pytest.raises(repositories.CircuitOpenError):
+        manager.circuit_breaker.allow('a.test')
+
+
+def test_load(breaker, clock):
+    breaker.load([
+        {'host': 'a.test', 'state': CircuitBreaker.OPEN, 'failures': 5, 'opened': 0},
+        {'host': 'b.test', 'state': CircuitBreaker.HALF_OPEN, 'failures': 6, 'opened': 0},
+        {'host': 'c.test', 'state': CircuitBreaker.CLOSED, 'failures': 1, 'opened': None},
+    ])
+
+    with pytest.raises(repositories.CircuitOpenError):
+        breaker.allow('a.test')
+    assert breaker.states()['b.test']['state'] == CircuitBreaker.OPEN
+    breaker.allow('c.test')
+    assert not breaker.on_change.called
+
+
+@pytest.mark.parametrize('exc,expected', [
+    (HTTPError(599), True),
+    (HTTPError(500), True),
+    (HTTPError(503), True),
+    (HTTPError(404), False),
+    (HTTPError(400), False),
+    (IOError('connection refused'), True),
+    (ValueError(), False),
+])
+def test_is_host_failure(exc, expected):
+    assert repositories.is_host_failure(exc) == expected
+
+
+def test_changes_published(breaker):
+    open_breaker(breaker)
+
+    breaker.on_change.assert_called_with(
+        'a.test', {'state': CircuitBreaker.OPEN,
+                   'failures': options.circuit_breaker_threshold,
+                   'opened': 0})
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_manager_skips_host_when_open(koi, repository_service_client):
+    """Repositories of a failing host are rescheduled without a request"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = HTTPError(503)
+
+    scheduler = MagicMock()
+    repostore = MagicMock()
+    repostore.get_repository.return_value = make_future(
+        {'service': {'location': 'http://a.test/v1'}})
+    manager = repositories.Manager(MagicMock(), repostore, scheduler)
+
+    for _ in range(options.circuit_breaker_threshold):
+        yield manager.fetch('repo1')
+    assert endpoint.get.call_count == options.circuit_breaker_threshold
+    assert repostore.fail.call_count == options.circuit_breaker_threshold
+
+    yield manager.fetch('repo2')
+
+    assert endpoint.get.call_count == options.circuit_breaker_threshold
+    assert repostore.fail.call_count == options.circuit_breaker_threshold
+    (repo_id, delay), _ = scheduler.done.call_args
+    assert repo_id == 'repo2'
+    assert options.circuit_breaker_timeout <= delay <= 2 * options.circuit_breaker_timeout
+    repostore.set_circuit_breaker.assert_called_with('a.test', {
+        'state': CircuitBreaker.OPEN,
+        'failures': options.circuit_breaker_threshold,
+        'opened': manager.circuit_breaker.states()['a.test']['opened']})
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_repository_errors_do_not_open_circuit(koi, repository_service_client):
+    """A repository returning client errors does not suspend its host"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = HTTPError(404)
+
+    repostore = MagicMock()
+    repostore.get_repository.return_value = make_future(
+        {'service': {'location': 'http://a.test/v1'}})
+    manager = repositories.Manager(MagicMock(), repostore, MagicMock())
+
+    for _ in range(options.circuit_breaker_threshold + 1):
+        yield manager.fetch('repo1')
+
+    assert endpoint.get.call_count == options.circuit_breaker_threshold + 1
+    assert manager.circuit_breaker.states() == {}
+
+
+def test_manager_loads_circuit_breakers():
+    repostore = MagicMock()
+    repostore.circuit_breakers.return_value = [
+        {'host': 'a.test', 'state': CircuitBreaker.OPEN, 'failures': 5, 'opened': 0}]
+    manager = repositories.Manager(MagicMock(), repostore, MagicMock())
+
+    with patch('index.repositories.IOLoop'):
+        manager.start()
+
+    assert manager.circuit_breaker.states()['a.test']['state'] == CircuitBreaker.OPEN
@@ -17,14 +17,18 @@
 #
 
 from datetime import datetime
-import Queue
 
+import dateutil.parser
 import pytest
+from freezegun import freeze_time
 from mock import call, patch, Mock, MagicMock
 from koi.test_helpers import make_future, gen_test
-from tornado.options import define
+from tornado.concurrent import Future
+from tornado.gen import coroutine, sleep, Return
+from tornado.options import define, options
 
 from index import repositories
+from index.models.repository_states import RepositoryStates
 
 
 define('ssl_ca_cert', default='')
@@ -39,20 +43,14 @@ def frange(x, y, jump):
 def mock_manager(use_clock=False):
     """
     Returns an instance of repositories.Manager with a mock database, an
-    empty shelf (using a dict instead of an actual shelf instance), and
-    an example repository
+    repository store kept in memory, and an example repository
     """
-    repostore = repositories.RepositoryStore({})
-    repostore._shelf = {
-        'repo_a': {'id': 'repo_a', 'service': {'location': 'http://a.test'}}
-    }
-    queue = Queue.Queue()
-    notification_q = repositories.Notification(queue)
+    repostore = repositories.RepositoryStore(states=RepositoryStates(':memory:'))
+    repostore._states['repo_a'] = {'id': 'repo_a', 'service': {'location': 'http://a.test'}}
     scheduler = repositories.Scheduler()
     scheduler._use_clock = use_clock
     if use_clock:
         scheduler._time = iter(frange(0, 100000, 0.5)).next
-    notification_q.connect_with(scheduler)
     manager = repositories.Manager(Mock(), repostore, scheduler)
     manager.db.add_entities.return_value = make_future({'errors': []})
     return scheduler, repostore, manager
@@ -78,7 +76,6 @@ def mock_identifiers(pages=None):
 
 
 @patch('index.repositories.API')
-@patch('index.repositories.shelve', MagicMock())
 @patch('index.repositories.koi', MagicMock())
 @gen_test
 def test_unknown_repository(API):
@@ -94,8 +91,7 @@ def test_unknown_repository(API):
     """
     scheduler = MagicMock()
     scheduler.get.return_value = make_future('repo1')
-    store = repositories.RepositoryStore({})
-    store._shelf = {}
+    store = repositories.RepositoryStore(states=RepositoryStates(':memory:'))
     # get_repository raises a KeyError if repo is unknown
     store.get_repository = MagicMock(side_effect=KeyError)
 
@@ -103,8 +99,8 @@ def test_unknown_repository(API):
     yield manager.fetch('repo1')
 
     assert not API().repository.repositories[''].assets.identifiers.called
-    assert not scheduler.schedule.called
-    assert store._shelf == {}
+    scheduler.done.assert_called_once_with('repo1', None)
+    assert store.get_repositories() == set()
 
 
 @patch('index.repositories.logging')
@@ -114,7 +110,7 @@ def test_unknown_repository(API):
 def test_not_called_if_repo_missing_location(API, koi, logging):
     """Don't insert data if the response was empty"""
     scheduler, repostore, manager = mock_manager()
-    repostore._shelf['repo_a']['service']['location'] = None
+    repostore._states['repo_a'] = {'id': 'repo_a', 'service': {'location': None}}
 
     yield manager.fetch_identifiers('repo_a')
 
@@ -173,7 +169,7 @@ def test_single_page_with_data(koi, repository_service_client):
                                                     'repo_a')
 
     # Check date was stored for the next time the endpoint is scheduled
-    assert repostore._shelf['repo_a']['next'] == datetime(2010, 1, 1)
+    assert repostore._states['repo_a']['next'] == datetime(2010, 1, 1)
 
 
 @patch('index.repositories.repository_service_client')
@@ -212,7 +208,9 @@ def test_three_pages_with_data(koi, repository_service_client):
         call('asset', ['second page'], 'repo_a'),
         call('asset', ['third page'], 'repo_a'),
     ])
-    assert repostore._shelf['repo_a']['next'] == datetime(2003, 1, 1)
+    assert repostore._states['repo_a']['next'] == datetime(2003, 1, 1)
+    assert repostore._states['repo_a']['polls'] == [
+        {'rows': 3, 'pages': 3, 'interval': None, 'moved': None, 'truncated': False}]
 
 
 @patch('index.repositories.repository_service_client')
@@ -258,7 +256,8 @@ def test_fetch_max_pages(koi, repository_service_client):
         call('asset', ['fourth page'], 'repo_a'),
         call('asset', ['fifth page'], 'repo_a'),
     ])
-    assert repostore._shelf['repo_a']['next'] == datetime(2005, 1, 1)
+    assert repostore._states['repo_a']['next'] == datetime(2005, 1, 1)
+    assert repostore._states['repo_a']['polls'][-1]['truncated']
 
 
 
@@ -267,7 +266,7 @@ def test_fetch_max_pages(koi, repository_service_client):
 @gen_test
 def test_fetch_api_call_with_saved_timestamp(koi, repository_service_client):
     """
-    The 'from' query parameter should be taken from the shelf if it's populated
+    The 'from' query parameter should be taken from the repository store if it's populated
     """
     client = MagicMock()
     repository_service_client.return_value = make_future(client)
@@ -276,7 +275,7 @@ def test_fetch_api_call_with_saved_timestamp(koi, repository_service_client):
     scheduler, repostore, manager = mock_manager()
 
     from_time = datetime(2016, 1, 1)
-    repostore._shelf['repo_a']['next'] = from_time
+    repostore._states['repo_a'] = dict(repostore._states['repo_a'], next=from_time)
 
     yield manager.fetch_identifiers('repo_a')
 
@@ -297,7 +296,7 @@ def test_next_poll_interval_after_successful():
 
     yield manager.fetch('repo1')
 
-    (repo_id, next_poll_interval), _ = scheduler.schedule.call_args
+    (repo_id, next_poll_interval), _ = scheduler.done.call_args
 
     min_interval, max_interval = manager.poll_interval_range
     assert min_interval <= next_poll_interval <= max_interval
@@ -307,48 +306,198 @@ def test_next_poll_interval_after_successful():
 @gen_test
 def test_next_poll_interval_after_error():
     """
-    If there was an error, the next poll interval, should be a random number
-    in the manager's interval range multiplied by the number errors up to
-    the max_error_delay_factor
+    If there was an error, the next poll interval should be the backoff of
+    the repository
     """
     scheduler = MagicMock()
     scheduler.get.return_value = make_future('repo1')
     manager = repositories.Manager(MagicMock(), MagicMock(), scheduler)
-    errors = manager.max_error_delay_factor - 1
     manager.fetch_identifiers = MagicMock(return_value=make_future(
-        {'errors': errors}
+        {'errors': 2, 'backoff': 12345}
     ))
 
     yield manager.fetch('repo1')
 
-    (repo_id, next_poll_interval), _ = scheduler.schedule.call_args
+    (repo_id, next_poll_interval), _ = scheduler.done.call_args
 
-    min_interval, max_interval = manager.poll_interval_range
-    assert min_interval * errors <= next_poll_interval
-    assert max_interval * errors >= next_poll_interval
+    assert next_poll_interval == 12345
+
+
+@pytest.mark.parametrize('previous', [None, 3600 * 6, 3600 * 24 * 365])
+def test_backoff_delay(previous):
+    """
+    The backoff is between half the default_poll_interval and three times
+    the previous delay, up to the max_error_delay_factor
+    """
+    base = 0.5 * options.default_poll_interval
+    cap = options.max_poll_error_delay_factor * options.default_poll_interval
+
+    for _ in range(100):
+        delay = repositories.backoff_delay(previous)
+        assert base <= delay <= min(cap, 3 * (previous or base))
+
+
+def poll(rows, pages, interval, moved=None, truncated=False):
+    return {'rows': rows, 'pages': pages, 'interval': interval, 'moved': moved,
+            'truncated': truncated}
+
+
+@pytest.mark.parametrize('polls,interval', [
+    # no data: the interval since the last poll is doubled
+    ([poll(0, 0, 3600)], 7200),
+    # bounded by max_poll_interval
+    ([poll(0, 0, 3600 * 24 * 7)], 3600 * 24 * 7),
+    # 4 pages in 4 hours
+    ([poll(100, 1, 3600), poll(300, 3, 3 * 3600)], 3600),
+    # range did not move: the same rows were fetched again
+    ([poll(100, 1, 3600), poll(100, 1, 3600, 0)], 7200),
+    # backlog: the polls that had more pages are ignored
+    ([poll(100, 1, 3600), poll(500, 5, 3600, truncated=True)], 7200),
+    # bounded by min_poll_interval
+    ([poll(100, 4, 60)], 600),
+])
+def test_adapted_poll_interval(polls, interval):
+    assert repositories.Manager._adapted_poll_interval(polls) == interval
 
 
 @gen_test
-def test_next_poll_interval_max_error_delay():
+def test_next_poll_interval_continuation():
     """
-    If there was an error, the next poll interval, should be a random number
-    in the manager's interval range multiplied by the number errors up to
-    the max_error_delay_factor
+    If the repository had more pages, the next poll should be after the
+    continuation_delay
     """
     scheduler = MagicMock()
-    scheduler.get.return_value = make_future('repo1')
     manager = repositories.Manager(MagicMock(), MagicMock(), scheduler)
     manager.fetch_identifiers = MagicMock(return_value=make_future(
-        {'errors': manager.max_error_delay_factor + 1}
+        {'errors': 0, 'polls': [poll(500, 5, 3600 * 24, truncated=True)]}
     ))
 
     yield manager.fetch('repo1')
 
-    (repo_id, next_poll_interval), _ = scheduler.schedule.call_args
+    (repo_id, next_poll_interval), _ = scheduler.done.call_args
+
+    assert next_poll_interval == options.continuation_delay
+
+
+@patch.object(options.mockable(), 'repository_poll_time_budget', 0)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_fetch_time_budget(koi, repository_service_client):
+    """No more pages are requested once the time budget is spent"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        n: {'data': ['page %d' % n], 'metadata': {}} for n in range(1, 6)
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    result = yield manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    assert endpoint.get.call_count == 1
+    assert result == (None, 1, 1, True)
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_fetch_all_pages_not_truncated(koi, repository_service_client):
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        n: {'data': ['page %d' % n], 'metadata': {}} for n in range(1, 3)
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    result = yield manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    assert result == (None, 2, 2, False)
+
+
+@patch.object(options.mockable(), 'max_repository_pages', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_fetch_max_pages_short_last_page_not_truncated(koi, repository_service_client):
+    """Reaching max_repository_pages is not a truncation if the last page was short"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        1: {'data': ['a', 'b'], 'metadata': {}},
+        2: {'data': ['c'], 'metadata': {}},
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    result = yield manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    assert endpoint.get.call_count == 2
+    assert result == (None, 3, 2, False)
+
+
+@coroutine
+def fetch_full_pages(repository_service_client, metadata):
+    """Fetch two full pages of identifiers, the last with metadata"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        1: {'data': ['a', 'b'], 'metadata': {}},
+        2: {'data': ['c', 'd'], 'metadata': metadata},
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    result = yield manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    assert endpoint.get.call_count == 2
+    raise Return(result)
+
+
+@patch.object(options.mockable(), 'max_repository_pages', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_fetch_max_pages_exactly(koi, repository_service_client):
+    """Results filling exactly max_repository_pages full pages may be truncated"""
+    result = yield fetch_full_pages(repository_service_client, {})
+
+    assert result == (None, 4, 2, True)
+
+
+@patch.object(options.mockable(), 'max_repository_pages', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_fetch_max_pages_next_link(koi, repository_service_client):
+    """The link to the next page, if any, tells whether results are truncated"""
+    result = yield fetch_full_pages(repository_service_client, {'next': None})
+    assert result == (None, 4, 2, False)
+
+    result = yield fetch_full_pages(repository_service_client,
+                                    {'next': 'http://a.test/identifiers?page=3'})
+    assert result == (None, 4, 2, True)
+
+
+@gen_test
+def test_next_poll_interval_adapted_to_history():
+    """
+    If there is a history of polls, the next poll interval should be a
+    random number up to the adapted interval
+    """
+    scheduler = MagicMock()
+    manager = repositories.Manager(MagicMock(), MagicMock(), scheduler)
+    manager.fetch_identifiers = MagicMock(return_value=make_future(
+        {'errors': 0, 'polls': [poll(100, 1, 3600 * 24)]}
+    ))
+
+    yield manager.fetch('repo1')
+
+    (repo_id, next_poll_interval), _ = scheduler.done.call_args
+
+    assert 3600 * 12 <= next_poll_interval <= 3600 * 24
 
-    min_interval, max_interval = manager.poll_interval_range
-    assert min_interval * manager.max_error_delay_factor <= next_poll_interval
-    assert max_interval * manager.max_error_delay_factor >= next_poll_interval
 
 
 @patch('index.repositories.options')
@@ -360,3 +509,389 @@ def test_invalid_max_error_delay_factor(options):
 
         with pytest.raises(ValueError):
             repositories.Manager(MagicMock(), MagicMock(), MagicMock())
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@patch.object(options.mockable(), 'max_repository_pages', 5)
+@patch.object(options.mockable(), 'repository_prefetch_pages', 2)
+@gen_test
+def test_fetch_pages_while_storing(koi, repository_service_client):
+    """Pages are fetched ahead while the previous pages are stored"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        n: {'data': ['page %d' % n],
+            'metadata': {'result_range': ('2000-01-01', '200%d-01-01' % n)}}
+        for n in range(1, 5)
+    })
+    scheduler, repostore, manager = mock_manager()
+    fetched = []
+
+    @coroutine
+    def add_entities(entity_type, data, repo_id):
+        fetched.append(endpoint.get.call_count)
+        yield sleep(0.01)
+
+    manager.db.add_entities.side_effect = add_entities
+
+    yield manager.fetch_identifiers('repo_a')
+
+    manager.db.add_entities.assert_has_calls([
+        call('asset', ['page %d' % n], 'repo_a') for n in range(1, 5)])
+    # the next two pages are fetched while the first page is stored
+    assert fetched[0] == 3
+    assert endpoint.get.call_count == 5
+    assert repostore._states['repo_a']['next'] == datetime(2004, 1, 1)
+
+
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@patch.object(options.mockable(), 'max_repository_pages', 5)
+@patch.object(options.mockable(), 'repository_prefetch_pages', 1)
+@gen_test
+def test_fetch_pages_store_error(koi, repository_service_client):
+    """Pages are no longer fetched if storing a page fails"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = mock_identifiers({
+        n: {'data': ['page %d' % n], 'metadata': {}} for n in range(1, 6)
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    @coroutine
+    def add_entities(entity_type, data, repo_id):
+        yield sleep(0.01)
+        raise ValueError()
+
+    manager.db.add_entities.side_effect = add_entities
+
+    with pytest.raises(ValueError):
+        yield manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    yield sleep(0.01)
+    assert manager.db.add_entities.call_count == 1
+    assert endpoint.get.call_count < 5
+
+
+@patch('index.repositories.logging')
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@patch.object(options.mockable(), 'max_repository_pages', 5)
+@patch.object(options.mockable(), 'repository_prefetch_pages', 1)
+@gen_test
+def test_fetch_pages_store_error_waits_for_producer(koi, repository_service_client,
+                                                    logging):
+    """The producer is waited for and its error logged if storing fails"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    requested = Future()
+
+    def get(page=1, **kwargs):
+        if page == 1:
+            return make_future({'data': ['page 1'], 'metadata': {}})
+        return requested
+
+    endpoint.get.side_effect = get
+    scheduler, repostore, manager = mock_manager()
+
+    @coroutine
+    def add_entities(entity_type, data, repo_id):
+        yield sleep(0.01)
+        raise ValueError()
+
+    manager.db.add_entities.side_effect = add_entities
+    fetching = manager._fetch_identifiers('repo_a', None, 'http://a.test')
+
+    yield sleep(0.02)
+    assert not fetching.done()
+    requested.set_exception(KeyError())
+
+    with pytest.raises(ValueError):
+        yield fetching
+    assert logging.exception.called
+
+
+@gen_test
+def test_fetch_forever_woken_by_schedule():
+    """A repository scheduled while waiting is fetched when it is due"""
+    scheduler, repostore, manager = mock_manager()
+    fetched = []
+
+    def fetch(repo_id):
+        fetched.append(repo_id)
+        return make_future(repo_id)
+
+    manager.fetch = fetch
+    manager.fetch_forever()
+
+    yield sleep(0.01)
+    assert fetched == []
+
+    yield scheduler.schedule('repo_a', 0)
+    yield sleep(0.01)
+    assert fetched == ['repo_a']
+
+
+@patch.object(options.mockable(), 'concurrency', 2)
+@gen_test
+def test_slow_repository_does_not_stall_workers():
+    """A worker picks up the next repository while another one is slow"""
+    scheduler, repostore, manager = mock_manager()
+    fetched = []
+    slow = Future()
+
+    def fetch(repo_id):
+        fetched.append(repo_id)
+        if repo_id == 'slow':
+            return slow
+        return make_future(repo_id)
+
+    manager.fetch = fetch
+    manager.start()
+
+    yield scheduler.schedule('slow', 0)
+    yield sleep(0.01)
+    for repo_id in ['repo0', 'repo1', 'repo2']:
+        yield scheduler.schedule(repo_id, 0)
+    yield sleep(0.01)
+
+    assert fetched == ['slow', 'repo0', 'repo1', 'repo2']
+    slow.set_result('slow')
+
+
+@patch.object(options.mockable(), 'concurrency', 3)
+@gen_test
+def test_start_workers():
+    """The manager fetches up to concurrency repositories at once"""
+    scheduler, repostore, manager = mock_manager()
+    running = {'now': 0, 'max': 0}
+
+    @coroutine
+    def fetch(repo_id):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        yield sleep(0.01)
+        running['now'] -= 1
+        scheduler.done(repo_id)
+
+    manager.fetch = fetch
+    manager.start()
+
+    for i in range(5):
+        yield scheduler.schedule('repo%d' % i, 0)
+    yield sleep(0.1)
+
+    assert running['max'] == 3
+
+
+@gen_test
+def test_set_concurrency():
+    """The pool of workers grows and shrinks while repositories are queued"""
+    scheduler, repostore, manager = mock_manager()
+    running = {'now': 0, 'max': 0}
+
+    @coroutine
+    def fetch(repo_id):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        yield sleep(0.01)
+        running['now'] -= 1
+        scheduler.done(repo_id)
+
+    manager.fetch = fetch
+    manager.set_concurrency(1)
+    for i in range(40):
+        yield scheduler.schedule('repo%d' % i, 0)
+    yield sleep(0.005)
+    assert running['max'] == 1
+
+    manager.set_concurrency(4)
+    yield sleep(0.02)
+    assert manager._workers == 4
+    assert running['max'] == 4
+
+    manager.set_concurrency(2)
+    yield sleep(0.02)
+    assert manager._workers == 2
+    running['max'] = running['now']
+    yield sleep(0.05)
+    assert running['max'] == 2
+
+    manager.set_concurrency(0)
+    yield sleep(0.05)
+    assert manager._workers == 0
+    assert running['now'] == 0
+
+
+@gen_test
+def test_rescheduled_while_fetched():
+    """
+    A repository rescheduled while it is fetched is not fetched by another
+    worker at the same time, but once the fetch is finished
+    """
+    scheduler, repostore, manager = mock_manager()
+    fetched = []
+    slow = Future()
+
+    @coroutine
+    def fetch_identifiers(repo_id):
+        fetched.append(repo_id)
+        if len(fetched) == 1:
+            yield slow
+        raise Return({})
+
+    manager.fetch_identifiers = fetch_identifiers
+    manager.fetch_forever()
+    manager.fetch_forever()
+
+    yield scheduler.schedule('repo_a', 0)
+    yield sleep(0.01)
+    yield scheduler.reschedule('repo_a', 0)
+    yield sleep(0.01)
+    assert fetched == ['repo_a']
+
+    slow.set_result(None)
+    yield sleep(0.01)
+    assert fetched == ['repo_a', 'repo_a']
+
+
+
+def slice_identifiers(pages):
+    """
+    Return a function returning the pages of a repository for each date
+    slice, keyed by the start of the slice and the page number
+    """
+    def func(page=1, **kwargs):
+        key = (dateutil.parser.parse(kwargs['from']), page)
+        return make_future(pages.get(key, {'data': [], 'metadata': {}}))
+
+    return func
+
+
+@freeze_time('2016-01-01')
+@patch.object(options.mockable(), 'backfill_slices', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_backfill_new_repository(koi, repository_service_client):
+    """The date range of a new repository is fetched in slices"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = slice_identifiers({
+        (datetime(2000, 1, 1), 1): {
+            'data': ['first slice'],
+            'metadata': {'result_range': ('2000-01-01', '2007-01-01')}},
+        (datetime(2008, 1, 1), 1): {
+            'data': ['second slice'],
+            'metadata': {'result_range': ('2008-01-01', '2015-01-01')}},
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    meta = yield manager.fetch_identifiers('repo_a')
+
+    endpoint.get.assert_has_calls([
+        call(page=1, **{'from': '2000-01-01T00:00:00', 'to': '2008-01-01T00:00:00'}),
+        call(page=1, **{'from': '2008-01-01T00:00:00', 'to': '2016-01-01T00:00:00'}),
+    ], any_order=True)
+    assert sorted(x[0][1] for x in manager.db.add_entities.call_args_list) == [
+        ['first slice'], ['second slice']]
+    assert meta['next'] == datetime(2015, 1, 1)
+    assert 'backfill' not in meta
+    assert not meta['polls'][-1]['truncated']
+
+
+@freeze_time('2016-01-01')
+@patch.object(options.mockable(), 'backfill_slices', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_backfill_single_slice_when_half_open(koi, repository_service_client):
+    """A single slice is fetched by the probe of a half-open circuit breaker"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = slice_identifiers({
+        (datetime(2000, 1, 1), 1): {
+            'data': ['first slice'],
+            'metadata': {'result_range': ('2000-01-01', '2007-01-01')}},
+    })
+    scheduler, repostore, manager = mock_manager()
+    manager.circuit_breaker.load([
+        {'host': 'a.test', 'state': repositories.CircuitBreaker.OPEN,
+         'failures': 5, 'opened': 0}])
+
+    meta = yield manager.fetch_identifiers('repo_a')
+
+    assert {x[1]['from'] for x in endpoint.get.call_args_list} == {'2000-01-01T00:00:00'}
+    assert [x['done'] for x in meta['backfill']] == [True, False]
+    assert manager.circuit_breaker.states()['a.test']['state'] == \
+        repositories.CircuitBreaker.CLOSED
+
+
+@freeze_time('2016-01-01')
+@patch.object(options.mockable(), 'backfill_slices', 2)
+@patch.object(options.mockable(), 'max_repository_pages', 1)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_backfill_next_waits_for_earlier_slices(koi, repository_service_client):
+    """
+    The start of the next query does not move past a slice that is not
+    done, and the progress of the slices is checkpointed
+    """
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+    endpoint.get.side_effect = slice_identifiers({
+        (datetime(2000, 1, 1), 1): {
+            'data': ['first slice'],
+            'metadata': {'result_range': ('2000-01-01', '2003-01-01')}},
+    })
+    scheduler, repostore, manager = mock_manager()
+
+    meta = yield manager.fetch_identifiers('repo_a')
+
+    assert meta['next'] == datetime(2003, 1, 1)
+    assert meta['polls'][-1]['truncated']
+    slices = repostore._states['repo_a']['backfill']
+    assert [(x['next'], x['done']) for x in slices] == [
+        (datetime(2003, 1, 1), False), (None, True)]
+
+    endpoint.get.reset_mock()
+    yield manager.fetch_identifiers('repo_a')
+
+    endpoint.get.assert_called_once_with(
+        page=1, **{'from': '2003-01-01T00:00:00', 'to': '2008-01-01T00:00:00'})
+    assert 'backfill' not in repostore._states['repo_a']
+    assert repostore._states['repo_a']['next'] == datetime(2016, 1, 1)
+
+
+@freeze_time('2016-01-01')
+@patch.object(options.mockable(), 'backfill_slices', 2)
+@patch('index.repositories.repository_service_client')
+@patch('index.repositories.koi')
+@gen_test
+def test_backfill_slice_error(koi, repository_service_client):
+    """The other slices are checkpointed if a slice fails"""
+    client = MagicMock()
+    repository_service_client.return_value = make_future(client)
+    endpoint = client.repository.repositories.__getitem__().assets.identifiers
+
+    def get(page=1, **kwargs):
+        if kwargs['from'].startswith('2000'):
+            raise ValueError()
+        return make_future({'data': [], 'metadata': {}})
+
+    endpoint.get.side_effect = get
+    scheduler, repostore, manager = mock_manager()
+
+    with pytest.raises(ValueError):
+        yield manager.fetch_identifiers('repo_a')
+
+    slices = repostore._states['repo_a']['backfill']
+    assert [x['done'] for x in slices] == [False, True]
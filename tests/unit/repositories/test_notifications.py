@@ -15,23 +15,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-
-import Queue
+import pytest
 from koi.test_helpers import gen_test
+from mock import patch
+from tornado.gen import sleep
+from tornado.options import options
 
 from index import repositories
 
 
+def connected_notification(time=0):
+    notification = repositories.Notification()
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: time
+    notification.connect_with(scheduler)
+    notification.start()
+    return notification, scheduler
+
+
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
 @gen_test
 def test_scheduler_receives_notification():
-    queue = Queue.Queue()
-    notification_q = repositories.Notification(queue)
-    scheduler = repositories.Scheduler()
-    notification_q.connect_with(scheduler)
+    notification, scheduler = connected_notification()
 
-    scheduler._time = lambda: 0
-    notification_q.put_nowait('repo0')
-    yield notification_q._check_for_notifications()
+    notification.put_nowait('repo0')
+    yield sleep(0.01)
 
     scheduler._time = lambda: repositories.options.notify_min_delay
     result = yield scheduler.get()
@@ -39,18 +47,26 @@ def test_scheduler_receives_notification():
     assert result == ['repo0']
 
 
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
 @gen_test
-def test_scheduler_notification_respects_order():
-    queue = Queue.Queue()
-    notification_q = repositories.Notification(queue)
-    scheduler = repositories.Scheduler()
-    scheduler._time = lambda: 0
-    notification_q.connect_with(scheduler)
+def test_scheduler_woken_by_notification():
+    notification, scheduler = connected_notification()
+    waiting = scheduler.wait()
+
+    notification.put_nowait('repo0')
+    yield sleep(0.01)
+
+    assert waiting.done()
+
 
-    notification_q.put_nowait('repo0')
-    notification_q.put_nowait('repo1')
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
+@gen_test
+def test_scheduler_notification_respects_order():
+    notification, scheduler = connected_notification()
 
-    yield notification_q._check_for_notifications()
+    notification.put_nowait('repo0')
+    notification.put_nowait('repo1')
+    yield sleep(0.01)
 
     scheduler._time = lambda: repositories.options.notify_min_delay
     result = yield scheduler.get()
@@ -60,21 +76,130 @@ def test_scheduler_notification_respects_order():
     assert result == ['repo1']
 
 
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
 @gen_test
 def test_scheduler_notification_in_same_batch_get_merged():
-    queue = Queue.Queue()
-    notification_q = repositories.Notification(queue)
-    scheduler = repositories.Scheduler()
-    scheduler._time = lambda: 0
-    notification_q.connect_with(scheduler)
+    notification, scheduler = connected_notification()
 
-    notification_q.put_nowait('repo0')
-    notification_q.put_nowait('repo1')
+    notification.put_nowait('repo0')
+    notification.put_nowait('repo1')
     for i in range(10):
-        notification_q.put_nowait('repo0')
-    yield notification_q._check_for_notifications()
+        notification.put_nowait('repo0')
+    yield sleep(0.01)
 
     scheduler._time = lambda: repositories.options.notify_min_delay
     result = yield scheduler.get(3)
 
     assert set(result) == {'repo0', 'repo1'}
+
+
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
+@gen_test
+def test_notifications_wait_for_reader():
+    """Notifications are kept (and merged) while the pipe is full"""
+    notification = repositories.Notification()
+    notification.PIPE_BUF = 10
+    written = []
+
+    def write(fd, data):
+        if len(written) >= 2:
+            raise OSError(repositories.errno.EAGAIN, 'full')
+        written.append(data)
+        return len(data)
+
+    with patch('index.repositories.os.write', write):
+        for i in range(5):
+            notification.put_nowait('repo%d' % i)
+        notification.put_nowait('repo3')
+
+    assert written == [b'repo0\n', b'repo1\n']
+    assert list(notification._pending) == [b'repo2', b'repo3', b'repo4']
+
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+    notification.connect_with(scheduler)
+    notification.start()
+    yield sleep(0.01)
+
+    assert not notification._pending
+    assert len(scheduler) == 3
+
+
+@patch.object(options.mockable(), 'notifications_queue_max_size', 2)
+@patch('index.repositories.os.write')
+def test_notifications_dropped_when_full(write):
+    write.side_effect = OSError(repositories.errno.EAGAIN, 'full')
+    notification = repositories.Notification()
+
+    with patch('index.repositories.IOLoop'):
+        for i in range(5):
+            notification.put_nowait('repo%d' % i)
+
+    assert list(notification._pending) == [b'repo0', b'repo1']
+
+
+@patch.object(options.mockable(), 'notify_debounce', 0.01)
+@gen_test
+def test_notifications_sent_once_per_debounce_window():
+    notification = repositories.Notification()
+    written = []
+
+    def write(fd, data):
+        written.append(data)
+        return len(data)
+
+    with patch('index.repositories.os.write', write):
+        for i in range(10):
+            notification.put_nowait('repo0')
+            notification.put_nowait('repo1')
+
+        assert written == []
+        yield sleep(0.02)
+
+    assert written == [b'repo0\nrepo1\n']
+    assert notification.stats() == {
+        'received': 20, 'coalesced': 18, 'dropped': 0, 'delivered': 2}
+
+
+@gen_test
+def test_notification_not_rescheduled_if_due_sooner():
+    notification, scheduler = connected_notification()
+    scheduler.schedule('repo0', 0)
+
+    notification._buffer = b'repo0\nrepo1\nrepo1'
+    with patch('index.repositories.os.read', side_effect=[b'\n', b'']):
+        notification._read()
+
+    assert len(scheduler) == 2
+    assert notification.stats() == {
+        'received': 3, 'coalesced': 2, 'dropped': 0, 'delivered': 1}
+
+
+@pytest.mark.parametrize('repo_id', [
+    '', 'repo\n0', 1, None, u'x' * 5000,
+])
+def test_invalid_notification(repo_id):
+    notification = repositories.Notification()
+
+    with pytest.raises(ValueError):
+        notification.put_nowait(repo_id)
+
+    assert not notification._pending
+
+
+@patch.object(options.mockable(), 'notify_debounce', 0.0)
+def test_notification_longer_than_pipe_buf_not_written():
+    """An id that cannot be written at once does not block the others"""
+    notification = repositories.Notification()
+    notification._pending[b'x' * notification.PIPE_BUF] = None
+    written = []
+
+    def write(fd, data):
+        written.append(data)
+        return len(data)
+
+    with patch('index.repositories.os.write', write):
+        notification.put_nowait('repo0')
+
+    assert written == [b'repo0\n']
+    assert not notification._pending
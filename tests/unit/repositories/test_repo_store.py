@@ -16,25 +16,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import shelve
 from datetime import datetime
 import pytest
 from mock import call, patch, Mock, MagicMock
 from tornado.httpclient import HTTPError
 from koi.test_helpers import make_future, gen_test
-from tornado.options import define
+from tornado.options import define, options
 from freezegun import freeze_time
 
 from index import repositories
+from index.models.repository_states import RepositoryStates
+from index.models.repository_status import RepositoryStatus
 
 
 define('ssl_ca_cert', default='')
 
 
-@patch('index.repositories.shelve')
+def repository_states(repos=None):
+    """Returns repository states stored in memory"""
+    states = RepositoryStates(':memory:')
+    for repo_id, repository in (repos or {}).items():
+        states[repo_id] = repository
+    states.flush()
+    return states
+
+
 @patch('index.repositories.API')
 @patch('index.repositories.koi')
 @gen_test
-def test_get_repositories(koi, API, shelve):
+def test_get_repositories(koi, API):
     API().accounts.repositories.get.return_value = make_future({
         'data': [{'id': 'a', 'location': 'http://a.test'},
                  {'id': 'b', 'location': 'http://b.test'}]
@@ -43,61 +54,300 @@ def test_get_repositories(koi, API, shelve):
     schedule_fetch = Mock()
     schedule_fetch.return_value = make_future([])
 
-    repostore = repositories.RepositoryStore({})
+    repostore = repositories.RepositoryStore(states=repository_states())
     repostore.on_new_repo = schedule_fetch
-    repostore._shelf = {}
 
     yield repostore._fetch_repositories()
 
     assert API().accounts.repositories.get.called
     schedule_fetch.assert_has_calls([call('a'), call('b')])
-    assert repostore._shelf == {
-        'a':  {'id': 'a', 'location': 'http://a.test'},
-        'b':  {'id': 'b', 'location': 'http://b.test'}
-    }
+    assert repostore.get_repositories() == {'a', 'b'}
+    assert repostore._states['a'] == {'id': 'a', 'location': 'http://a.test'}
+    assert repostore._states['b'] == {'id': 'b', 'location': 'http://b.test'}
 
 
-@patch('index.repositories.shelve')
 @patch('index.repositories.API')
 @patch('index.repositories.koi')
 @gen_test
-def test_get_repositories_are_registered_once(koi, API, shelve):
+def test_get_repositories_are_registered_once(koi, API):
     API().accounts.repositories.get.return_value = make_future({
-        'data': [{'id': 'a', 'location': 'http://a.test'}]
+        'data': [{'id': 'a', 'location': 'http://a.test'},
+                 {'id': 'b', 'location': 'http://b.test'}]
     })
 
     schedule_fetch = Mock()
     schedule_fetch.return_value = make_future([])
 
-    repostore = repositories.RepositoryStore({})
-    repostore.on_new_repo = schedule_fetch
-    repostore._shelf = {
+    repostore = repositories.RepositoryStore(states=repository_states({
         'a':  {'id': 'a', 'location': 'http://a.test'},
         'b':  {'id': 'b', 'location': 'http://b.test'}
-    }
+    }))
+    repostore.on_new_repo = schedule_fetch
 
-    repostore._fetch_repositories()
+    yield repostore._fetch_repositories()
 
     assert not schedule_fetch.called
-    assert repostore._shelf == {
+    assert repostore.get_repositories() == {'a', 'b'}
+    assert repostore._states['a'] == {'id': 'a', 'location': 'http://a.test'}
+    assert repostore._states['b'] == {'id': 'b', 'location': 'http://b.test'}
+
+
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_changed(koi, API):
+    """The record is updated, keeping the state of the polling"""
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a2.test'}]
+    })
+
+    repostore = repositories.RepositoryStore(states=repository_states({
+        'a':  {'id': 'a', 'location': 'http://a.test', 'errors': 1},
+    }))
+    repostore.on_new_repo = Mock()
+
+    yield repostore._fetch_repositories()
+
+    assert not repostore.on_new_repo.called
+    assert repostore._states['a'] == {'id': 'a', 'location': 'http://a2.test', 'errors': 1}
+
+
+@patch.object(options.mockable(), 'repository_removal_grace', 100)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_removed(koi, API):
+    """
+    Repositories no longer listed are removed and unscheduled after the
+    grace period, unless they were fetched on their own
+    """
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a.test'}]
+    })
+    status = RepositoryStatus(10)
+    status.set('b', None)
+
+    repostore = repositories.RepositoryStore(states=repository_states({
         'a':  {'id': 'a', 'location': 'http://a.test'},
-        'b':  {'id': 'b', 'location': 'http://b.test'}
+        'b':  {'id': 'b', 'location': 'http://b.test'},
+        'c':  {'id': 'c', 'location': 'http://c.test', 'unlisted': True}
+    }), status=status)
+    repostore.on_removed_repo = Mock()
+
+    with freeze_time('2016-01-01 00:00:00'):
+        yield repostore._fetch_repositories()
+
+    assert not repostore.on_removed_repo.called
+    assert repostore.get_repositories() == {'a', 'b', 'c'}
+    assert 'missing_since' in repostore._states['b']
+
+    with freeze_time('2016-01-01 00:01:00'):
+        yield repostore._fetch_repositories()
+
+    assert not repostore.on_removed_repo.called
+
+    with freeze_time('2016-01-01 00:02:00'):
+        yield repostore._fetch_repositories()
+
+    repostore.on_removed_repo.assert_called_once_with('b')
+    assert repostore.get_repositories() == {'a', 'c'}
+    with pytest.raises(KeyError):
+        status.get('b')
+
+
+@patch.object(options.mockable(), 'repository_removal_grace', 100)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_listed_again(koi, API):
+    """A repository listed again within the grace period is kept"""
+    repostore = repositories.RepositoryStore(states=repository_states({
+        'a':  {'id': 'a', 'location': 'http://a.test'},
+        'b':  {'id': 'b', 'location': 'http://b.test', 'next': '2016-01-01'}
+    }))
+    repostore.on_removed_repo = Mock()
+
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a.test'}]
+    })
+    with freeze_time('2016-01-01 00:00:00'):
+        yield repostore._fetch_repositories()
+
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a.test'},
+                 {'id': 'b', 'location': 'http://b.test'}]
+    })
+    with freeze_time('2016-01-01 00:01:00'):
+        yield repostore._fetch_repositories()
+
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a.test'}]
+    })
+    with freeze_time('2016-01-01 00:02:00'):
+        yield repostore._fetch_repositories()
+
+    assert not repostore.on_removed_repo.called
+    assert repostore._states['b']['next'] == '2016-01-01'
+
+
+@patch.object(options.mockable(), 'repository_removal_grace', 0)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_empty_list_not_pruned(koi, API):
+    """Nothing is removed if the accounts service lists no repositories"""
+    API().accounts.repositories.get.return_value = make_future({'data': []})
+    repostore = repositories.RepositoryStore(states=repository_states({
+        'a':  {'id': 'a', 'location': 'http://a.test'},
+    }))
+    repostore.on_removed_repo = Mock()
+
+    yield repostore._fetch_repositories()
+
+    assert not repostore.on_removed_repo.called
+    assert repostore.get_repositories() == {'a'}
+
+
+@patch.object(options.mockable(), 'repository_removal_grace', 0)
+@patch.object(options.mockable(), 'accounts_page_size', 2)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_failed_page_not_pruned(koi, API):
+    """Nothing is removed if a page of the list could not be fetched"""
+    def get(page, **kwargs):
+        if page == 2:
+            raise HTTPError(503)
+        return make_future({'data': [{'id': 'a'}, {'id': 'b'}]})
+
+    API().accounts.repositories.get.side_effect = get
+    repostore = repositories.RepositoryStore(states=repository_states({
+        'a':  {'id': 'a'},
+        'b':  {'id': 'b'},
+        'c':  {'id': 'c'},
+    }))
+    repostore.on_removed_repo = Mock()
+
+    yield repostore._fetch_repositories()
+
+    assert not repostore.on_removed_repo.called
+    assert repostore.get_repositories() == {'a', 'b', 'c'}
+
+
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_not_modified(koi, API):
+    """The list is only requested if modified since the last sync"""
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a', 'location': 'http://a.test'}]
+    })
+    repostore = repositories.RepositoryStore(states=repository_states())
+    repostore.on_new_repo = Mock(return_value=make_future(None))
+    yield repostore._fetch_repositories()
+
+    API().accounts.repositories.get.return_value = None
+    API().accounts.repositories.get.side_effect = HTTPError(304)
+    repostore.on_removed_repo = Mock()
+    yield repostore._fetch_repositories()
+
+    _, kwargs = API().accounts.repositories.get.call_args
+    assert 'If-Modified-Since' in kwargs['headers']
+    assert not repostore.on_removed_repo.called
+    assert repostore.get_repositories() == {'a'}
+
+
+@patch.object(options.mockable(), 'accounts_page_size', 2)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_paginated(koi, API):
+    pages = {
+        1: [{'id': 'a'}, {'id': 'b'}],
+        2: [{'id': 'c'}, {'id': 'd'}],
+        3: [{'id': 'e'}]
     }
+    API().accounts.repositories.get.side_effect = lambda page, **kwargs: make_future(
+        {'data': pages.get(page, [])})
+    repostore = repositories.RepositoryStore(states=repository_states())
+    repostore.on_new_repo = Mock(return_value=make_future(None))
+
+    yield repostore._fetch_repositories()
+
+    assert repostore.get_repositories() == {'a', 'b', 'c', 'd', 'e'}
+    assert API().accounts.repositories.get.call_count == 4
+
+
+@patch.object(options.mockable(), 'accounts_page_size', 3)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_short_pages(koi, API):
+    """Keep requesting pages if the service caps the page size"""
+    pages = {
+        1: [{'id': 'a'}, {'id': 'b'}],
+        2: [{'id': 'c'}, {'id': 'd'}],
+        3: [{'id': 'e'}]
+    }
+    API().accounts.repositories.get.side_effect = lambda page, **kwargs: make_future(
+        {'data': pages.get(page, [])})
+    repostore = repositories.RepositoryStore(states=repository_states())
+    repostore.on_new_repo = Mock(return_value=make_future(None))
+
+    yield repostore._fetch_repositories()
+
+    assert repostore.get_repositories() == {'a', 'b', 'c', 'd', 'e'}
+
+
+@patch.object(options.mockable(), 'accounts_page_size', 2)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_end_marker(koi, API):
+    """Stop requesting pages when the metadata has no next page"""
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a'}],
+        'metadata': {'next': None}
+    })
+    repostore = repositories.RepositoryStore(states=repository_states())
+    repostore.on_new_repo = Mock(return_value=make_future(None))
+
+    yield repostore._fetch_repositories()
+
+    assert repostore.get_repositories() == {'a'}
+    assert API().accounts.repositories.get.call_count == 1
+
+
+@patch.object(options.mockable(), 'accounts_page_size', 2)
+@patch('index.repositories.API')
+@patch('index.repositories.koi')
+@gen_test
+def test_get_repositories_pages_ignored(koi, API):
+    """Stop requesting pages if the service returns the whole list"""
+    API().accounts.repositories.get.return_value = make_future({
+        'data': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+    })
+    repostore = repositories.RepositoryStore(states=repository_states())
+    repostore.on_new_repo = Mock(return_value=make_future(None))
+
+    yield repostore._fetch_repositories()
+
+    assert repostore.get_repositories() == {'a', 'b', 'c'}
+    assert API().accounts.repositories.get.call_count == 2
 
 
-@patch('index.repositories.shelve')
 @patch('index.repositories.logging')
 @patch('index.repositories.API')
 @patch('index.repositories.koi')
 @gen_test
-def test_get_repositories_swallow_exceptions(koi, API, logging, shelve):
+def test_get_repositories_swallow_exceptions(koi, API, logging):
     """Log but don't raise exceptions"""
     API().accounts.repositories.get.side_effect = Exception('Test')
 
     schedule_fetch = Mock()
     schedule_fetch.return_value = make_future([])
 
-    repostore = repositories.RepositoryStore({})
+    repostore = repositories.RepositoryStore(states=repository_states())
     repostore.on_new_repo = schedule_fetch
 
     yield repostore._fetch_repositories()
@@ -106,25 +356,21 @@ def test_get_repositories_swallow_exceptions(koi, API, logging, shelve):
     assert not schedule_fetch.called
 
 
-@patch('index.repositories.shelve')
 @gen_test
-def test_get_repository(shelve):
-    shelf = {'repo1': {'id': 1}}
-    shelve.open.return_value = shelf
+def test_get_repository():
+    repos = {'repo1': {'id': 1}}
 
-    repo_store = repositories.RepositoryStore({}, api_client=Mock())
+    repo_store = repositories.RepositoryStore(states=repository_states(repos), api_client=Mock())
     result = yield repo_store.get_repository('repo1')
 
-    assert result == shelf['repo1']
+    assert result == repos['repo1']
 
 
 @patch('index.repositories.options')
-@patch('index.repositories.shelve')
 @gen_test
-def test_get_unknown_repository_closed_service(shelve, options):
+def test_get_unknown_repository_closed_service(options):
     """When closed service don't fetch unknown repository"""
-    shelf = {}
-    shelve.open.return_value = shelf
+    repos = {}
     options.open_service = False
 
     api_client = MagicMock()
@@ -132,7 +378,7 @@ def test_get_unknown_repository_closed_service(shelve, options):
     endpoint().get.return_value = make_future({'data': {'id': 1}})
     endpoint.reset_mock()
 
-    repo_store = repositories.RepositoryStore({}, api_client=api_client)
+    repo_store = repositories.RepositoryStore(states=repository_states(repos), api_client=api_client)
     with pytest.raises(KeyError):
         yield repo_store.get_repository('repo1')
 
@@ -140,12 +386,10 @@ def test_get_unknown_repository_closed_service(shelve, options):
     assert not endpoint().get.called
 
 
-@patch('index.repositories.shelve')
 @gen_test
-def test_get_unknown_repository_exists_in_accounts(shelve):
+def test_get_unknown_repository_exists_in_accounts():
     """Query for a service that exists in the accounts service"""
-    shelf = {}
-    shelve.open.return_value = shelf
+    repos = {}
 
     repo_id = 'repo1'
     repo = {'id': repo_id}
@@ -154,26 +398,24 @@ def test_get_unknown_repository_exists_in_accounts(shelve):
     endpoint().get.return_value = make_future({'data': repo})
     endpoint.reset_mock()
 
-    repo_store = repositories.RepositoryStore({}, api_client=api_client)
+    repo_store = repositories.RepositoryStore(states=repository_states(repos), api_client=api_client)
     result = yield repo_store.get_repository(repo_id)
 
     endpoint.assert_called_once_with(repo_id)
     assert endpoint().get.called
-    assert result == repo
+    assert result == dict(repo, unlisted=True)
 
 
-@patch('index.repositories.shelve')
 @gen_test
-def test_get_unknown_repository_does_not_exist_in_accounts(shelve):
+def test_get_unknown_repository_does_not_exist_in_accounts():
     """Query for a service that doesn't exist in the accounts service"""
-    shelf = {}
-    shelve.open.return_value = shelf
+    repos = {}
 
     api_client = MagicMock()
     endpoint = api_client.accounts.repositories.__getitem__
     endpoint().get.side_effect = HTTPError(404, 'Unknown resource')
 
-    repo_store = repositories.RepositoryStore({}, api_client=api_client)
+    repo_store = repositories.RepositoryStore(states=repository_states(repos), api_client=api_client)
     with pytest.raises(KeyError):
         yield repo_store.get_repository('repo1')
 
@@ -182,70 +424,64 @@ def test_get_unknown_repository_does_not_exist_in_accounts(shelve):
 
 
 @patch('index.repositories.logging')
-@patch('index.repositories.shelve')
 @gen_test
-def test_fail(shelve, logging):
+def test_fail(logging):
     """Test recording failed fetch"""
-    shelf = {'repo1': {}}
-    shelve.open.return_value = shelf
+    repos = {'repo1': {}}
 
-    store = repositories.RepositoryStore({}, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     store.fail('repo1', 'An error')
-    assert shelf['repo1'] == {'errors': 1}
+    assert store._states['repo1']['errors'] == 1
+    backoff = store._states['repo1']['backoff']
+    assert backoff > 0
 
     store.fail('repo1', 'An error')
-    assert shelf['repo1'] == {'errors': 2}
+    assert store._states['repo1']['errors'] == 2
+    assert store._states['repo1']['backoff'] <= 3 * backoff
 
     logging.warning.assert_has_calls([call('An error'), call('An error')])
 
 
 @patch('index.repositories.logging')
-@patch('index.repositories.shelve')
 @gen_test
-def test_fail_without_reason(shelve, logging):
+def test_fail_without_reason(logging):
     """Test recording failed fetch without specifying a reason"""
-    shelf = {'repo1': {}}
-    shelve.open.return_value = shelf
+    repos = {'repo1': {}}
 
-    store = repositories.RepositoryStore({}, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     store.fail('repo1')
-    assert shelf['repo1'] == {'errors': 1}
+    assert store._states['repo1']['errors'] == 1
 
     assert logging.warning.call_count == 1
 
 
-@patch('index.repositories.shelve')
 @gen_test
-def test_fail_unknown_(shelve):
+def test_fail_unknown_():
     """
     Test KeyError raised if unknown repository
 
     We don't want to keep a record of unknown repositories
     """
-    shelf = {'repo1': {}}
-    shelve.open.return_value = shelf
+    repos = {'repo1': {}}
 
-    store = repositories.RepositoryStore({}, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     with pytest.raises(KeyError):
         yield store.fail('repo0')
 
-    assert shelf['repo1'] == {}
+    assert store._states['repo1'] == {}
 
 
 @freeze_time("2000-01-01")
 @patch('index.repositories.IOLoop')
-@patch('index.repositories.shelve')
 @gen_test
-def test_success(shelve, IOLoop):
+def test_success(IOLoop):
     """Test recording successful fetch"""
-    shelf = {'repo1': {}}
-    shelve.open.return_value = shelf
-    repo_dict = {}
+    repos = {'repo1': {}}
 
-    store = repositories.RepositoryStore(repo_dict, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     now = datetime.now()
     store.success('repo1', now)
@@ -255,8 +491,7 @@ def test_success(shelve, IOLoop):
         'errors': 0,
         'successful_queries': 1
     }
-    assert shelf['repo1'] == expected
-    assert repo_dict['repo1'] == expected
+    assert store._states['repo1'] == expected
 
     later = datetime.now()
     store.success('repo1', later)
@@ -266,21 +501,17 @@ def test_success(shelve, IOLoop):
         'errors': 0,
         'successful_queries': 2
     }
-    assert shelf['repo1'] == expected
-    assert repo_dict['repo1'] == expected
+    assert store._states['repo1'] == expected
 
 
 @freeze_time("2000-01-01")
 @patch('index.repositories.IOLoop')
-@patch('index.repositories.shelve')
 @gen_test
-def test_success_resets_errors(shelve, IOLoop):
+def test_success_resets_errors(IOLoop):
     """Test recording successful fetch resets errors"""
-    shelf = {'repo1': {'errors': 10}}
-    shelve.open.return_value = shelf
-    repo_dict = {}
+    repos = {'repo1': {'errors': 10, 'backoff': 3600}}
 
-    store = repositories.RepositoryStore(repo_dict, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     now = datetime.now()
     store.success('repo1', now)
@@ -290,21 +521,17 @@ def test_success_resets_errors(shelve, IOLoop):
         'errors': 0,
         'successful_queries': 1
     }
-    assert shelf['repo1'] == expected
-    assert repo_dict['repo1'] == expected
+    assert store._states['repo1'] == expected
 
 
 @freeze_time("2000-01-01")
 @patch('index.repositories.IOLoop')
-@patch('index.repositories.shelve')
 @gen_test
-def test_success_without_next(shelve, IOLoop):
+def test_success_without_next(IOLoop):
     """Test recording successful fetch resets errors"""
-    shelf = {'repo1': {}}
-    shelve.open.return_value = shelf
-    repo_dict = {}
+    repos = {'repo1': {}}
 
-    store = repositories.RepositoryStore(repo_dict, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     store.success('repo1')
     expected = {
@@ -313,21 +540,17 @@ def test_success_without_next(shelve, IOLoop):
         'errors': 0,
         'successful_queries': 1
     }
-    assert shelf['repo1'] == expected
-    assert repo_dict['repo1'] == expected
+    assert store._states['repo1'] == expected
 
 
 @freeze_time("2000-01-01")
 @patch('index.repositories.IOLoop')
-@patch('index.repositories.shelve')
 @gen_test
-def test_success_replace_next_with_none(shelve, IOLoop):
+def test_success_replace_next_with_none(IOLoop):
     """Test recording successful fetch resets errors"""
-    shelf = {'repo1': {'next': 'something'}}
-    shelve.open.return_value = shelf
-    repo_dict = {}
+    repos = {'repo1': {'next': 'something'}}
 
-    store = repositories.RepositoryStore(repo_dict, api_client=MagicMock())
+    store = repositories.RepositoryStore(states=repository_states(repos), api_client=MagicMock())
 
     store.success('repo1')
     expected = {
@@ -336,5 +559,76 @@ def test_success_replace_next_with_none(shelve, IOLoop):
         'errors': 0,
         'successful_queries': 1
     }
-    assert shelf['repo1'] == expected
-    assert repo_dict['repo1'] == expected
+    assert store._states['repo1'] == expected
+
+
+@freeze_time("2000-01-01")
+@patch('index.repositories.IOLoop')
+@gen_test
+def test_success_published_to_status(IOLoop):
+    """Test the last indexed time is shared with the web workers"""
+    repos = {'repo1': {}, 'repo2': {'last': datetime(1999, 1, 1)}}
+    status = RepositoryStatus(10)
+
+    store = repositories.RepositoryStore(states=repository_states(repos),
+                                         api_client=MagicMock(), status=status)
+    assert not status.complete
+    store.start()
+    assert status.complete
+    assert status.get('repo1') is None
+    assert status.get('repo2') == datetime(1999, 1, 1)
+
+    store.success('repo1')
+    assert status.get('repo1') == datetime(2000, 1, 1)
+
+
+@patch('index.repositories.IOLoop')
+@gen_test
+def test_success_records_poll_history(IOLoop):
+    """Test the number of rows and pages fetched are recorded"""
+    repos = {'repo1': {'last': datetime(2000, 1, 1), 'next': datetime(1999, 1, 1)}}
+    store = repositories.RepositoryStore(states=repository_states(repos),
+                                         api_client=MagicMock())
+
+    with freeze_time('2000-01-01 01:00:00'):
+        store.success('repo1', datetime(1999, 1, 2), 10, 1)
+    with freeze_time('2000-01-01 02:00:00'):
+        store.success('repo1', datetime(1999, 1, 2), 0, 0)
+
+    assert store._states['repo1']['polls'] == [
+        {'rows': 10, 'pages': 1, 'interval': 3600, 'moved': 3600 * 24, 'truncated': False},
+        {'rows': 0, 'pages': 0, 'interval': 3600, 'moved': 0, 'truncated': False}
+    ]
+
+
+@patch('index.repositories.IOLoop')
+@gen_test
+def test_success_poll_history_size(IOLoop):
+    """Test only the last poll_history_size polls are kept"""
+    store = repositories.RepositoryStore(states=repository_states({'repo1': {}}),
+                                         api_client=MagicMock())
+
+    for rows in range(repositories.options.poll_history_size + 2):
+        store.success('repo1', None, rows, 1)
+
+    polls = store._states['repo1']['polls']
+    assert len(polls) == repositories.options.poll_history_size
+    assert polls[-1]['rows'] == repositories.options.poll_history_size + 1
+
+
+@patch('index.repositories.IOLoop')
+def test_start_imports_legacy_shelf(IOLoop, tmpdir):
+    """The repositories of the shelf of earlier versions are kept on upgrade"""
+    shelf_path = str(tmpdir.join('repos_shelf.db'))
+    shelf = shelve.open(shelf_path)
+    shelf['repo1'] = {'id': 'repo1', 'next': datetime(2016, 7, 8)}
+    shelf.close()
+    status = RepositoryStatus(10)
+
+    store = repositories.RepositoryStore(states=repository_states(),
+                                         api_client=MagicMock(), status=status)
+    with patch.object(options.mockable(), 'legacy_local_db', shelf_path):
+        store.start()
+
+    assert store.get_repositories() == {'repo1'}
+    assert store._get_repository('repo1')['next'] == datetime(2016, 7, 8)
@@ -16,7 +16,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import timedelta
+
 from koi.test_helpers import gen_test
+from tornado.gen import sleep, with_timeout
+from tornado.ioloop import IOLoop
 
 from index import repositories
 
@@ -209,3 +213,166 @@ def test_get_rescheduled_in_the_future():
     result = yield scheduler.get(5)
 
     assert result == ['repo1']
+
+
+@gen_test
+def test_rescheduled_items_compacted():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+
+    for i in range(100):
+        yield scheduler.schedule('repo%d' % i, i)
+    for _ in range(3):
+        for i in range(100):
+            yield scheduler.schedule('repo%d' % i, i + 1)
+
+    assert len(scheduler) == 100
+    assert len(scheduler._priority_q) <= 100 * (1 + repositories.options.scheduler_compact_ratio) + 1
+
+    scheduler._time = lambda: 1000
+    result = yield scheduler.get(200)
+    assert result == ['repo%d' % i for i in range(100)]
+    assert scheduler._priority_q == []
+    assert len(scheduler) == 0
+
+
+@gen_test
+def test_get_skips_removed_items_scheduled_later():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+
+    yield scheduler.schedule('repo0', 1)
+    yield scheduler.schedule('repo0', 10)
+
+    scheduler._time = lambda: 5
+    result = yield scheduler.get()
+
+    assert result == []
+    assert len(scheduler._priority_q) == 1
+
+
+@gen_test
+def test_reschedule_after_get():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+
+    yield scheduler.schedule('repo0', 0)
+    result = yield scheduler.get()
+    assert result == ['repo0']
+    scheduler.done('repo0')
+
+    yield scheduler.reschedule('repo0', 5)
+    assert scheduler._items['repo0'][0] == 5
+
+
+@gen_test
+def test_wait_item_due():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 10
+
+    yield scheduler.schedule('repo0', -1)
+
+    yield with_timeout(timedelta(seconds=1), scheduler.wait())
+
+
+@gen_test
+def test_wait_until_item_due():
+    scheduler = repositories.Scheduler()
+    yield scheduler.schedule('repo0', 0.05)
+    start = IOLoop.current().time()
+
+    yield with_timeout(timedelta(seconds=1), scheduler.wait())
+
+    assert IOLoop.current().time() - start >= 0.04
+    result = yield scheduler.get()
+    assert result == ['repo0']
+
+
+@gen_test
+def test_wait_woken_by_schedule():
+    scheduler = repositories.Scheduler()
+    yield scheduler.schedule('repo0', 3600)
+    waiting = scheduler.wait()
+
+    yield sleep(0.01)
+    assert not waiting.done()
+
+    yield scheduler.reschedule('repo0', 0)
+    yield with_timeout(timedelta(seconds=1), waiting)
+
+
+@gen_test
+def test_wait_empty():
+    scheduler = repositories.Scheduler()
+    waiting = scheduler.wait()
+
+    yield sleep(0.01)
+    assert not waiting.done()
+
+    yield scheduler.schedule('repo0', 0)
+    yield with_timeout(timedelta(seconds=1), waiting)
+
+
+@gen_test
+def test_unschedule():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+    yield scheduler.schedule('repo0', 0)
+    yield scheduler.schedule('repo1', 0)
+
+    scheduler.unschedule('repo0')
+    scheduler.unschedule('unknown')
+
+    assert len(scheduler) == 1
+    result = yield scheduler.get(2)
+    assert result == ['repo1']
+
+
+@gen_test
+def test_get_in_flight_until_done():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+    yield scheduler.schedule('repo0', 0)
+
+    result = yield scheduler.get()
+    assert result == ['repo0']
+
+    rescheduled = yield scheduler.reschedule('repo0', 0)
+    assert rescheduled
+    result = yield scheduler.get()
+    assert result == []
+
+    scheduler.done('repo0', 10)
+    assert scheduler._items['repo0'][0] == 0
+    result = yield scheduler.get()
+    assert result == ['repo0']
+
+
+@gen_test
+def test_done_without_reschedule():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+    yield scheduler.schedule('repo0', 0)
+    yield scheduler.get()
+
+    scheduler.done('repo0', 10)
+    assert scheduler._items['repo0'][0] == 10
+
+    yield scheduler.schedule('repo1', 0)
+    yield scheduler.get()
+    scheduler.done('repo1')
+    assert 'repo1' not in scheduler._items
+
+
+@gen_test
+def test_unschedule_in_flight():
+    scheduler = repositories.Scheduler()
+    scheduler._time = lambda: 0
+    yield scheduler.schedule('repo0', 0)
+    yield scheduler.get()
+    yield scheduler.reschedule('repo0', 0)
+
+    scheduler.unschedule('repo0')
+    scheduler.done('repo0')
+
+    assert len(scheduler) == 0
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014-2016 Digital Catapult and The Copyright Hub Foundation
+# (together the Open Permissions Platform Coalition)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from koi.test_helpers import gen_test, make_future
+from mock import patch
+from tornado.concurrent import Future
+from tornado.options import define, options
+
+from index import repositories
+
+
+define('url_auth', default='https://auth.test')
+define('service_id', default='index')
+define('client_secret', default='secret')
+
+
+class MockClient(object):
+    def __init__(self, token):
+        self.token = token
+
+
+@patch('index.repositories.ssl_server_options')
+@patch('index.repositories.request_token')
+@gen_test
+def test_token_requested(request_token, ssl_server_options):
+    request_token.return_value = make_future('token1')
+    repositories._clients.clear()
+
+    client = yield repositories.repository_service_client('http://a.test')
+
+    assert client.token == 'token1'
+    assert request_token.call_args[0] == (options.url_auth, options.service_id,
+                                          options.client_secret)
+
+
+@patch('index.repositories.request_token')
+def test_configure_tokens(request_token):
+    repositories.configure_tokens()
+
+    assert request_token.max_until_expired == options.token_refresh_margin
+
+
+@patch('index.repositories.ssl_server_options')
+@patch('index.repositories.API')
+@patch('index.repositories.request_token')
+@gen_test
+def test_concurrent_token_requests_shared(request_token, API, ssl_server_options):
+    """Concurrent callers wait for a single request when the token is refreshed"""
+    pending = Future()
+    request_token.return_value = pending
+    API.side_effect = lambda location, token, **kwargs: MockClient(token)
+    repositories._clients.clear()
+
+    clients = [repositories.repository_service_client(location)
+               for location in ['http://a.test', 'http://b.test', 'http://a.test']]
+    pending.set_result('token1')
+    clients = yield clients
+
+    assert request_token.call_count == 1
+    assert [x.token for x in clients] == ['token1'] * 3
+    assert clients[0] is clients[2]
+
+
+@patch('index.repositories.ssl_server_options')
+@patch('index.repositories.API')
+@patch('index.repositories.request_token')
+@gen_test
+def test_repository_service_client_reused(request_token, API, ssl_server_options):
+    request_token.return_value = make_future('token1')
+    API.side_effect = lambda location, token, **kwargs: MockClient(token)
+    repositories._clients.clear()
+
+    first = yield repositories.repository_service_client('http://a.test')
+    second = yield repositories.repository_service_client('http://a.test')
+    other = yield repositories.repository_service_client('http://b.test')
+
+    assert first is second
+    assert first is not other
+    assert API.call_count == 2
+
+
+@patch('index.repositories.ssl_server_options')
+@patch('index.repositories.API')
+@patch('index.repositories.request_token')
+@gen_test
+def test_repository_service_client_token_updated(request_token, API, ssl_server_options):
+    API.side_effect = lambda location, token, **kwargs: MockClient(token)
+    repositories._clients.clear()
+
+    request_token.return_value = make_future('token1')
+    first = yield repositories.repository_service_client('http://a.test')
+    request_token.return_value = make_future('token2')
+    second = yield repositories.repository_service_client('http://a.test')
+
+    assert first is second
+    assert second.token == 'token2'
+    assert API.call_count == 1
+
+
+@patch.object(repositories, 'MAX_CLIENTS', 2)
+@patch('index.repositories.ssl_server_options')
+@patch('index.repositories.API')
+@patch('index.repositories.request_token')
+@gen_test
+def test_repository_service_clients_bounded(request_token, API, ssl_server_options):
+    request_token.return_value = make_future('token1')
+    API.side_effect = lambda location, token, **kwargs: MockClient(token)
+    repositories._clients.clear()
+
+    for location in ['http://a.test', 'http://b.test', 'http://a.test', 'http://c.test']:
+        yield repositories.repository_service_client(location)
+
+    assert list(repositories._clients) == ['http://a.test', 'http://c.test']